@@ -0,0 +1,138 @@
+"""benchmark the startup time of the pavo cli and app
+
+usage: python dev/benchmarks/bench_startup.py [--repeat N] [--dataset PATH]
+
+Every scenario runs in a fresh interpreter. The script reports the median
+wall time and the heavy modules that got imported, and exits with a non
+zero status if a scenario exceeds its time budget or imports a module it
+must not import.
+
+Only the cli is lazy: `pavo version` and `pavo --help` import none of the
+heavy modules. `create_app` still imports the runtime dependencies of the
+views and extensions (flask, dynaconf, celery and pado, which pulls in
+pandas, pyarrow, shapely and tiffslide), so its time is reported but has
+no budget. Dataset opening happens in the background and is not part of
+the `create_app` scenario.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import os
+import statistics
+import subprocess
+import sys
+import time
+from typing import NamedTuple
+
+HEAVY_MODULES = [
+    "celery",
+    "dynaconf",
+    "flask",
+    "geopandas",
+    "pado",
+    "pandas",
+    "pyarrow",
+    "shapely",
+    "tiffslide",
+]
+
+_REPORT = """
+import json, sys
+print(json.dumps(sorted(m for m in {heavy!r} if m in sys.modules)))
+"""
+
+
+class Scenario(NamedTuple):
+    name: str
+    code: str
+    budget: float | None  # seconds
+    forbidden: tuple[str, ...] = ()
+
+
+SCENARIOS = [
+    Scenario(
+        name="pavo version",
+        code=(
+            "import sys; sys.argv = ['pavo', 'version']\n"
+            "from pavo.__main__ import cli\n"
+            "try:\n    cli()\nexcept SystemExit:\n    pass\n"
+        ),
+        budget=1.0,
+        forbidden=tuple(HEAVY_MODULES),
+    ),
+    Scenario(
+        name="pavo --help",
+        code=(
+            "import sys; sys.argv = ['pavo', '--help']\n"
+            "from pavo.__main__ import cli\n"
+            "try:\n    cli()\nexcept SystemExit:\n    pass\n"
+        ),
+        budget=1.0,
+        forbidden=tuple(HEAVY_MODULES),
+    ),
+    Scenario(
+        name="create_app",
+        code="from pavo.app import create_app\ncreate_app()\n",
+        budget=None,
+        forbidden=("geopandas",),
+    ),
+]
+
+
+def run(scenario: Scenario, env: dict[str, str]) -> tuple[float, list[str]]:
+    """run a scenario in a fresh interpreter"""
+    code = scenario.code + _REPORT.format(heavy=HEAVY_MODULES)
+    t0 = time.perf_counter()
+    out = subprocess.run(
+        [sys.executable, "-c", code],
+        capture_output=True,
+        check=True,
+        env=env,
+        text=True,
+    )
+    duration = time.perf_counter() - t0
+    return duration, json.loads(out.stdout.strip().splitlines()[-1])
+
+
+def main() -> int:
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument("--repeat", type=int, default=5)
+    parser.add_argument("--dataset", action="append", default=[])
+    args = parser.parse_args()
+
+    env = dict(os.environ)
+    env.setdefault("PAVO_INSTANCE_NAME", "benchmark")
+    if args.dataset:
+        env["PAVO_DATASET_PATHS"] = json.dumps(args.dataset)
+
+    baseline = statistics.median(
+        run(Scenario("python", "", budget=0), env)[0] for _ in range(args.repeat)
+    )
+    print(f"{'interpreter':<16} {baseline:7.3f}s")
+
+    failed = False
+    for scenario in SCENARIOS:
+        durations = []
+        for _ in range(args.repeat):
+            duration, modules = run(scenario, env)
+            durations.append(duration)
+        median = statistics.median(durations)
+        bad = sorted(set(modules).intersection(scenario.forbidden))
+        over = scenario.budget is not None and median > scenario.budget
+        failed |= over or bool(bad)
+        status = "FAIL" if over or bad else "ok"
+        budget = (
+            "no budget" if scenario.budget is None else f"budget {scenario.budget:.1f}s"
+        )
+        print(
+            f"{scenario.name:<16} {median:7.3f}s "
+            f"({budget}) {status:<4} imports: {modules}"
+        )
+        if bad:
+            print(f"  must not import: {bad}")
+    return 1 if failed else 0
+
+
+if __name__ == "__main__":
+    raise SystemExit(main())
@@ -0,0 +1,127 @@
+"""benchmark the tabular records pipeline on synthetic inputs
+
+usage: python dev/benchmarks/bench_tabular_records.py [--rows N ...] [--precomputed-area]
+
+Reports the time to compute the tabular records table for increasing
+numbers of annotation rows. The per-row cost should stay roughly constant.
+Parsing the wkt annotation geometries dominates the runtime, use
+`--precomputed-area` to time the remaining pipeline.
+"""
+from __future__ import annotations
+
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from pavo.tabular import TabularRecordsEngine
+from pavo.tabular import TabularRecordsInputs
+
+CLASSES = ["Necrosis", "Mitosis", "Hypertrophy", "Vacuolation", "Other"]
+ANNOTATORS = [{"name": "tgab", "type": "human"}, {"name": "ai9", "type": "model"}]
+
+
+def make_inputs(
+    num_rows: int,
+    rows_per_image: int = 200,
+    precomputed_area: bool = False,
+) -> TabularRecordsInputs:
+    """create synthetic dataset frames with num_rows annotations"""
+    rng = np.random.default_rng(42)
+    num_images = max(1, num_rows // rows_per_image)
+    image_ids = np.array(
+        [f"ImageId('image_{i}.svs', site='bench')" for i in range(num_images)],
+        dtype=object,
+    )
+
+    metadata = pd.DataFrame(
+        {
+            "classification": rng.choice(CLASSES, num_images),
+            "compound_name": rng.choice(["C0", "C1", "C2"], num_images),
+            "organ": rng.choice(["liver", "kidney"], num_images),
+            "species": "rat",
+        },
+        index=pd.Index(image_ids, name="image_id"),
+    )
+
+    x = rng.integers(0, 10000, num_rows)
+    s = rng.integers(1, 100, num_rows)
+    geometry = [
+        f"POLYGON (({a} {a}, {a} {a + b}, {a + b} {a + b}, {a + b} {a}, {a} {a}))"
+        for a, b in zip(x, s)
+    ]
+    annotations = pd.DataFrame(
+        {
+            "image_id": image_ids[rng.integers(0, num_images, num_rows)],
+            "annotator": [ANNOTATORS[i] for i in rng.integers(0, 2, num_rows)],
+            "classification": rng.choice(CLASSES, num_rows),
+            "geometry": geometry,
+        }
+    )
+
+    if precomputed_area:
+        annotations["area"] = (s * s).astype(float)
+
+    num_predictions = num_images * len(CLASSES)
+    metadata_predictions = pd.DataFrame(
+        {
+            "image_id": np.repeat(image_ids, len(CLASSES)),
+            "model_extra_json": json.dumps({"model": "AIgSeg", "iteration": "v1"}),
+            "row_json": [
+                json.dumps({"classification": c, "metric": "score", "value": v})
+                for c, v in zip(
+                    np.tile(CLASSES, num_images), rng.random(num_predictions)
+                )
+            ],
+        }
+    )
+    image_predictions = pd.DataFrame(
+        {
+            "image_id": image_ids,
+            "extra_metadata": json.dumps(
+                {"model": "Classifier", "iteration": "v2", "classes": CLASSES}
+            ),
+        }
+    )
+    tissue_area = pd.Series(np.full(num_images, 1e8), index=image_ids)
+    return TabularRecordsInputs(
+        identifier="tgbench",
+        metadata=metadata,
+        annotations=annotations,
+        image_predictions=image_predictions,
+        metadata_predictions=metadata_predictions,
+        tissue_area=tissue_area,
+    )
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument(
+        "--rows", type=int, nargs="+", default=[10_000, 100_000, 1_000_000]
+    )
+    parser.add_argument(
+        "--precomputed-area",
+        action="store_true",
+        help="provide an area column to exclude wkt parsing from the timing",
+    )
+    args = parser.parse_args()
+
+    engine = TabularRecordsEngine(
+        extra_columns=["compound_name", "organ", "species"],
+        extra_column_mode="ignore_missing",
+    )
+    print(f"{'rows':>10} {'table':>10} {'seconds':>10} {'us/row':>10}")
+    for num_rows in args.rows:
+        inputs = make_inputs(num_rows, precomputed_area=args.precomputed_area)
+        t0 = time.perf_counter()
+        table = engine.compute(inputs)
+        dt = time.perf_counter() - t0
+        print(
+            f"{num_rows:>10} {len(table):>10} {dt:>10.3f} {dt / num_rows * 1e6:>10.3f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -15,12 +15,11 @@ from typing import List
 from typing import NoReturn
 
 import typer
-from flask import Flask
 
 from pavo import __version__
-from pavo.app import create_app
-from pavo.config import default_config_as_file
-from pavo.config import initialize_config
+
+# note: flask, the app and the config are imported in the commands that need
+#   them, so that `pavo --help` and `pavo version` start instantly.
 
 # --- formatting utils ---
 
@@ -60,6 +59,8 @@ def searchtree() -> None:
     """print the current app config to console"""
     from dynaconf.utils import files as _files
 
+    from pavo.app import create_app
+
     # get the configured app
     app = create_app(is_worker=False, config_only=True)
     settings = app.dynaconf  # type: ignore
@@ -86,6 +87,10 @@ def config_show(
     production: bool = typer.Option(False, help="show prod config"),
 ) -> None:
     """show the current pavo configuration"""
+    from flask import Flask
+
+    from pavo.config import initialize_config
+
     app = Flask("pavo")
     settings = initialize_config(
         app=app,
@@ -100,6 +105,8 @@ def config_show(
 @cli_config.command(name="default")
 def config_default() -> None:
     """output the default pavo configuration"""
+    from pavo.config import default_config_as_file
+
     with default_config_as_file() as fn:
         typer.echo(fn.read_text())
 
@@ -162,6 +169,11 @@ def dev_run(
     port: int = typer.Option(8000, help="flask port"),
 ) -> None:
     """run development webserver"""
+    from flask import Flask
+
+    from pavo.app import create_app
+    from pavo.config import initialize_config
+
     overrides = {
         "DEBUG": debug,
         "SERVER": host,
@@ -211,6 +223,10 @@ def prod_run(
 
     NOTE: the production webserver is configured via the .pavo.toml config file!
     """
+    from flask import Flask
+
+    from pavo.config import initialize_config
+
     app = Flask("pavo")
     settings = initialize_config(app=app, force_env="production").settings
 
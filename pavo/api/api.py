@@ -1,19 +1,40 @@
 from __future__ import annotations
 
+import logging
+from typing import Iterable
+
+import orjson
+from celery.result import AsyncResult
 from flask import Blueprint
+from flask import current_app
+from flask import g
 from flask import jsonify
 from flask import request
+from flask import url_for
 from pado.images.ids import ImageId
 from werkzeug.exceptions import BadRequest
 
 from pavo._types import EndpointResponse
-from pavo.api.utils import get_filtered_image_ids
+from pavo.api.tasks import ingest_predictions_task
+from pavo.api.utils import InvalidPredictionRecord
+from pavo.api.utils import decode_cursor
+from pavo.api.utils import encode_cursor
+from pavo.api.utils import get_filtered_positions
+from pavo.api.utils import ingest_annotation_predictions
 from pavo.api.utils import insert_annotation_prediction
 from pavo.api.utils import insert_image_prediction
+from pavo.api.utils import validate_annotation_prediction
 from pavo.data import dataset
+from pavo.extensions import TaskState
+from pavo.extensions import celery
+from pavo.ingest import IngestQueueFull
+from pavo.ingest import IngestSpool
+from pavo.utils import int_ge_1
 
 blueprint = Blueprint("api", __name__)
 
+_logger = logging.getLogger(__name__)
+
 # ---- refresh endpoints ------------------------------------------------------
 
 
@@ -47,7 +68,23 @@ def manage_predictions(image_id: ImageId) -> EndpointResponse:
             return f'Prediction type "{prediction_type}" is invalid.', 400
 
         if prediction_type == "annotation":
-            return insert_annotation_prediction(prediction_record, image_id)
+            spool = _ingest_spool()
+            if spool is None:
+                return insert_annotation_prediction(prediction_record, image_id)
+            # reject malformed records now, not in the worker
+            try:
+                validate_annotation_prediction(prediction_record, image_id)
+            except InvalidPredictionRecord as e:
+                return str(e), 400
+            url_id = dataset.registry.url_id_of(image_id)
+            if url_id is None:
+                return f"unknown image_id {image_id.to_str()!r}", 404
+            line = {
+                "image_id": url_id,
+                "prediction_type": prediction_type,
+                "prediction": prediction_record,
+            }
+            return _enqueue_predictions(spool, [orjson.dumps(line)])
         else:
             return insert_image_prediction()
 
@@ -69,7 +106,86 @@ def manage_predictions(image_id: ImageId) -> EndpointResponse:
         raise RuntimeError(f"unknown method {request.method!r}")
 
 
+@blueprint.route("/predictions", methods=["POST"])
+def ingest_predictions() -> EndpointResponse:
+    """bulk insert annotation predictions of many images
+
+    The request body is newline delimited json (application/x-ndjson), one
+    prediction record per line: {"image_id": <url id>, "prediction_type":
+    "annotation", "prediction": {...}}. The body is read as a stream, so
+    large model runs can be posted in one request.
+
+    Returns the number of inserted records and the errors of the invalid
+    records by line number. Invalid records don't stop the ingest.
+
+    With PREDICTIONS_INGEST_MODE = "queued" the body is spooled for the
+    celery workers instead, and the response is a job id (202), or 429
+    when PREDICTIONS_INGEST_MAX_QUEUED jobs are already waiting.
+    """
+    spool = _ingest_spool()
+    if spool is not None:
+        return _enqueue_predictions(
+            spool, iter(lambda: request.stream.read(2**16), b"")
+        )
+    result = ingest_annotation_predictions(request.stream)
+    return jsonify(result.to_json()), 200
+
+
+@blueprint.route("/predictions/jobs/<string:job_id>", methods=["GET"])
+def prediction_job(job_id: str) -> EndpointResponse:
+    """return the state of a queued prediction ingest job
+
+    The result of a finished job is the response of the synchronous ingest.
+    """
+    result = AsyncResult(job_id, app=celery)
+    state = result.state
+    if state == TaskState.PENDING:
+        spool = IngestSpool.from_cache_path(current_app.config.get("CACHE_PATH"))
+        if spool is None or job_id not in spool:
+            return f"unknown job {job_id!r}", 404
+    info = result.info
+    if TaskState.is_exception(state):
+        info = {"error": str(info)}
+    return jsonify({"job_id": job_id, "status": state, "info": info}), 200
+
+
+def _ingest_spool() -> IngestSpool | None:
+    """the spool of the queued ingest mode, None ingests synchronously"""
+    if current_app.config.get("PREDICTIONS_INGEST_MODE", "sync") != "queued":
+        return None
+    spool = IngestSpool.from_cache_path(current_app.config.get("CACHE_PATH"))
+    if spool is None:
+        _logger.warning("queued prediction ingest requires a local CACHE_PATH")
+    return spool
+
+
+def _enqueue_predictions(
+    spool: IngestSpool, chunks: Iterable[bytes]
+) -> EndpointResponse:
+    """spool ndjson predictions and queue the ingest job for the workers"""
+    max_queued = int(current_app.config.get("PREDICTIONS_INGEST_MAX_QUEUED", 16))
+    try:
+        job_id = spool.submit(chunks, max_depth=max_queued)
+    except IngestQueueFull as e:
+        response = jsonify({"status": "rejected", "error": str(e)})
+        response.status_code = 429
+        response.headers["Retry-After"] = "10"
+        return response
+    try:
+        ingest_predictions_task.apply_async(
+            (job_id, g.get("pavo_dataset")), task_id=job_id
+        )
+    except Exception as e:
+        spool.discard(job_id)
+        return f"could not queue the prediction ingest: {e}", 503
+    link = url_for(".prediction_job", job_id=job_id)
+    return jsonify({"job_id": job_id, "status": TaskState.PENDING, "link": link}), 202
+
+
 # ---- filter dataset endpoints -----------------------------------------------
+IMAGE_IDS_MAX_LIMIT = 10_000
+
+
 @blueprint.route("/image_ids", methods=["GET"])
 def filter_by() -> EndpointResponse:
     """return image_ids which match some filter
@@ -79,13 +195,57 @@ def filter_by() -> EndpointResponse:
     - "filename": str,
     - "metadata_key": str,
     - "metadata_values": List[str]
+    - "query": a filter query, see pavo.filters.query_mask, e.g.
+      {"or": [{"metadata": {"organ": "liver"}}, {"prediction": "model-v1"}]}
+    - "order": "index", "filename" or a metadata key, prefixed with "-"
+      for descending order (default: SLIDES_ORDER)
+
+    Without query parameters all matching image_ids are returned. With the
+    `limit` query parameter a page of image_ids and the `next` cursor are
+    returned, pass it as the `cursor` query parameter to get the next page.
+    A cursor is rejected once the dataset changed, e.g. after a refresh or
+    a prediction ingest, because its offset would point into a different
+    result.
     """
 
-    filter = request.get_json()
+    filter = dict(request.get_json(silent=True) or {})
+    filter.setdefault("order", current_app.config.get("SLIDES_ORDER", "index"))
+    limit = request.args.get("limit", None, type=int_ge_1)
+    cursor = request.args.get("cursor", None)
+    if limit is not None and limit > IMAGE_IDS_MAX_LIMIT:
+        raise BadRequest(f"limit must be <= {IMAGE_IDS_MAX_LIMIT}")
 
     try:
-        image_ids = get_filtered_image_ids(filter)
+        snapshot = dataset.snapshot
+        filter_index = snapshot.filter_index
+        version = snapshot.version
+        positions = get_filtered_positions(
+            filter,
+            filter_index,
+            records=dataset.get_tabular_records_index,
+            version=version,
+        )
+        offset = 0 if cursor is None else decode_cursor(cursor, filter, version)
     except Exception as e:
         raise BadRequest(f"{e}")
 
-    return jsonify([image_id.to_url_id() for image_id in image_ids]), 200
+    if limit is None and cursor is None:
+        image_ids = filter_index.image_ids_at(positions)
+        return jsonify([image_id.to_url_id() for image_id in image_ids]), 200
+
+    stop = offset + (limit or IMAGE_IDS_MAX_LIMIT)
+    image_ids = filter_index.image_ids_at(positions[offset:stop])
+    return (
+        jsonify(
+            {
+                "total": len(positions),
+                "image_ids": [image_id.to_url_id() for image_id in image_ids],
+                "next": (
+                    encode_cursor(filter, stop, version)
+                    if stop < len(positions)
+                    else None
+                ),
+            }
+        ),
+        200,
+    )
@@ -0,0 +1,38 @@
+"""celery tasks for the api"""
+from __future__ import annotations
+
+from typing import Optional
+
+from celery import Task
+from flask import current_app
+from flask import g
+
+from pavo.api.utils import ingest_annotation_predictions
+from pavo.extensions import TaskState
+from pavo.extensions import celery
+from pavo.ingest import IngestSpool
+
+
+@celery.task(bind=True)
+def ingest_predictions_task(
+    self: Task, job_id: str, dataset_name: Optional[str] = None
+) -> dict:
+    """ingest a spooled ndjson prediction job into the prediction logs"""
+    spool = IngestSpool.from_cache_path(current_app.config.get("CACHE_PATH"))
+    if spool is None:
+        raise RuntimeError("queued prediction ingest requires a local CACHE_PATH")
+    if dataset_name is not None:
+        g.pavo_dataset = dataset_name
+
+    def _progress(num_records: int, num_inserted: int) -> None:
+        self.update_state(
+            state=TaskState.PROGRESS,
+            meta={"num_records": num_records, "num_inserted": num_inserted},
+        )
+
+    try:
+        with open(spool.path(job_id), "rb") as f:
+            result = ingest_annotation_predictions(f, queued=True, progress=_progress)
+    finally:
+        spool.discard(job_id)
+    return result.to_json()
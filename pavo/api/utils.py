@@ -1,16 +1,28 @@
 from __future__ import annotations
 
+import base64
+import hashlib
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Callable
+from typing import Iterable
 from typing import List
-from typing import Set
+from typing import NamedTuple
 
+import numpy as np
+import orjson
 from pado.annotations import Annotation
 from pado.images import ImageId
 
 from pavo._types import EndpointResponse
 from pavo.data import DatasetProxy
 from pavo.data import dataset
-from pavo.metadata.utils import get_valid_metadata_attribute_options
-from pavo.metadata.utils import get_valid_metadata_attributes
+from pavo.filters import ImageFilterIndex
+from pavo.filters import query_mask
+from pavo.filters import query_uses_records
+
+if TYPE_CHECKING:
+    from pavo.tabular import TabularRecordsIndex
 
 
 # --- filtering ---------------------------------------------------------------
@@ -19,81 +31,314 @@ class InvalidFilterParameters(Exception):
 
 
 def get_filtered_image_ids(filter: dict, ds: DatasetProxy = dataset) -> List[ImageId]:
-    """returns tuple of all ImageIds which match the given filter"""
+    """returns all ImageIds which match the given filter"""
+    filter_index = ds.filter_index
+    positions = get_filtered_positions(
+        filter, filter_index, records=ds.get_tabular_records_index, version=ds.version
+    )
+    return filter_index.image_ids_at(positions)
+
+
+def get_filtered_positions(
+    filter: dict,
+    filter_index: ImageFilterIndex,
+    records: Callable[[], TabularRecordsIndex] | None = None,
+    version: str = "",
+) -> np.ndarray:
+    """returns the ordered filter index positions of the images matching the filter
 
-    filtered_ids = set(ds.index)
+    The filter supports the keys "filename", "metadata_key" and
+    "metadata_values", a filter "query" (see pavo.filters.query_mask) as
+    a json object or str, and the "order" of the result.
 
+    The result is cached per filter on the index of the dataset snapshot,
+    so that all pages of a result are slices of the same array. The index
+    is shared by the snapshots of annotation writes, so the results of
+    queries on the tabular records are cached per snapshot version.
+    """
     filename: str = filter.get("filename", None)
     metadata_key: str = filter.get("metadata_key", None)
     metadata_values: List[str] = filter.get("metadata_values", None)
     if metadata_values and not isinstance(metadata_values, list):
         metadata_values = [metadata_values]
+    query = _unpack_query(filter)
+    order: str = filter.get("order", None) or "index"
+
+    def _filter() -> np.ndarray:
+        positions = []
+        try:
+            if filename:
+                positions.append(filter_by_filename(filename, filter_index))
+            if metadata_key or metadata_values:
+                if metadata_key and metadata_values:
+                    positions.append(
+                        filter_by_metadata(metadata_key, metadata_values, filter_index)
+                    )
+                else:
+                    raise InvalidFilterParameters(
+                        "Must specify a metadata_key and metadata_value."
+                    )
+            if query:
+                mask = query_mask(query, filter_index, records)
+                positions.append(np.flatnonzero(mask))
+            if not positions:
+                return filter_index.sort(filter_index.all(), order)
+            return filter_index.sort(filter_index.intersect(*positions), order)
+        except Exception as e:
+            raise InvalidFilterParameters(f"{e}")
+
+    if not query_uses_records(query):
+        version = ""  # the result doesn't depend on the annotations
+    key = _filter_key(filename, metadata_key, metadata_values, query, order, version)
+    return filter_index.cached(key, _filter)
+
+
+def _unpack_query(filter: dict) -> Any:
+    query = filter.get("query", None)
+    if isinstance(query, str):
+        try:
+            query = orjson.loads(query) if query else None
+        except orjson.JSONDecodeError as e:
+            raise InvalidFilterParameters(f"query is not valid json: {e}")
+    return query
+
+
+def _filter_key(*args: Any) -> bytes:
+    return orjson.dumps(args, option=orjson.OPT_SORT_KEYS)
+
+
+def encode_cursor(filter: dict, offset: int, version: str) -> str:
+    """return an opaque cursor pointing at offset in the filter result
+
+    version is the dataset version of the result, offsets into the result
+    of another version are meaningless.
+    """
+    digest = _cursor_digest(filter)
+    data = orjson.dumps([digest, version, offset])
+    return base64.urlsafe_b64encode(data).rstrip(b"=").decode()
 
-    # TODO: for efficiency, combine filters without needing set<->list conversions
+
+def decode_cursor(cursor: str, filter: dict, version: str) -> int:
+    """return the offset of a cursor of the filter result of version"""
     try:
-        if filename:
-            filtered_ids = filtered_ids & filter_by_filename(filename, ds)
-        if metadata_key or metadata_values:
-            if metadata_key and metadata_values:
-                filtered_ids = filtered_ids & filter_by_metadata(
-                    metadata_key, metadata_values
-                )
-            else:
-                raise InvalidFilterParameters(
-                    "Must specify a metadata_key and metadata_value."
-                )
-    except Exception as e:
-        raise InvalidFilterParameters(f"{e}")
+        data = base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4))
+        digest, cursor_version, offset = orjson.loads(data)
+    except (ValueError, TypeError, orjson.JSONDecodeError):
+        raise InvalidFilterParameters("invalid cursor")
+    if digest != _cursor_digest(filter) or not isinstance(offset, int) or offset < 0:
+        raise InvalidFilterParameters("cursor does not match the filter")
+    if cursor_version != version:
+        raise InvalidFilterParameters("cursor expired, the dataset changed")
+    return offset
+
 
-    return list(filtered_ids)
+def _cursor_digest(filter: dict) -> str:
+    """a short digest of the filter a cursor belongs to"""
+    keys = ("filename", "metadata_key", "metadata_values", "order")
+    data = _filter_key(*(filter.get(k) for k in keys), _unpack_query(filter))
+    return hashlib.sha256(data).hexdigest()[:12]
+
+
+def get_records_filters(
+    records_filter: dict | None, filter: dict, ds: DatasetProxy = dataset
+) -> dict | None:
+    """combine a tabular records filter with an image filter of the slides api"""
+    if not any(filter.values()):
+        return records_filter
+    records_filter = dict(records_filter or {})
+
+    filter_index = ds.filter_index
+    positions = get_filtered_positions(
+        filter, filter_index, records=ds.get_tabular_records_index, version=ds.version
+    )
+    image_ids = filter_index.registry.strs[positions].tolist()
+    accepted = records_filter.get("image_id")
+    if accepted is not None:
+        if not isinstance(accepted, list):
+            accepted = [accepted]
+        image_ids = list(set(image_ids).intersection(accepted))
+    records_filter["image_id"] = image_ids
+    return records_filter
 
 
 # --- filter by helpers -------------------------------------------------------
-def filter_by_filename(filename: str, ds: DatasetProxy = dataset) -> Set[ImageId]:
-    return {id for id in ds.index if id.last == filename}
+def filter_by_filename(filename: str, filter_index: ImageFilterIndex) -> np.ndarray:
+    return filter_index.filename(filename)
 
 
 def filter_by_metadata(
-    metadata_key: str, metadata_values: List[str], ds: DatasetProxy = dataset
-) -> Set[ImageId]:
-    try:
-        assert (
-            metadata_key in get_valid_metadata_attributes()
-        ), "Invalid metadata attribute."
-        valid_options = get_valid_metadata_attribute_options(metadata_key)
-        for idx, metadata_value in enumerate(metadata_values):
-            assert metadata_values[idx] in valid_options, (
-                f"{metadata_values[idx]} of type {type(metadata_value[idx])} "
+    metadata_key: str, metadata_values: List[str], filter_index: ImageFilterIndex
+) -> np.ndarray:
+    if metadata_key not in filter_index.metadata_keys:
+        raise InvalidFilterParameters("Invalid metadata attribute.")
+    for metadata_value in metadata_values:
+        if not filter_index.has_metadata_value(metadata_key, metadata_value):
+            raise InvalidFilterParameters(
+                f"{metadata_value} of type {type(metadata_value).__name__} "
                 "is an invalid metadata attribute value."
             )
-    except AssertionError as e:
-        raise AssertionError(e)
-
-    image_id_strings = ds.metadata.df[
-        ds.metadata.df[metadata_key].isin(metadata_values)
-    ].index.unique()
-    return {ImageId.from_str(id) for id in image_id_strings}
+    return filter_index.metadata(metadata_key, metadata_values)
 
 
 # ---- prediction api helper functions ----------------------------------------
+# number of ndjson records validated and written together
+INGEST_BATCH_SIZE = 10_000
+# at most this many per-record errors are reported
+INGEST_MAX_ERRORS = 1_000
+
+
+class InvalidPredictionRecord(Exception):
+    pass
+
+
+class IngestResult(NamedTuple):
+    """the outcome of an annotation prediction ingest"""
+
+    num_records: int
+    num_inserted: int
+    image_ids: set[ImageId]
+    num_errors: int
+    errors: list[dict[str, Any]]  # {"line": int, "error": str}
+
+    def to_json(self) -> dict[str, Any]:
+        return {
+            "num_records": self.num_records,
+            "num_inserted": self.num_inserted,
+            "num_images": len(self.image_ids),
+            "num_errors": self.num_errors,
+            "errors": self.errors,
+        }
+
+
+def validate_annotation_prediction(
+    prediction_record: Any, image_id: ImageId
+) -> dict[str, Any]:
+    """return the annotation record of a prediction, raises InvalidPredictionRecord"""
+    if not isinstance(prediction_record, dict):
+        raise InvalidPredictionRecord("prediction must be an object")
+    annotator = prediction_record.get("annotator")
+    if not isinstance(annotator, dict) or annotator.get("type") != "model":
+        raise InvalidPredictionRecord('Annotator type for predictions must be "model"')
+    try:
+        return Annotation.from_obj(prediction_record).to_record(image_id)
+    except Exception as e:  # pydantic and shapely errors
+        raise InvalidPredictionRecord(f"invalid annotation: {e}")
+
+
 def insert_annotation_prediction(
     prediction_record: dict, image_id: ImageId
 ) -> EndpointResponse:
     """inserts an annotation style prediction into an image's list of annotations"""
+    try:
+        record = validate_annotation_prediction(prediction_record, image_id)
+    except InvalidPredictionRecord as e:
+        return str(e), 400
 
-    if prediction_record["annotator"]["type"] != "model":
-        return 'Annotator type for predictions must be "model"', 400
-
+    if image_id not in dataset.registry:
+        return f"unknown image_id {image_id.to_str()!r}", 404
     try:
-        dataset.annotations[image_id].insert(
-            index=0, value=Annotation.from_obj(prediction_record)
-        )
+        dataset.insert_annotations({image_id: [record]})
     except Exception as e:
         return f"Could not insert prediction for {image_id} due to {e}", 500
 
     return "", 200
 
 
+def ingest_annotation_predictions(
+    lines: Iterable[bytes],
+    *,
+    batch_size: int = INGEST_BATCH_SIZE,
+    max_errors: int = INGEST_MAX_ERRORS,
+    queued: bool = False,
+    progress: Callable[[int, int], None] | None = None,
+) -> IngestResult:
+    """insert ndjson annotation predictions of many images
+
+    Each line is a json object with the "image_id" (url id) and the
+    "prediction_type" and "prediction" of a manage_predictions request.
+    Records are validated in batches, the valid records of a batch are
+    grouped by image and each image is written once per batch. Invalid
+    records are reported by line number and are skipped.
+
+    With queued, each batch is appended to the prediction logs instead of
+    the annotations of this process (see pavo.ingest). progress is
+    called with the number of records and inserted records per batch.
+    """
+    registry = dataset.registry
+    num_records = num_inserted = num_errors = 0
+    errors: list[dict[str, Any]] = []
+    image_ids: set[ImageId] = set()
+
+    def _error(lineno: int, msg: str) -> None:
+        nonlocal num_errors
+        num_errors += 1
+        if len(errors) < max_errors:
+            errors.append({"line": lineno, "error": msg})
+
+    def _write(batch: dict[ImageId, list[tuple[int, dict[str, Any]]]]) -> None:
+        nonlocal num_inserted
+        if batch:
+            records = {iid: [r for _, r in items] for iid, items in batch.items()}
+            try:
+                if queued:
+                    dataset.log_annotations(records)
+                else:
+                    dataset.insert_annotations(records)
+            except Exception as e:
+                for items in batch.values():
+                    for lineno, _ in items:
+                        _error(lineno, f"could not insert prediction: {e}")
+            else:
+                num_inserted += sum(map(len, batch.values()))
+                image_ids.update(batch)
+        batch.clear()
+        if progress is not None:
+            progress(num_records, num_inserted)
+
+    batch: dict[ImageId, list[tuple[int, dict[str, Any]]]] = {}
+    batch_records = 0
+    for lineno, line in enumerate(lines, start=1):
+        if not line.strip():
+            continue
+        num_records += 1
+        try:
+            obj = orjson.loads(line)
+            if not isinstance(obj, dict):
+                raise InvalidPredictionRecord("record must be an object")
+            url_id = obj.get("image_id")
+            handle = None
+            if isinstance(url_id, str):
+                handle = registry.handle_from_url_id(url_id)
+            if handle is None:
+                raise InvalidPredictionRecord(f"unknown image_id {url_id!r}")
+            prediction_type = obj.get("prediction_type", "annotation")
+            if prediction_type != "annotation":
+                raise InvalidPredictionRecord(
+                    f'Prediction type "{prediction_type}" is not supported.'
+                )
+            (image_id,) = registry.image_ids_at([handle])
+            record = validate_annotation_prediction(obj.get("prediction"), image_id)
+        except orjson.JSONDecodeError as e:
+            _error(lineno, f"invalid json: {e}")
+        except InvalidPredictionRecord as e:
+            _error(lineno, str(e))
+        else:
+            batch.setdefault(image_id, []).append((lineno, record))
+            batch_records += 1
+            if batch_records >= batch_size:
+                _write(batch)
+                batch_records = 0
+    _write(batch)
+
+    return IngestResult(
+        num_records=num_records,
+        num_inserted=num_inserted,
+        image_ids=image_ids,
+        num_errors=num_errors,
+        errors=errors,
+    )
+
+
 def insert_image_prediction() -> EndpointResponse:
     # TODO: upload a large image style prediction here
     return "not implemented", 200
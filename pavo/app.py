@@ -9,6 +9,7 @@ from typing import Optional
 
 from flask import Flask
 from flask import Response
+from flask import abort
 from flask import g
 
 __all__ = ["create_app"]
@@ -19,6 +20,7 @@ def create_app(
     configured_app: Optional[Flask] = None,
     is_worker: bool = False,
     config_only: bool = False,
+    background: Optional[bool] = None,
 ) -> Flask:
     """create a Flask app instance
 
@@ -31,6 +33,9 @@ def create_app(
         allows to skip blueprint definitions
     config_only:
         return the app directly after configuring
+    background:
+        start the dataset warmup and refresh watcher threads, defaults to
+        only starting them in the web server (not is_worker)
 
     """
     configure_logging()
@@ -51,7 +56,9 @@ def create_app(
     from pavo.data import initialize_dataset
     from pavo.extensions import register_extensions
 
-    initialize_dataset(app)
+    if background is None:
+        background = not is_worker
+    initialize_dataset(app, background=background)
 
     register_extensions(app, is_worker=is_worker)
     register_blueprints(app, is_worker=is_worker)
@@ -89,6 +96,7 @@ def register_blueprints(app: Flask, *, is_worker: bool = True) -> None:
 
     if is_worker:
         # register the worker tasks
+        import pavo.api.tasks  # noqa: F401
         import pavo.home.tasks  # noqa: F401
         import pavo.slides.tasks  # noqa: F401
 
@@ -108,6 +116,18 @@ def register_blueprints(app: Flask, *, is_worker: bool = True) -> None:
 
     app.register_blueprint(api_blueprint, url_prefix="/api")
 
+    # --- dataset scoped views ---
+    for bp, prefix in [
+        (metadata_blueprint, "/metadata"),
+        (slides_blueprint, "/slides"),
+        (api_blueprint, "/api"),
+    ]:
+        app.register_blueprint(
+            bp,
+            url_prefix=f"/datasets/<dataset_name>{prefix}",
+            name=f"datasets_{bp.name}",
+        )
+
     # --- plugins ---
     ...  # todo...
 
@@ -117,11 +137,32 @@ def register_decorators(app: Flask, *, is_worker: bool = True) -> None:
     if is_worker:
         return
 
+    from pavo.data import dataset
+
+    @app.url_value_preprocessor
+    def pull_dataset_name(endpoint: str | None, values: dict | None) -> None:
+        if values and "dataset_name" in values:
+            g.pavo_dataset = values.pop("dataset_name")
+
+    @app.url_defaults
+    def add_dataset_name(endpoint: str, values: dict) -> None:
+        name = g.get("pavo_dataset")
+        if name is not None and app.url_map.is_endpoint_expecting(
+            endpoint, "dataset_name"
+        ):
+            values.setdefault("dataset_name", name)
+
     @app.before_request
     def calculate_timing() -> None:
         t0 = time.monotonic()
         g.get_request_duration = lambda: time.monotonic() - t0
 
+    @app.before_request
+    def check_dataset_name() -> None:
+        name = g.get("pavo_dataset")
+        if name is not None and name not in dataset.entries:
+            abort(404, f"unknown dataset {name!r}")
+
     @app.after_request
     def set_timing_header(response: Response) -> Response:
         response.headers["x-pado-request-duration"] = g.get_request_duration()
@@ -2,21 +2,49 @@ from __future__ import annotations
 
 import concurrent.futures
 import os
+from typing import BinaryIO
 from typing import NoReturn
 
 import click
+import orjson
 import redis
+from flask import Flask
 from flask import current_app
 from flask.cli import FlaskGroup
 from flask.cli import with_appcontext
+from pado.images import ImageId
 from tqdm import tqdm
 
+from pavo.api.utils import InvalidFilterParameters
+from pavo.api.utils import get_records_filters
 from pavo.app import create_app
 from pavo.data import dataset
+from pavo.slides.cache import AnnotationTileCache
+from pavo.slides.utils import get_annotation_tile
 from pavo.slides.utils import thumbnail_image
+from pavo.slides.views import annotation_tile_grid
+from pavo.tabular import EXPORT_BATCH_SIZE
+from pavo.tabular import EXPORT_FORMATS
+from pavo.utils import check_numeric_list
 
 
-@click.group(cls=FlaskGroup, create_app=create_app)
+def create_cli_app() -> Flask:
+    """create the app for the commandline interface
+
+    The dataset warmup and refresh watcher threads are opt-in for commands:
+    they only start if PAVO_DATASET_WARMUP is set and enabled.
+    """
+    from pavo.config import initialize_config
+
+    app = Flask("pavo")
+    _ = initialize_config(app)
+    background = "PAVO_DATASET_WARMUP" in os.environ and bool(
+        app.config.get("DATASET_WARMUP", False)
+    )
+    return create_app(configured_app=app, background=background)
+
+
+@click.group(cls=FlaskGroup, create_app=create_cli_app)
 def cli() -> None:
     """pavo's commandline interface"""
 
@@ -68,6 +96,122 @@ def create_thumbnails(threads: int) -> None:
             f.result()
 
 
+@cli.command()
+@click.argument("output", type=click.File("wb"))
+@click.option(
+    "--format",
+    "fmt",
+    type=click.Choice(sorted(EXPORT_FORMATS)),
+    default=None,
+    help="export format, defaults to the output file extension",
+)
+@click.option("--columns", default=None, help="comma separated columns")
+@click.option("--filter", "records_filter", default=None, help="json records filter")
+@click.option("--filename", default=None)
+@click.option("--metadata-key", default=None)
+@click.option("--metadata-value", "metadata_values", multiple=True)
+@click.option("--batch-size", default=EXPORT_BATCH_SIZE, type=int, show_default=True)
+@with_appcontext
+def export_records(
+    output: BinaryIO,
+    fmt: str | None,
+    columns: str | None,
+    records_filter: str | None,
+    filename: str | None,
+    metadata_key: str | None,
+    metadata_values: tuple[str, ...],
+    batch_size: int,
+) -> None:
+    """export the tabular records as arrow ipc, parquet or csv"""
+    if fmt is None:
+        _, ext = os.path.splitext(output.name)
+        fmt = {".arrow": "arrow", ".arrows": "arrow"}.get(ext, ext[1:])
+        if fmt not in EXPORT_FORMATS:
+            raise click.UsageError("can't infer the export format, use --format")
+
+    image_filter = {
+        "filename": filename,
+        "metadata_key": metadata_key,
+        "metadata_values": check_numeric_list(list(metadata_values)),
+    }
+    try:
+        filters = get_records_filters(
+            orjson.loads(records_filter) if records_filter else None, image_filter
+        )
+        chunks = dataset.get_tabular_records_index().export(
+            fmt,
+            filters=filters,
+            columns=columns.split(",") if columns else None,
+            batch_size=batch_size,
+        )
+        for chunk in chunks:
+            output.write(chunk)
+    except (orjson.JSONDecodeError, InvalidFilterParameters, ValueError) as err:
+        raise click.ClickException(str(err))
+
+
+@cli.command()
+@click.option(
+    "--image-id",
+    "image_ids",
+    multiple=True,
+    help="image id str, defaults to all images with annotations",
+)
+@click.option("--min-level", default=8, type=int, show_default=True)
+@click.option("--max-level", default=None, type=int, help="defaults to full resolution")
+@click.option("--threads", default=6, type=int, show_default=True)
+@with_appcontext
+def create_annotation_tiles(
+    image_ids: tuple[str, ...],
+    min_level: int,
+    max_level: int | None,
+    threads: int,
+) -> None:
+    """precompute the annotation vector tiles in the CACHE_PATH"""
+    tile_cache = AnnotationTileCache.from_cache_path(current_app.config["CACHE_PATH"])
+    if tile_cache is None:
+        raise click.ClickException("annotation tiles require a local CACHE_PATH")
+    snapshot = dataset.snapshot
+    if image_ids:
+        ids = [ImageId.from_str(i) for i in image_ids]
+    else:
+        ids = [i for i in snapshot.index if i in snapshot.annotations]
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=threads) as executor:
+        futures = []
+        for image_id in tqdm(ids, desc="dispatch"):
+            try:
+                grid = annotation_tile_grid(image_id)
+                bounds = snapshot.annotation_indexes[image_id].total_bounds
+            except (KeyError, FileNotFoundError) as err:
+                tqdm.write(f"skipping {image_id!r}: {err!r}")
+                continue
+            if bounds is None:
+                continue
+            top = (
+                grid.max_level if max_level is None else min(max_level, grid.max_level)
+            )
+            for level in range(max(min_level, 0), top + 1):
+                # only the tiles that intersect the annotations
+                for col, row in grid.tiles_in(level, bounds):
+                    futures.append(
+                        executor.submit(
+                            get_annotation_tile,
+                            snapshot,
+                            image_id,
+                            level,
+                            col,
+                            row,
+                            grid,
+                            tile_cache=tile_cache,
+                        )
+                    )
+        for f in tqdm(
+            concurrent.futures.as_completed(futures), desc="tiles", total=len(futures)
+        ):
+            f.result()
+
+
 @cli.command()
 @click.option("--image-id", type=str)
 @click.option("--output", default=None, type=str)
@@ -1,54 +1,107 @@
 """pavo.data provides access to pado datasets"""
 from __future__ import annotations
 
-import json
+import hashlib
+import logging
 import os
+import re
 import tempfile
-import warnings
+import threading
+import time
 from datetime import datetime
 from datetime import timezone
 from enum import Enum
 from enum import auto
 from functools import wraps
-from operator import itemgetter
 from typing import Any
 from typing import Callable
+from typing import Collection
 from typing import Generic
+from typing import Mapping
+from typing import NamedTuple
 from typing import NoReturn
-from typing import Optional
 from typing import Sequence
 from typing import TypeVar
 
 import pandas as pd
 from flask import Flask
+from flask import g
+from flask import has_app_context
 from fsspec.implementations.cached import SimpleCacheFileSystem
-from itsdangerous import base64_encode
 from pado import PadoDataset
 from pado.annotations import AnnotationProvider
+from pado.annotations import GroupedAnnotationProvider
 from pado.images import ImageId
 from pado.images import ImageProvider
+from pado.images.providers import GroupedImageProvider
 from pado.images.providers import LocallyCachedImageProvider
-from pado.io.paths import search_dataset
+from pado.io.files import urlpathlike_to_string
+from pado.metadata import GroupedMetadataProvider
 from pado.metadata import MetadataProvider
+from pado.predictions.providers import GroupedImagePredictionProvider
+from pado.predictions.providers import GroupedMetadataPredictionProvider
+from pado.predictions.providers import ImagePredictionProvider
+from pado.predictions.providers import MetadataPredictionProvider
 from pado.predictions.proxy import PredictionProxy
-from pandas import DataFrame
 
 from pavo._types import ConfigMetadataExtraColumn
+from pavo.filters import ImageFilterIndex
+from pavo.ingest import AnnotationOverlay
+from pavo.ingest import PredictionLog
+from pavo.ingest import PredictionLogCompacted
+from pavo.ingest import insert_annotation_records
+from pavo.ingest import records_digest
+from pavo.registry import ImageIdRegistry
+from pavo.spatial import AnnotationIndexes
+from pavo.spatial import AnnotationSummaryIndex
+from pavo.tabular import TabularRecords
+from pavo.tabular import TabularRecordsEngine
+from pavo.tabular import TabularRecordsIndex
+from pavo.tabular import TabularRecordsStore
+from pavo.tissue import TissueAreaService
 
 __all__ = [
     "dataset",
+    "DatasetEntry",
     "DatasetNotReadyException",
     "DatasetProxy",  # only used for typing...
+    "DatasetSnapshot",
+    "GroupedSnapshot",
     "DatasetState",
     "initialize_dataset",
 ]
 
 RT = TypeVar("RT")
 
+_logger = logging.getLogger("pavo.data.dataset")
+
+
+def _build_once(instance: object, name: str, func: Callable[[], RT]) -> RT:
+    """compute an attribute of instance once, concurrent callers wait for it"""
+    cache = instance.__dict__
+    try:
+        return cache[name]
+    except KeyError:
+        pass  # cache miss
+    # dict.setdefault is atomic, so all callers end up with the same lock
+    locks = cache.setdefault("_build_once_locks", {})
+    with locks.setdefault(name, threading.Lock()):
+        try:
+            return cache[name]
+        except KeyError:
+            val = cache[name] = func()
+            return val
+
+
+def _reset_build_once_locks(instance: object) -> None:
+    """drop the build locks of instance, threads lost in a fork might hold them"""
+    instance.__dict__.pop("_build_once_locks", None)
+
 
 # noinspection PyPep8Naming
-class lockless_cached_property(Generic[RT]):
-    # https://bugs.python.org/issue43468
+class build_once_property(Generic[RT]):
+    """a cached property that is computed only once under concurrent access"""
+
     def __init__(self, func: Callable[..., RT]) -> None:
         self.func = func
         self.__doc__ = func.__doc__
@@ -56,8 +109,7 @@ class lockless_cached_property(Generic[RT]):
     def __get__(self, instance: object, cls: type | None = None) -> RT:
         if instance is None:
             return self  # type: ignore
-        val = instance.__dict__[self.func.__name__] = self.func(instance)
-        return val
+        return _build_once(instance, self.func.__name__, lambda: self.func(instance))
 
 
 def _parse_extra_columns(value: Any) -> list[ConfigMetadataExtraColumn]:
@@ -93,118 +145,665 @@ def _parse_extra_columns(value: Any) -> list[ConfigMetadataExtraColumn]:
     return out
 
 
-# noinspection PyMethodMayBeStatic
-class _Normalize:
-    """normization of metadata"""
+class DatasetState(Enum):
+    """indicates current state of the loaded proxy"""
 
-    def column_names_inplace(self, mdf: DataFrame) -> None:
-        mdf.rename(
-            columns={
-                "finding_type": "classification",
-            },
-            inplace=True,
-        )
+    NOT_CONFIGURED = auto()
+    READY = auto()
+
+
+class DatasetNotReadyException(Exception):
+    def __init__(self, state: DatasetState):
+        super().__init__(state)
+        self.state: DatasetState = state
+
+
+class DatasetSnapshot:
+    """an immutable view of one version of the pado dataset
+
+    Requests read the current snapshot without locks. A refresh or an
+    annotation write never mutates a snapshot, it publishes a new one.
+    After a refresh it comes with empty caches, after a write it shares
+    the caches that don't depend on the annotations.
+    """
+
+    def __init__(
+        self,
+        ds: PadoDataset,
+        *,
+        refreshed: float,
+        modified: datetime | None = None,
+        cache_path: str | None = None,
+        annotations: AnnotationProvider | None = None,
+        log_position: int = 0,
+        writes_digest: str = "",
+    ) -> None:
+        self.ds = ds
+        self.refreshed = refreshed  # mtime of the refresh file at creation
+        self.modified = modified
+        # the prediction log position of the last replay that wrote annotations
+        self.log_position = log_position
+        # a digest of the in-memory annotation writes since the refresh
+        self.writes_digest = writes_digest
+        self._cache_path = cache_path
+        if annotations is not None:
+            self.__dict__["annotations"] = annotations
+
+    @build_once_property
+    def index(self) -> Sequence[ImageId]:
+        return list(self.ds.index)
+
+    @build_once_property
+    def metadata(self) -> MetadataProvider:
+        return self.ds.metadata
 
-    def annotator_name(self, x: str) -> str:
-        """take care of legacy names"""
-        if x.lower().startswith("tg"):
-            return f"TG-{x[2:].title()}"
-        elif x.startswith("ai"):
-            return f"AI{x[2:]}"
-        elif len(x) <= 2:
-            return x.upper()
+    @build_once_property
+    def images(self) -> ImageProvider:
+        if self._cache_path is None:
+            return self.ds.images
         else:
-            return x
-
-    def model_name(self, x: dict) -> str:
-        """construct a compatible model name"""
-        v = x.get("iteration", "0.0.0")
-        m = x.get("model", "unknown")
-        if v == "v0":
-            return m
+            return LocallyCachedImageProvider(
+                self.ds.images,
+                cache_cls=SimpleCacheFileSystem,
+                cache_storage=self._cache_path,
+            )
+
+    @build_once_property
+    def annotations(self) -> AnnotationProvider:
+        return self.ds.annotations
+
+    @build_once_property
+    def predictions(self) -> PredictionProxy:
+        return self.ds.predictions
+
+    @build_once_property
+    def description(self) -> dict[str, Any]:
+        return self.ds.describe(output_format="json")  # type: ignore
+
+    @build_once_property
+    def version(self) -> str:
+        """a short identifier of the dataset version of this snapshot
+
+        The version only depends on state shared by all processes on the
+        host, so that they can share the caches keyed by it.
+        """
+        if not (self.log_position or self.writes_digest):
+            return self.base_version
+        key = f"{self._base_key()}\n{self.log_position}\n{self.writes_digest}"
+        return hashlib.sha256(key.encode()).hexdigest()[:16]
+
+    @build_once_property
+    def base_version(self) -> str:
+        """the version of the opened dataset, without the annotation writes
+
+        The prediction log is scoped to it, see pavo.ingest.PredictionLog.
+        """
+        return hashlib.sha256(self._base_key().encode()).hexdigest()[:16]
+
+    def _base_key(self) -> str:
+        modified = self.modified.isoformat() if self.modified else repr(self.refreshed)
+        urlpath = urlpathlike_to_string(self.ds.urlpath)
+        return f"{urlpath}\n{modified}"
+
+    @build_once_property
+    def registry(self) -> ImageIdRegistry:
+        return ImageIdRegistry(self.index)
+
+    @build_once_property
+    def filter_index(self) -> ImageFilterIndex:
+        return ImageFilterIndex(self.registry, self.metadata.df)
+
+    @build_once_property
+    def annotation_indexes(self) -> AnnotationIndexes:
+        return AnnotationIndexes(self.annotations)
+
+    @build_once_property
+    def annotation_summaries(self) -> AnnotationSummaryIndex:
+        return AnnotationSummaryIndex.from_annotations(self.annotations.df)
+
+    def build_once(self, name: str, func: Callable[[], RT]) -> RT:
+        """cache the result of func on this snapshot, computing it only once"""
+        return _build_once(self, name, func)
+
+    def with_annotations(
+        self,
+        annotations: AnnotationProvider,
+        image_ids: Collection[ImageId],
+        *,
+        log_position: int | None = None,
+        writes_digest: str | None = None,
+    ) -> DatasetSnapshot:
+        """a new snapshot with the annotations of image_ids written"""
+        snapshot = DatasetSnapshot(
+            self.ds,
+            refreshed=self.refreshed,
+            modified=self.modified,
+            cache_path=self._cache_path,
+            annotations=annotations,
+            log_position=self.log_position if log_position is None else log_position,
+            writes_digest=self.writes_digest
+            if writes_digest is None
+            else writes_digest,
+        )
+        cache = self.__dict__
+        for name in _ANNOTATION_INDEPENDENT_CACHES:
+            if name in cache:
+                snapshot.__dict__[name] = cache[name]
+        indexes = cache.get("annotation_indexes")
+        if indexes is not None:
+            snapshot.__dict__["annotation_indexes"] = indexes.replaced(
+                annotations, image_ids
+            )
+        summaries = cache.get("annotation_summaries")
+        if summaries is not None:
+            # only the geometries of the written images are parsed
+            snapshot.__dict__["annotation_summaries"] = summaries.replaced(
+                {image_id: annotations[image_id].df for image_id in image_ids}
+            )
+        return snapshot
+
+
+# the caches a snapshot shares with the snapshots of its annotation writes
+_ANNOTATION_INDEPENDENT_CACHES = (
+    "index",
+    "metadata",
+    "images",
+    "predictions",
+    "description",
+    "registry",
+    # results of records queries are cached by snapshot version
+    "filter_index",
+)
+
+
+class GroupedPredictions(NamedTuple):
+    """the predictions of several datasets"""
+
+    images: ImagePredictionProvider
+    metadata: MetadataPredictionProvider
+
+
+class GroupedSnapshot:
+    """a combined read-only view of the snapshots of several datasets"""
+
+    def __init__(self, snapshots: Sequence[DatasetSnapshot]) -> None:
+        self.snapshots = tuple(snapshots)
+
+    def matches(self, snapshots: Sequence[DatasetSnapshot]) -> bool:
+        return len(snapshots) == len(self.snapshots) and all(
+            a is b for a, b in zip(snapshots, self.snapshots)
+        )
+
+    @build_once_property
+    def index(self) -> Sequence[ImageId]:
+        index: dict[ImageId, None] = {}
+        for s in self.snapshots:
+            index.update(dict.fromkeys(s.index))
+        return list(index)
+
+    @build_once_property
+    def metadata(self) -> MetadataProvider:
+        return GroupedMetadataProvider(*(s.metadata for s in self.snapshots))
+
+    @build_once_property
+    def images(self) -> ImageProvider:
+        return GroupedImageProvider(*(s.images for s in self.snapshots))
+
+    @build_once_property
+    def annotations(self) -> AnnotationProvider:
+        return GroupedAnnotationProvider(*(s.annotations for s in self.snapshots))
+
+    @build_once_property
+    def predictions(self) -> GroupedPredictions:
+        return GroupedPredictions(
+            images=GroupedImagePredictionProvider(
+                *(s.predictions.images for s in self.snapshots)
+            ),
+            metadata=GroupedMetadataPredictionProvider(
+                *(s.predictions.metadata for s in self.snapshots)
+            ),
+        )
+
+    @build_once_property
+    def version(self) -> str:
+        """a short identifier of the dataset versions of this view"""
+        versions = "\n".join(s.version for s in self.snapshots)
+        return hashlib.sha256(versions.encode()).hexdigest()[:16]
+
+    @build_once_property
+    def registry(self) -> ImageIdRegistry:
+        return ImageIdRegistry(self.index)
+
+    @build_once_property
+    def filter_index(self) -> ImageFilterIndex:
+        return ImageFilterIndex(self.registry, self.metadata.df)
+
+    @build_once_property
+    def annotation_indexes(self) -> AnnotationIndexes:
+        return AnnotationIndexes(self.annotations)
+
+    @build_once_property
+    def annotation_summaries(self) -> AnnotationSummaryIndex:
+        return AnnotationSummaryIndex.concat(
+            [s.annotation_summaries for s in self.snapshots]
+        )
+
+    def build_once(self, name: str, func: Callable[[], RT]) -> RT:
+        """cache the result of func on this view, computing it only once"""
+        return _build_once(self, name, func)
+
+
+class DatasetEntry:
+    """one configured pado dataset
+
+    The dataset is opened on first access and keeps its own snapshot,
+    caches and refresh tracking. Entries that were not accessed for a
+    while can be evicted and will be reopened on demand.
+    """
+
+    def __init__(
+        self,
+        name: str,
+        urlpath: str,
+        *,
+        modified_file: str,
+        cache_path: str | None = None,
+        tabular_store: TabularRecordsStore | None = None,
+        tissue_areas: TissueAreaService | None = None,
+        prediction_log: PredictionLog | None = None,
+        metadata_extra_columns: list[ConfigMetadataExtraColumn] | None = None,
+        metadata_extra_column_mode: str | None = None,
+    ) -> None:
+        self.name = name
+        self.urlpath = urlpath
+        self.last_access = time.monotonic()
+        self._modified_file = modified_file
+        self._cache_path = cache_path
+        self._tabular_store = tabular_store
+        self._tabular_records: TabularRecords | None = None
+        self._tissue_areas = tissue_areas
+        self._prediction_log = prediction_log
+        self._metadata_extra_columns = metadata_extra_columns
+        self._metadata_extra_column_mode = metadata_extra_column_mode
+        self._snapshot: DatasetSnapshot | None = None
+        # publishing a snapshot and writing annotations are serialized
+        self._lock = threading.Lock()
+        # only one thread opens and warms up a refreshed snapshot
+        self._refresh_lock = threading.Lock()
+        # the prediction log position of the current snapshot
+        self._log_position = 0
+        self._log_mtime = 0
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.name!r}, {self.urlpath!r})"
+
+    @property
+    def loaded(self) -> bool:
+        return self._snapshot is not None
+
+    def get_snapshot(self, *, check_refresh: bool = False) -> DatasetSnapshot:
+        """the current snapshot, opening the dataset if necessary"""
+        self.last_access = time.monotonic()
+        snapshot = self._snapshot
+        if snapshot is None:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot is None:
+                    snapshot = self._publish_snapshot(self._refresh_mtime())
+        elif check_refresh:
+            snapshot = self.check_refresh(snapshot)
+        return snapshot
+
+    def get_tabular_records_df(
+        self, snapshot: DatasetSnapshot | None = None
+    ) -> pd.DataFrame:
+        """the tabular records of snapshot, by default the current snapshot"""
+        s = self.get_snapshot() if snapshot is None else snapshot
+        return s.build_once(
+            "_tabular_records_df", lambda: self._build_tabular_records_df(s)
+        )
+
+    def _build_tabular_records_df(self, snapshot: DatasetSnapshot) -> pd.DataFrame:
+        engine = TabularRecordsEngine(
+            extra_columns=[c["name"] for c in self._metadata_extra_columns or []],
+            extra_column_mode=self._metadata_extra_column_mode,
+            tissue_areas=self._tissue_areas,
+        )
+        # partitions of the previous table are reused if they didn't change
+        previous = self._tabular_records
+
+        ds = snapshot.ds
+        # retried tissue masks change the areas without changing the dataset
+        tissue_area = engine.load_tissue_area(ds)
+
+        def _build(previous: TabularRecords | None) -> TabularRecords:
+            # the annotations of the snapshot include the in-memory writes,
+            # their areas are looked up in the summaries by image and row
+            annotations = snapshot.annotations.df
+            return engine.build(
+                ds,
+                previous=previous,
+                annotations=annotations,
+                annotation_areas=snapshot.annotation_summaries.areas_of(annotations),
+                tissue_area=tissue_area,
+            )
+
+        store = self._tabular_store
+        if store is None:
+            records = _build(previous)
         else:
-            return f"{m}-{v}"
+            latest = store.latest
+            fingerprint = store.fingerprint(
+                ds,
+                snapshot.log_position,
+                snapshot.writes_digest,
+                self._metadata_extra_column_mode,
+                self._metadata_extra_columns,
+                engine.tissue_area_digest(tissue_area),
+            )
+            records = store.get_or_build(
+                fingerprint,
+                lambda: _build(previous or latest()),
+            )
+        self._tabular_records = records
+        return records.df
 
+    # --- refreshing ---
 
-# noinspection PyMethodMayBeStatic
-class _Hotfixes:
-    """collection of hot fixes for metadata"""
+    def _refresh_mtime(self) -> float:
+        return os.stat(self._modified_file).st_mtime
 
-    def load_tissue_area(self, ds: PadoDataset) -> pd.Series:
-        """load tissue area from precomputed df"""
-        from geopandas import GeoSeries
+    def check_refresh(
+        self, snapshot: DatasetSnapshot, *, warmup: bool = False
+    ) -> DatasetSnapshot:
+        """publish a new snapshot if a refresh was requested
 
-        try:
-            (of,) = search_dataset(ds, "precomputed.tissue.parquet")
-            with of as f:
-                _t = pd.read_parquet(f)
-                tissue = GeoSeries.from_wkb(_t["tissue"])
-            return tissue.area.groupby(tissue.index).sum()
-        except BaseException:
-            index = ds.index
-            data = []
-            for iid in index:
-                dims = ds.images[iid].dimensions
-                data.append(dims.x * dims.y)
-            return pd.Series(data, index=list(map(str, index)))
-
-    def ensure_area_column(self, df: DataFrame) -> None:
-        """ensure the area column is available in df"""
-        from geopandas import GeoDataFrame
-        from geopandas import GeoSeries
-
-        if "area" not in df.columns:
-            gs = GeoSeries.from_wkt(df["geometry"])
-            geo_adf = GeoDataFrame(df, geometry=gs)
-            df["area"] = geo_adf.geometry.area
+        The new snapshot is opened and warmed up outside of the lock, so
+        that requests and annotation writes keep using the previous
+        snapshot in the meantime.
+        """
+        ts = self._refresh_mtime()
+        if ts <= snapshot.refreshed:
+            return self.apply_prediction_log(snapshot)
+        # only one thread opens the new dataset, the others wait for it
+        with self._refresh_lock:
+            current = self._snapshot
+            if current is not None and ts <= current.refreshed:
+                return current
+            new, position, _ = self._replay_prediction_log(self._open_snapshot(ts), 0)
+            if warmup:
+                self.warmup(new)
+            with self._lock:
+                try:
+                    # catch up with the predictions ingested in the meantime
+                    replayed = self._replay_prediction_log(new, position)
+                except PredictionLogCompacted:
+                    return self._publish_snapshot(ts)
+                new, self._log_position, self._log_mtime = replayed
+                return self._swap_snapshot(new)
+
+    def _open_snapshot(self, refreshed: float) -> DatasetSnapshot:
+        """open the dataset in a new snapshot"""
+        ds = PadoDataset(self.urlpath, mode="r")
+        dt = datetime.utcfromtimestamp(refreshed).replace(tzinfo=timezone.utc)
+        snapshot = DatasetSnapshot(
+            ds,
+            refreshed=refreshed,
+            modified=max([self._last_change(ds), dt]),
+            cache_path=self._cache_path,
+        )
+        if self._prediction_log is not None:
+            # the predictions ingested into the previous versions are dropped
+            self._prediction_log.truncate(snapshot.base_version)
+        return snapshot
 
+    def _publish_snapshot(self, refreshed: float) -> DatasetSnapshot:
+        """open the dataset and atomically replace the current snapshot
 
-class DatasetState(Enum):
-    """indicates current state of the loaded proxy"""
+        The caller must hold the lock.
+        """
+        snapshot = self._open_snapshot(refreshed)
+        # predictions ingested by the workers are not part of the pado dataset
+        snapshot, self._log_position, self._log_mtime = self._replay_prediction_log(
+            snapshot, 0
+        )
+        return self._swap_snapshot(snapshot)
 
-    NOT_CONFIGURED = auto()
-    READY = auto()
+    def _swap_snapshot(self, snapshot: DatasetSnapshot) -> DatasetSnapshot:
+        self._snapshot = snapshot
+        _logger.info(
+            f"published dataset snapshot {self.name!r} modified={snapshot.modified}"
+        )
+        return snapshot
+
+    def insert_annotations(
+        self, batch: Mapping[ImageId, Sequence[dict[str, Any]]]
+    ) -> DatasetSnapshot:
+        """insert annotation records in memory and publish the new snapshot"""
+        with self._lock:
+            snapshot = self._snapshot
+            if snapshot is None:
+                snapshot = self._publish_snapshot(self._refresh_mtime())
+            annotations = AnnotationOverlay(snapshot.annotations)
+            for image_id, records in batch.items():
+                insert_annotation_records(annotations, image_id, records)
+            # identical writes in other processes lead to the same version
+            h = hashlib.sha256(f"{snapshot.writes_digest}\n".encode())
+            h.update(f"{snapshot.log_position}\n".encode())
+            h.update(records_digest(batch).encode())
+            snapshot = snapshot.with_annotations(
+                annotations, batch, writes_digest=h.hexdigest()
+            )
+            self._snapshot = snapshot
+        return snapshot
 
+    def log_annotations(self, batch: Mapping[ImageId, Sequence[dict[str, Any]]]) -> int:
+        """append annotation records to the prediction log of the dataset version
 
-class DatasetNotReadyException(Exception):
-    def __init__(self, state: DatasetState):
-        super().__init__(state)
-        self.state: DatasetState = state
+        Every process serving the dataset replays them into its snapshots.
+        Returns the log position of the batch.
+        """
+        log = self._prediction_log
+        if log is None:
+            raise RuntimeError("the prediction log requires a local CACHE_PATH")
+        snapshot = self.get_snapshot()
+        return log.append(batch, version=snapshot.base_version)
+
+    def apply_prediction_log(self, snapshot: DatasetSnapshot) -> DatasetSnapshot:
+        """publish a new snapshot if predictions were appended to the log"""
+        log = self._prediction_log
+        if log is None or log.mtime(snapshot.base_version) == self._log_mtime:
+            return snapshot
+        with self._lock:
+            current = self._snapshot
+            if current is None:
+                return snapshot  # evicted
+            if log.mtime(current.base_version) == self._log_mtime:
+                return current
+            try:
+                replayed = self._replay_prediction_log(current, self._log_position)
+            except PredictionLogCompacted:
+                # this process fell behind the log retention
+                return self._publish_snapshot(current.refreshed)
+            current, self._log_position, self._log_mtime = replayed
+            self._snapshot = current
+            return current
+
+    def _replay_prediction_log(
+        self, snapshot: DatasetSnapshot, position: int
+    ) -> tuple[DatasetSnapshot, int, int]:
+        """insert the predictions logged after position into snapshot
+
+        Returns the new snapshot, the log position and the log mtime it
+        is up-to-date with.
+        """
+        log = self._prediction_log
+        if log is None:
+            return snapshot, position, 0
+        mtime = log.mtime(snapshot.base_version)
+        annotations = AnnotationOverlay(snapshot.annotations)
+        position, image_ids = log.replay(
+            annotations,
+            snapshot.registry,
+            version=snapshot.base_version,
+            position=position,
+        )
+        # appends within the mtime granularity might share the mtime
+        if time.time_ns() - mtime <= 1_000_000_000:
+            mtime = 0
+        if not image_ids:
+            return snapshot, position, mtime
+        _logger.info(
+            f"replayed predictions of {len(image_ids)} images"
+            f" into dataset snapshot {self.name!r}"
+        )
+        snapshot = snapshot.with_annotations(
+            annotations, image_ids, log_position=position
+        )
+        return snapshot, position, mtime
+
+    def _last_change(self, ds: PadoDataset) -> datetime:
+        # noinspection PyProtectedMember
+        fs, root = ds._fs, ds._root
+        try:
+            return max(
+                x["LastModified"]
+                for x in fs.ls(root, detail=True, refresh=True)
+                if "LastModified" in x
+            )
+        except ValueError:
+            return datetime.fromtimestamp(0, tz=timezone.utc)
+
+    def warmup(self, snapshot: DatasetSnapshot | None = None) -> None:
+        """build the expensive attributes of a snapshot"""
+        t0 = time.monotonic()
+        s = self.get_snapshot() if snapshot is None else snapshot
+        s.index
+        s.metadata
+        s.annotations
+        s.predictions
+        s.description
+        s.filter_index.facet_catalog
+        s.annotation_summaries
+        self.get_tabular_records_df(s)
+        _logger.info(
+            f"warmed up dataset snapshot {self.name!r} in {time.monotonic() - t0:.2f}s"
+        )
+
+    def evict(self) -> None:
+        """drop the snapshot and caches, the dataset is reopened on access"""
+        with self._lock:
+            self._snapshot = None
+            self._tabular_records = None
+        _logger.info(f"evicted idle dataset {self.name!r}")
+
+    def reset_locks_after_fork(self) -> None:
+        """replace the locks that threads of the parent process might hold"""
+        self._lock = threading.Lock()
+        self._refresh_lock = threading.Lock()
+        snapshot = self._snapshot
+        if snapshot is not None:
+            _reset_build_once_locks(snapshot)
+
+
+def _dataset_name(urlpath: str, taken: Collection[str]) -> str:
+    """derive a unique url-safe dataset name from its urlpath"""
+    stem = urlpath.rstrip("/").rsplit("/", 1)[-1]
+    stem = re.sub(r"[^A-Za-z0-9_.-]+", "-", stem).strip("-.") or "dataset"
+    name, idx = stem, 1
+    while name in taken:
+        idx += 1
+        name = f"{stem}-{idx}"
+    return name
 
 
 class DatasetProxy:
-    """a proxy for accessing the pado dataset"""
+    """a proxy for accessing the pado datasets
+
+    All configured datasets are served through a combined view. Requests
+    to the dataset scoped routes ``/datasets/<name>/...`` only see their
+    own dataset.
+    """
 
-    urlpath: Optional[str]
     state: DatasetState
 
     def __init__(self) -> None:
         """default instantiation in not configured state"""
-        self.urlpath = None
         self.state = DatasetState.NOT_CONFIGURED
-        self._ds: Optional[PadoDataset] = None
-        self._cache_path = None
+        self.entries: dict[str, DatasetEntry] = {}
+        self._grouped: GroupedSnapshot | None = None
         self._metadata_extra_column_mode: str | None = None
         self._metadata_extra_columns: list[ConfigMetadataExtraColumn] | None = None
         self._modified_file = os.path.join(tempfile.gettempdir(), ".pavo.timestamp")
-        self._modified_time: datetime | None = None
-
-    def init_app(self, app: Flask) -> None:
-        """initialize the dataset proxy with the Flask app instance"""
+        self._refresh_interval: float = 5.0
+        self._idle_timeout: float = 0.0
+        self._watcher: threading.Thread | None = None
+        self._watcher_wakeup = threading.Event()
+        self._fork_hook_registered = False
+        self._warmup_enabled = True
+        self._background = True
+        self._warm = threading.Event()
+
+    def init_app(self, app: Flask, *, background: bool = True) -> None:
+        """initialize the dataset proxy with the Flask app instance
+
+        background starts the warmup and the refresh watcher threads. Without
+        them, datasets are built and refreshed on access.
+        """
         urlpaths = app.config.get("DATASET_PATHS", [])
-        assert len(urlpaths) <= 1, "todo: support for multiple datasets"
-        self._cache_path = app.config.get("CACHE_IMAGES_PATH", None)
+        cache_path = app.config.get("CACHE_IMAGES_PATH", None)
+        self._refresh_interval = float(app.config.get("DATASET_REFRESH_INTERVAL", 5))
+        self._idle_timeout = float(app.config.get("DATASET_IDLE_TIMEOUT", 0))
+        self._warmup_enabled = bool(app.config.get("DATASET_WARMUP", True))
+        self._background = background
 
         self._metadata_extra_column_mode = app.config.get("METADATA_EXTRA_COLUMN_MODE")
         self._metadata_extra_columns = _parse_extra_columns(
             app.config.get("METADATA_EXTRA_COLUMNS", [])
         )
 
-        self.urlpath = urlpaths[0] if urlpaths else None
-        if self.urlpath:
-            self.trigger_refresh()
-            self._ds = PadoDataset(self.urlpath, mode="r")
+        for urlpath in map(os.fspath, urlpaths):
+            name = _dataset_name(urlpath, self.entries)
+            tabular_store = None
+            if app.config.get("CACHE_TABULAR_RECORDS", True):
+                tabular_store = TabularRecordsStore.from_cache_path(
+                    app.config.get("CACHE_PATH"), urlpath
+                )
+            self.entries[name] = DatasetEntry(
+                name,
+                urlpath,
+                modified_file=self._modified_file,
+                cache_path=cache_path,
+                tabular_store=tabular_store,
+                tissue_areas=TissueAreaService.from_cache_path(
+                    app.config.get("CACHE_PATH"),
+                    urlpath,
+                    max_workers=int(app.config.get("TISSUE_AREA_WORKERS", 8)),
+                    use_masks=bool(app.config.get("TISSUE_AREA_MASKS", True)),
+                ),
+                prediction_log=PredictionLog.from_cache_path(
+                    app.config.get("CACHE_PATH"), urlpath
+                ),
+                metadata_extra_columns=self._metadata_extra_columns,
+                metadata_extra_column_mode=self._metadata_extra_column_mode,
+            )
+
+        if self.entries:
+            # datasets are opened on first access or by the warmup thread.
+            # don't touch an existing refresh file: it would make all other
+            # workers reload their datasets whenever a worker starts.
+            if not os.path.exists(self._modified_file):
+                self.trigger_refresh()
             self.state = DatasetState.READY
+            if not self._fork_hook_registered and hasattr(os, "register_at_fork"):
+                # threads don't survive a fork, e.g. in prefork celery workers
+                os.register_at_fork(after_in_child=self._restart_after_fork)
+                self._fork_hook_registered = True
+            if not background:
+                self._warm.set()
+                return
+            self._start_warmup()
+            self._start_watcher()
 
     def requires_state(
         self,
@@ -232,49 +831,128 @@ class DatasetProxy:
 
         return decorator
 
-    def get_ds(self) -> PadoDataset:
+    # --- scoping ---
+
+    @property
+    def scope(self) -> list[DatasetEntry]:
+        """the dataset entries visible to the current request"""
         if self.state != DatasetState.READY:
             raise DatasetNotReadyException(self.state)
-        self._check_refresh()
-        if self._ds is None:
-            raise RuntimeError("dataset is None")
-        return self._ds
+        if has_app_context():
+            name = g.get("pavo_dataset")
+            if name is not None:
+                return [self.entries[name]]
+        return list(self.entries.values())
+
+    @property
+    def snapshot(self) -> DatasetSnapshot | GroupedSnapshot:
+        """the currently published snapshot of the datasets in scope"""
+        # refresh watcher disabled: check for refreshes on every access
+        check = self._watcher is None
+        entries = self.scope
+        if len(entries) == 1:
+            return entries[0].get_snapshot(check_refresh=check)
+        snapshots = [e.get_snapshot(check_refresh=check) for e in entries]
+        grouped = self._grouped
+        if grouped is None or not grouped.matches(snapshots):
+            grouped = self._grouped = GroupedSnapshot(snapshots)
+        return grouped
+
+    def get_ds(self) -> PadoDataset:
+        snapshot = self.snapshot
+        if not isinstance(snapshot, DatasetSnapshot):
+            raise RuntimeError("multiple datasets in scope")
+        return snapshot.ds
 
-    @lockless_cached_property
+    @property
     def index(self) -> Sequence[ImageId]:
-        return list(self.get_ds().index)
+        return self.snapshot.index
 
-    @lockless_cached_property
+    @property
     def metadata(self) -> MetadataProvider:
-        return self.get_ds().metadata
+        return self.snapshot.metadata
 
-    @lockless_cached_property
+    @property
     def images(self) -> ImageProvider:
-        ds = self.get_ds()
-        if self._cache_path is None:
-            return ds.images
-        else:
-            return LocallyCachedImageProvider(
-                ds.images,
-                cache_cls=SimpleCacheFileSystem,
-                cache_storage=self._cache_path,
-            )
+        return self.snapshot.images
 
-    @lockless_cached_property
+    @property
     def annotations(self) -> AnnotationProvider:
-        return self.get_ds().annotations
+        return self.snapshot.annotations
 
-    @lockless_cached_property
-    def predictions(self) -> PredictionProxy:
-        return self.get_ds().predictions
+    @property
+    def predictions(self) -> PredictionProxy | GroupedPredictions:
+        return self.snapshot.predictions
 
-    def describe(self) -> dict[str, Any]:
-        ds = self.get_ds()
+    @property
+    def version(self) -> str:
+        return self.snapshot.version
+
+    @property
+    def registry(self) -> ImageIdRegistry:
+        return self.snapshot.registry
+
+    def get_loaded_snapshot(self) -> DatasetSnapshot | GroupedSnapshot | None:
+        """the current snapshot if the datasets in scope are already opened"""
         try:
-            description = self.__dict__["_describe"]
-        except KeyError:
-            description = self.__dict__["_describe"] = ds.describe(output_format="json")
-        return description
+            entries = self.scope
+        except DatasetNotReadyException:
+            return None
+        if len(entries) == 1:
+            return entries[0]._snapshot
+        grouped = self._grouped
+        if grouped is None or not all(e.loaded for e in entries):
+            return None
+        if not grouped.matches([e._snapshot for e in entries]):  # type: ignore
+            return None
+        return grouped
+
+    @property
+    def filter_index(self) -> ImageFilterIndex:
+        return self.snapshot.filter_index
+
+    @property
+    def annotation_indexes(self) -> AnnotationIndexes:
+        return self.snapshot.annotation_indexes
+
+    @property
+    def annotation_summaries(self) -> AnnotationSummaryIndex:
+        return self.snapshot.annotation_summaries
+
+    def insert_annotations(
+        self, batch: Mapping[ImageId, Sequence[dict[str, Any]]]
+    ) -> None:
+        """insert annotation records of the images in scope in memory
+
+        Each dataset with images in batch publishes a new snapshot. The
+        combined view of several datasets is rebuilt on the next access.
+        """
+        for entry in self.scope:
+            registry = entry.get_snapshot().registry
+            part = {k: v for k, v in batch.items() if k in registry}
+            if part:
+                entry.insert_annotations(part)
+
+    def log_annotations(
+        self, batch: Mapping[ImageId, Sequence[dict[str, Any]]]
+    ) -> None:
+        """append annotation records of the images in scope to the prediction logs
+
+        The snapshots are refreshed first, so that the records are logged for
+        the current dataset versions, see DatasetEntry.log_annotations.
+        """
+        check = self._watcher is None
+        for entry in self.scope:
+            registry = entry.get_snapshot(check_refresh=check).registry
+            part = {k: v for k, v in batch.items() if k in registry}
+            if part:
+                entry.log_annotations(part)
+
+    def describe(self) -> dict[str, Any]:
+        snapshot = self.snapshot
+        if isinstance(snapshot, DatasetSnapshot):
+            return snapshot.description
+        return {e.name: s.description for e, s in zip(self.scope, snapshot.snapshots)}
 
     def get_tabular_records_df(self) -> pd.DataFrame:
         """tabular representation of the dataset including metadata and annotations
@@ -284,233 +962,155 @@ class DatasetProxy:
         is of the form:
         (ImageId, classification, area, annotator_type, annotator_name,
         compound_name, organ, species)
+
+        The table is persisted in the CACHE_PATH, keyed by a fingerprint of
+        the dataset files and the extra column config, so that it is only
+        built once across workers and restarts. After a refresh only the
+        per-image partitions that changed are recomputed. The tables of
+        several datasets are concatenated.
         """
-        ds = self.get_ds()
-        try:
-            return self.__dict__["_tabular_records_df"]
-        except KeyError:
-            pass  # cache miss
-
-        OUTPUT_COLUMNS = [
-            "image_id",
-            "image_url",
-            "classification",
-            "annotation_type",
-            "annotator_type",
-            "annotator_name",
-            "annotation_area",
-            "annotation_count",
-            "annotation_metric",
-            "annotation_value",
-        ]
-
-        xcolumns = []
-        for xcol_dct in self._metadata_extra_columns or []:
-            xcolumns.append(xcol_dct["name"])
-
-        # === prepare metadata df for joining =================================
-        normalize = _Normalize()
-        hotfixes = _Hotfixes()
-
-        mdf = ds.metadata.df.copy()
-        normalize.column_names_inplace(mdf)
-        available_xcolumns = [c for c in xcolumns if c in mdf.columns]
-
-        if set(available_xcolumns) != set(xcolumns):
-            if self._metadata_extra_column_mode == "ignore_missing":
-                warnings.warn("requested columns are not available in dataframe")
-            else:
-                raise ValueError()
-        OUTPUT_COLUMNS.extend(available_xcolumns)
-
-        mdf = mdf[["classification", *available_xcolumns]]
-        mdf = mdf.reset_index(names="image_id")
-        mdf["annotator_name"] = normalize.annotator_name(ds.metadata.identifier)
-        mdf["annotator_type"] = "dataset"
-        mdf["annotation_area"] = None
-        mdf["annotation_count"] = None
-        mdf["classification"] = mdf["classification"].fillna("None")
-        mdf["annotation_type"] = "slide"
-        mdf["annotation_metric"] = None
-        mdf["annotation_value"] = None
-
-        _xcolumn_map = {
-            c: mdf[["image_id", c]].drop_duplicates().set_index("image_id")[c]
-            for c in available_xcolumns
-        }
-
-        # === prepare the annotation df for joining ===========================
-        adf = ds.annotations.df.copy()
-
-        hotfixes.ensure_area_column(adf)
-
-        adf["annotator_type"] = adf["annotator"].apply(lambda x: x["type"])
-        adf["annotator_name"] = adf["annotator"].apply(
-            lambda x: normalize.annotator_name(x["name"])
-        )
-        adf = adf[
-            ["image_id", "classification", "area", "annotator_type", "annotator_name"]
-        ]
-        adf = (
-            adf.groupby(
-                ["image_id", "classification", "annotator_type", "annotator_name"]
-            )["area"]
-            .agg(["sum", "count"])
-            .rename(columns={"sum": "annotation_area", "count": "annotation_count"})
-            .reset_index()
-        )
-        for xcol in available_xcolumns:
-            adf[xcol] = adf["image_id"].map(_xcolumn_map[xcol])
-        adf["annotation_type"] = "contour"
-
-        _tissue = hotfixes.load_tissue_area(ds)
-        _tissue_area = adf["image_id"].map(_tissue)
-        adf["annotation_area"] = adf["annotation_area"] / _tissue_area * 100
-
-        count_mask = adf["classification"].str.lower().str.contains("mitosis")
-        adf["annotation_metric"] = None
-        adf.loc[~count_mask, "annotation_metric"] = "area"
-        adf.loc[count_mask, "annotation_area"] = None
-        adf.loc[count_mask, "annotation_metric"] = "count"
-        adf.loc[~count_mask, "annotation_count"] = None
-        adf["annotation_value"] = None
-
-        # === prepare image prediction dataframe for joining ==================
-        ipdf = ds.predictions.images.df.copy()
-        _model_metadata = ipdf["extra_metadata"].apply(json.loads)
-
-        ipdf = ipdf[["image_id"]]
-        ipdf["classification"] = _model_metadata.apply(lambda x: x.get("classes"))
-        ipdf["annotator_name"] = _model_metadata.apply(normalize.model_name)
-        ipdf["annotator_type"] = "model"
-        for xcol in available_xcolumns:
-            ipdf[xcol] = ipdf["image_id"].map(_xcolumn_map[xcol])
-
-        ipdf["annotation_type"] = "heatmap"  # fixme: segmentation vs others...
-        ipdf["annotation_metric"] = "area"  # fixme
-        ipdf["annotation_value"] = None
-        ipdf["annotation_area"] = None  # provided via MetadataPredictionProvider
-        ipdf["annotation_count"] = None  # fixme: calculate
-
-        ipdf = ipdf.explode("classification")
-        ipdf = ipdf.loc[ipdf["classification"] != "other", :]
-        ipdf["classification"] = ipdf["classification"].str.title()
-
-        # === prepare metadata prediction dataframe for joining ===============
-        mpdf = ds.predictions.metadata.df.copy()
-        _model_metadata = mpdf["model_extra_json"].apply(json.loads)
-        _row_data = mpdf["row_json"].apply(json.loads)
-        mpdf = mpdf[["image_id"]]
-        mpdf["classification"] = _row_data.apply(
-            itemgetter("classification")
-        ).str.title()
-        mpdf["annotator_name"] = _model_metadata.apply(normalize.model_name)
-        mpdf["annotator_type"] = "model"
-        for xcol in available_xcolumns:
-            mpdf[xcol] = mpdf["image_id"].map(_xcolumn_map[xcol])
-
-        _metric = _row_data.apply(itemgetter("metric"))
-        _score = _row_data.apply(itemgetter("value"))
-        _mask = mpdf["annotator_name"].str.startswith("AIg") | (
-            mpdf["annotator_name"] == "MultiClassSegmentation-v0.1"
+        return self._tabular_records_df(self.snapshot)
+
+    def _tabular_records_df(
+        self, snapshot: DatasetSnapshot | GroupedSnapshot
+    ) -> pd.DataFrame:
+        # build from snapshot only, a newer snapshot might be published meanwhile
+        entries = self.scope
+        if isinstance(snapshot, DatasetSnapshot):
+            return entries[0].get_tabular_records_df(snapshot)
+        grouped = snapshot
+        return grouped.build_once(
+            "_tabular_records_df",
+            lambda: TabularRecordsEngine.concat(
+                [
+                    e.get_tabular_records_df(s)
+                    for e, s in zip(entries, grouped.snapshots)
+                ]
+            ),
         )
 
-        mpdf["annotation_type"] = "slide"
-        mpdf.loc[_mask, "annotation_type"] = "heatmap"
-        mpdf["annotation_area"] = _score * 100
-        mpdf.loc[~_mask, "annotation_area"] = None
-        mpdf["annotation_count"] = None  # fixme: calculate
-        mpdf["annotation_metric"] = _metric
-        mpdf.loc[_mask, "annotation_metric"] = "area"
-        mpdf["annotation_value"] = _score
-        mpdf.loc[_mask, "annotation_value"] = None
-
-        mpdf = mpdf.loc[mpdf["classification"] != "Other", :]
-
-        # === transfer area score for segmentation models =====================
-        ipdf = ipdf.loc[
-            ~(
-                (ipdf["annotator_name"].str.startswith("AIg"))
-                | (ipdf["annotator_name"] == "MultiClassSegmentation-v0.1")
-            )
-        ]
-
-        # === join and validate ===============================================
-        table = pd.concat([mdf, adf, ipdf, mpdf], axis=0)
-        table["image_url"] = table["image_id"].apply(
-            lambda x: base64_encode(x.encode()).decode()
+    def get_tabular_records_index(self) -> TabularRecordsIndex:
+        """return the query index over the tabular records"""
+        snapshot = self.snapshot
+        return snapshot.build_once(
+            "_tabular_records_index",
+            lambda: TabularRecordsIndex(self._tabular_records_df(snapshot)),
         )
 
-        if set(table.columns) != set(OUTPUT_COLUMNS):
-            raise RuntimeError(f"expected {OUTPUT_COLUMNS!r} got {table.columns!r}")
-
-        # === cache and return ================================================
-        tabular_records_df = self.__dict__["_tabular_records_df"] = table
-        return tabular_records_df
-
-    def get_tabular_records_json(self) -> str:
-        """return tabular records df as json"""
-        recs = self.get_tabular_records_df().to_json(orient="records")
-        recs_json = self.__dict__["_tabular_records_json"] = recs
-        return recs_json
-
     # --- refreshing ---
 
     def trigger_refresh(self) -> datetime:
+        """request a refresh of the datasets in all workers
+
+        The modification time of the refresh file is shared by all worker
+        processes on this host. Their refresh watchers pick it up within
+        DATASET_REFRESH_INTERVAL seconds.
+        """
         with open(self._modified_file, "a"):
             pass
+        os.utime(self._modified_file)
+        self._watcher_wakeup.set()
         ts = os.stat(self._modified_file).st_mtime
         return datetime.utcfromtimestamp(ts).replace(tzinfo=timezone.utc)
 
-    def _check_refresh(self) -> None:
-        ts = os.stat(self._modified_file).st_mtime
-        dt = datetime.utcfromtimestamp(ts).replace(tzinfo=timezone.utc)
-        if self._modified_time is None or dt > self._modified_time:
-            self._modified_time = max([self._last_change(), dt])
-            self._ds = PadoDataset(self.urlpath, mode="r")
-            self._clear_caches()
-
-    def _last_change(self) -> datetime:
-        ds = self._ds
-        if ds is None:
-            return datetime.fromtimestamp(0, tz=timezone.utc)
-        # noinspection PyProtectedMember
-        fs, root = ds._fs, ds._root
+    # --- warmup ---
+
+    @property
+    def ready(self) -> bool:
+        """true once the datasets are loaded and their caches are warm"""
+        return self.state == DatasetState.READY and self._warm.is_set()
+
+    def _start_warmup(self) -> None:
+        """build the caches of all datasets in a background thread"""
+        if not self._warmup_enabled:
+            self._warm.set()
+            return
+        threading.Thread(
+            target=self._warmup_initial,
+            name="pavo-dataset-warmup",
+            daemon=True,
+        ).start()
+
+    def _warmup_initial(self) -> None:
         try:
-            return max(
-                x["LastModified"]
-                for x in fs.ls(root, detail=True, refresh=True)
-                if "LastModified" in x
-            )
-        except ValueError:
-            return datetime.fromtimestamp(0, tz=timezone.utc)
+            for entry in self.entries.values():
+                try:
+                    entry.warmup()
+                except Exception:
+                    _logger.exception(f"warmup of dataset {entry.name!r} failed")
+        finally:
+            # failed builds are retried lazily by the requests
+            self._warm.set()
+
+    # --- refresh watcher ---
+
+    def _start_watcher(self) -> None:
+        """start the background refresh watcher of this process"""
+        if self._refresh_interval <= 0:
+            return
+        if self._watcher is not None and self._watcher.is_alive():
+            return
+        self._watcher = threading.Thread(
+            target=self._watch, name="pavo-refresh-watcher", daemon=True
+        )
+        self._watcher.start()
 
-    def _clear_caches(self) -> None:
-        caches = [
-            "index",
-            "images",
-            "metadata",
-            "annotations",
-            "predictions",
-            "_describe",
-            "_tabular_records_df",
-            "_tabular_records_json",
-        ]
-        for key in caches:
-            try:
-                del self.__dict__[key]
-            except KeyError:
-                pass
+    def _restart_after_fork(self) -> None:
+        """restart the background threads in a forked child process
+
+        Only the forking thread survives a fork. Locks held by the other
+        threads of the parent are replaced, an interrupted warmup is run
+        again.
+        """
+        for entry in self.entries.values():
+            entry.reset_locks_after_fork()
+        grouped = self._grouped
+        if grouped is not None:
+            _reset_build_once_locks(grouped)
+        warm = self._warm.is_set()
+        self._warm = threading.Event()
+        self._watcher = None
+        self._watcher_wakeup = threading.Event()
+        if self.state != DatasetState.READY:
+            return
+        if not self._background:
+            # e.g. prefork celery workers, datasets are built on access
+            self._warm.set()
+            return
+        if warm:
+            self._warm.set()
+        else:
+            self._start_warmup()
+        self._start_watcher()
+
+    def _watch(self) -> None:
+        """poll the refresh file, publish new snapshots and evict idle datasets"""
+        while True:
+            self._watcher_wakeup.wait(self._refresh_interval)
+            self._watcher_wakeup.clear()
+            now = time.monotonic()
+            for entry in list(self.entries.values()):
+                snapshot = entry._snapshot
+                if snapshot is None:
+                    continue
+                try:
+                    if 0 < self._idle_timeout < now - entry.last_access:
+                        entry.evict()
+                        self._grouped = None
+                    else:
+                        entry.check_refresh(snapshot, warmup=self._warmup_enabled)
+                except Exception:
+                    _logger.exception(f"refresh watcher failed for {entry.name!r}")
 
 
 # interface used throughout the app
 dataset = DatasetProxy()
 
 
-def initialize_dataset(app: Flask) -> DatasetProxy:
+def initialize_dataset(app: Flask, *, background: bool = True) -> DatasetProxy:
     """prepare the dataset"""
     global dataset
-    dataset.init_app(app)
+    dataset.init_app(app, background=background)
     assert not hasattr(app, "dataset")
     app.dataset = dataset  # type: ignore
     return dataset
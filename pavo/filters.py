@@ -0,0 +1,402 @@
+"""pavo.filters provides the filter index over the images of a dataset
+
+The index maps filenames and metadata values to posting lists: sorted
+arrays of image handles (see pavo.registry). Filters are answered by
+looking up and intersecting posting lists instead of scanning all image
+ids or the metadata dataframe. An index is built once per dataset
+snapshot, and is replaced with the snapshot on refresh.
+
+Filter queries are json objects, evaluated to boolean masks over the
+images of the index (see `query_mask`).
+"""
+from __future__ import annotations
+
+import fnmatch
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Callable
+from typing import Collection
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+from pado.images import ImageId
+from pandas import DataFrame
+
+from pavo.registry import ImageIdRegistry
+
+if TYPE_CHECKING:
+    from pavo.tabular import TabularRecordsIndex
+
+__all__ = [
+    "ImageFilterIndex",
+    "query_mask",
+    "query_uses_records",
+]
+
+
+class _Postings:
+    """sorted image positions per distinct value"""
+
+    def __init__(self, values: Any, positions: np.ndarray) -> None:
+        codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+        valid = (codes >= 0) & (positions >= 0)
+        codes, positions = codes[valid], positions[valid]
+        order = np.lexsort((positions, codes))
+        codes, positions = codes[order], positions[order]
+        # an image can have several metadata rows with the same value
+        keep = np.ones(len(codes), dtype=bool)
+        keep[1:] = (codes[1:] != codes[:-1]) | (positions[1:] != positions[:-1])
+        codes, positions = codes[keep], positions[keep]
+        self.values = pd.Index(uniques)
+        self.codes = codes
+        self.positions = positions
+        self.bounds = np.searchsorted(codes, np.arange(len(uniques) + 1))
+
+    def __contains__(self, value: Any) -> bool:
+        return self.values.get_indexer([value])[0] >= 0
+
+    def lookup(self, values: Collection[Any]) -> np.ndarray:
+        """return the sorted image positions of any of values"""
+        codes = self.values.get_indexer(list(values))
+        parts = [
+            self.positions[self.bounds[c] : self.bounds[c + 1]] for c in codes if c >= 0
+        ]
+        if not parts:
+            return np.empty(0, dtype=np.intp)
+        elif len(parts) == 1:
+            return parts[0]
+        return np.unique(np.concatenate(parts))
+
+    def counts(self, selected: np.ndarray | None = None) -> np.ndarray:
+        """return the number of images per value, optionally of a selection"""
+        if selected is None:
+            return np.diff(self.bounds)
+        codes = self.codes[selected[self.positions]]
+        return np.bincount(codes, minlength=len(self.values))
+
+
+class ImageFilterIndex:
+    """an inverted index from filenames and metadata values to images
+
+    Filter results are cached as ordered position arrays, so that paging
+    through a result only slices an array.
+    """
+
+    MAX_CACHED_RESULTS = 128
+
+    def __init__(self, registry: ImageIdRegistry, metadata: DataFrame) -> None:
+        self.registry = registry
+        self.image_ids = registry.image_ids
+        self._metadata = metadata
+        self._row_positions = registry.handles_from_strs(metadata.index)
+        self._filename_strs = pd.Series(
+            [image_id.last for image_id in self.image_ids], dtype=object
+        )
+        self._filenames = _Postings(
+            self._filename_strs.to_numpy(), np.arange(len(self.image_ids))
+        )
+        self._columns: dict[str, _Postings] = {}
+        self._ranks: dict[str, np.ndarray] = {}
+        self._results: OrderedDict[bytes, np.ndarray] = OrderedDict()
+        self._facet_catalog: dict[str, list[tuple[Any, int]]] | None = None
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.image_ids)
+
+    @property
+    def metadata_keys(self) -> list[str]:
+        return list(map(str, self._metadata.columns))
+
+    def all(self) -> np.ndarray:
+        """return the positions of all images"""
+        return np.arange(len(self.image_ids))
+
+    def filename(self, filename: str) -> np.ndarray:
+        """return the positions of the images with filename"""
+        return self._filenames.lookup([filename])
+
+    def metadata(self, key: str, values: Collection[Any]) -> np.ndarray:
+        """return the positions of the images with a metadata value in values"""
+        return self._postings(key).lookup(values)
+
+    def has_metadata_value(self, key: str, value: Any) -> bool:
+        return value in self._postings(key)
+
+    def filename_mask(self, condition: Any) -> np.ndarray:
+        """return the image mask of a filename condition
+
+        condition is a filename, a list of filenames or one of
+        {"glob": pattern} and {"contains": substring}.
+        """
+        if isinstance(condition, str):
+            condition = [condition]
+        if isinstance(condition, list):
+            return self._positions_mask(self._filenames.lookup(condition))
+        if not isinstance(condition, dict) or len(condition) != 1:
+            raise ValueError("filename must be a str, a list or a glob or contains")
+        ((op, value),) = condition.items()
+        if not isinstance(value, str):
+            raise ValueError(f"filename {op} requires a str")
+        if op == "glob":
+            matches = self._filename_strs.str.match(fnmatch.translate(value))
+        elif op == "contains":
+            matches = self._filename_strs.str.contains(value, regex=False)
+        else:
+            raise ValueError(f"unknown filename operator {op!r}")
+        return matches.to_numpy(dtype=bool)
+
+    def metadata_mask(self, key: str, condition: Any) -> np.ndarray:
+        """return the image mask of a metadata condition
+
+        condition is a value, a list of values or a {"min": ..., "max": ...}
+        range. An image matches if any of its metadata rows matches.
+        """
+        if key not in self._metadata.columns:
+            raise ValueError(f"unknown metadata key {key!r}")
+        if not isinstance(condition, dict):
+            if not isinstance(condition, list):
+                condition = [condition]
+            return self._positions_mask(self.metadata(key, condition))
+        unknown = set(condition).difference({"min", "max"})
+        if unknown:
+            raise ValueError(f"unknown range bounds {sorted(unknown)!r}")
+        values = pd.to_numeric(self._metadata[key], errors="coerce").to_numpy()
+        rows = self._row_positions >= 0
+        if condition.get("min") is not None:
+            rows &= values >= float(condition["min"])
+        if condition.get("max") is not None:
+            rows &= values <= float(condition["max"])
+        return self._positions_mask(self._row_positions[rows])
+
+    def image_mask(self, image_ids: Collection[str]) -> np.ndarray:
+        """return the image mask of image id strs"""
+        positions = self.registry.handles_from_strs(image_ids)
+        return self._positions_mask(positions[positions >= 0])
+
+    def _positions_mask(self, positions: np.ndarray) -> np.ndarray:
+        mask = np.zeros(len(self.image_ids), dtype=bool)
+        mask[positions] = True
+        return mask
+
+    def facets(
+        self,
+        keys: Sequence[str] | None = None,
+        positions: np.ndarray | None = None,
+    ) -> dict[str, list[tuple[Any, int]]]:
+        """return the distinct values and their image counts per metadata key
+
+        Without positions the precomputed catalog of all images is returned.
+        With positions the counts are restricted to these images (drill-down)
+        and values without images are omitted. Values are ordered by count.
+        """
+        if keys is None:
+            keys = self.metadata_keys
+        if positions is None:
+            catalog = self.facet_catalog
+            return {key: catalog[key] for key in keys}
+        selected = self._positions_mask(positions)
+        return {key: self._facet(key, selected) for key in keys}
+
+    @property
+    def facet_catalog(self) -> dict[str, list[tuple[Any, int]]]:
+        """the distinct values with image counts of all metadata keys"""
+        catalog = self._facet_catalog
+        if catalog is None:
+            catalog = {key: self._facet(key) for key in self.metadata_keys}
+            self._facet_catalog = catalog
+        return catalog
+
+    def _facet(
+        self, key: str, selected: np.ndarray | None = None
+    ) -> list[tuple[Any, int]]:
+        postings = self._postings(key)
+        counts = postings.counts(selected)
+        order = np.argsort(-counts, kind="stable")
+        if selected is not None:
+            order = order[counts[order] > 0]
+        values = postings.values.take(order).tolist()
+        return list(zip(values, counts[order].tolist()))
+
+    def image_ids_at(self, positions: np.ndarray) -> list[ImageId]:
+        """return the image ids at positions"""
+        return self.registry.image_ids_at(positions)
+
+    def cached(self, key: bytes, func: Callable[[], np.ndarray]) -> np.ndarray:
+        """return the cached filter result for key, computing it on a miss"""
+        with self._lock:
+            try:
+                self._results.move_to_end(key)
+                return self._results[key]
+            except KeyError:
+                pass  # cache miss
+        result = func()
+        result.setflags(write=False)
+        with self._lock:
+            self._results[key] = result
+            while len(self._results) > self.MAX_CACHED_RESULTS:
+                self._results.popitem(last=False)
+        return result
+
+    def sort(self, positions: np.ndarray, order: str) -> np.ndarray:
+        """return positions sorted by order
+
+        order is "index" for the dataset order, "filename" or a metadata
+        key, prefixed with "-" for descending order. Ties and missing
+        values are kept in dataset order, missing values last.
+        """
+        ranks = self._ranks.get(order)
+        if ranks is None:
+            ranks = self._ranks[order] = self._build_ranks(order)
+        return positions[np.argsort(ranks[positions], kind="stable")]
+
+    def _build_ranks(self, order: str) -> np.ndarray:
+        ascending = not order.startswith("-")
+        key = order if ascending else order[1:]
+        num_images = len(self.image_ids)
+        if key == "index":
+            values = pd.Series(np.arange(num_images))
+        elif key == "filename":
+            values = self._filename_strs
+        elif key in self._metadata.columns:
+            # images are ordered by the value of their first metadata row
+            valid = self._row_positions >= 0
+            values = pd.Series(
+                self._metadata[key].to_numpy()[valid],
+                index=self._row_positions[valid],
+            )
+            values = values[~values.index.duplicated()].reindex(range(num_images))
+        else:
+            raise ValueError(f"unknown order {order!r}")
+        try:
+            permutation = values.sort_values(
+                ascending=ascending, kind="stable", na_position="last"
+            ).index.to_numpy()
+        except TypeError:
+            raise ValueError(f"can't order by {key!r} with mixed value types")
+        ranks = np.empty(num_images, dtype=np.intp)
+        ranks[permutation] = np.arange(num_images)
+        return ranks
+
+    def _postings(self, key: str) -> _Postings:
+        """return the postings of a metadata column, built on first use"""
+        try:
+            return self._columns[key]
+        except KeyError:
+            pass
+        if key not in self._metadata.columns:
+            raise KeyError(key)
+        with self._lock:
+            if key not in self._columns:
+                self._columns[key] = _Postings(
+                    self._metadata[key].to_numpy(), self._row_positions
+                )
+            return self._columns[key]
+
+    @staticmethod
+    def intersect(*positions: np.ndarray) -> np.ndarray:
+        """intersect sorted posting arrays, smallest first"""
+        parts = sorted(positions, key=len)
+        result = parts[0]
+        for part in parts[1:]:
+            result = np.intersect1d(result, part, assume_unique=True)
+        return result
+
+
+# --- query language ----------------------------------------------------------
+
+QUERY_MAX_DEPTH = 32
+
+
+def query_mask(
+    query: Any,
+    index: ImageFilterIndex,
+    records: Callable[[], TabularRecordsIndex] | None = None,
+    *,
+    _depth: int = 0,
+) -> np.ndarray:
+    """evaluate a filter query to a boolean mask over the images of index
+
+    A query is a json object, all its keys must match:
+
+      - {"and": [query, ...]}, {"or": [query, ...]}, {"not": query}
+      - {"filename": "a.svs"}, {"filename": ["a.svs", "b.svs"]},
+        {"filename": {"glob": "*_HE.svs"}}, {"filename": {"contains": "HE"}}
+      - {"metadata": {key: value, key: [value, ...], key: {"min": 1, "max": 2}}}
+      - {"records": {column: condition, ...}} matches images with a tabular
+        record matching all conditions, e.g. an area of a classification
+        above 5% of the tissue:
+        {"records": {"classification": "Necrosis", "annotation_area": {"min": 5}}}
+      - {"prediction": "model"} or {"prediction": ["model", ...]} matches
+        images with predictions of one of the models
+
+    """
+    if _depth > QUERY_MAX_DEPTH:
+        raise ValueError("filter query is nested too deeply")
+    if not isinstance(query, dict) or not query:
+        raise ValueError("filter query must be a non empty json object")
+
+    def _sub(q: Any) -> np.ndarray:
+        return query_mask(q, index, records, _depth=_depth + 1)
+
+    def _records(filters: Any) -> np.ndarray:
+        if records is None:
+            raise ValueError("records queries are not available")
+        if not isinstance(filters, dict) or not filters:
+            raise ValueError("records must be a non empty json object")
+        tabular = records()
+        image_ids = tabular.df["image_id"].to_numpy()[tabular.mask(filters)]
+        return index.image_mask(pd.unique(image_ids))
+
+    mask = np.ones(len(index), dtype=bool)
+    for op, arg in query.items():
+        if op == "and" or op == "or":
+            if not isinstance(arg, list) or not arg:
+                raise ValueError(f"{op} requires a non empty list of queries")
+            masks = [_sub(q) for q in arg]
+            if op == "and":
+                mask &= np.logical_and.reduce(masks)
+            else:
+                mask &= np.logical_or.reduce(masks)
+        elif op == "not":
+            mask &= ~_sub(arg)
+        elif op == "filename":
+            mask &= index.filename_mask(arg)
+        elif op == "metadata":
+            if not isinstance(arg, dict) or not arg:
+                raise ValueError("metadata must be a non empty json object")
+            for key, condition in arg.items():
+                mask &= index.metadata_mask(key, condition)
+        elif op == "records":
+            mask &= _records(arg)
+        elif op == "prediction":
+            names = arg if isinstance(arg, list) else [arg]
+            mask &= _records({"annotator_type": ["model"], "annotator_name": names})
+        else:
+            raise ValueError(f"unknown filter query operator {op!r}")
+    return mask
+
+
+def query_uses_records(query: Any, *, _depth: int = 0) -> bool:
+    """return if a filter query depends on the tabular records
+
+    The results of these queries change with the annotations of a dataset
+    snapshot, the results of all other queries only with the dataset.
+    """
+    if _depth > QUERY_MAX_DEPTH or not isinstance(query, dict):
+        return False  # rejected by query_mask
+    for op, arg in query.items():
+        if op == "records" or op == "prediction":
+            return True
+        elif op == "and" or op == "or":
+            if isinstance(arg, list) and any(
+                query_uses_records(q, _depth=_depth + 1) for q in arg
+            ):
+                return True
+        elif op == "not":
+            if query_uses_records(arg, _depth=_depth + 1):
+                return True
+    return False
@@ -39,6 +39,14 @@ def health() -> EndpointResponse:
     return json.dumps({"success": True}), 200, {"ContentType": "application/json"}
 
 
+@blueprint.route("/ready")
+def ready() -> EndpointResponse:
+    """readiness probe: fails until the dataset caches are warm"""
+    if dataset.state == DatasetState.NOT_CONFIGURED or dataset.ready:
+        return json.dumps({"ready": True}), 200, {"ContentType": "application/json"}
+    return json.dumps({"ready": False}), 503, {"ContentType": "application/json"}
+
+
 @blueprint.route("/worker/ping")
 def ping_worker() -> EndpointResponse:
     result: AsyncResult = ping_worker_task.apply_async()
@@ -0,0 +1,455 @@
+"""pavo.ingest applies and persists ingested annotation predictions
+
+Predictions are either inserted into the in-memory annotations of the
+request's process, or, in the queued ingest mode, spooled to CACHE_PATH
+and validated by the celery workers. The workers append the validated
+records in batches to the prediction log of the dataset version, which
+every pavo process on the host replays in the same order into its
+dataset snapshots. The log is compacted into checkpoints, so that new
+snapshots don't replay every batch, and truncated on refresh.
+
+Writes never modify the annotations of a published snapshot. They go to
+an AnnotationOverlay of its annotations, which is published with a new
+snapshot.
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import shutil
+import tempfile
+import time
+import uuid
+from functools import cached_property
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Iterable
+from typing import Iterator
+from typing import Mapping
+from typing import Sequence
+
+import orjson
+import pandas as pd
+from filelock import FileLock
+from pado.annotations import AnnotationProvider
+from pado.annotations import Annotations
+from pado.annotations.annotation import AnnotationModel
+from pado.images import ImageId
+from pado.io.files import urlpathlike_to_fs_and_path
+from pado.types import UrlpathLike
+
+if TYPE_CHECKING:
+    from pavo.registry import ImageIdRegistry
+
+__all__ = [
+    "AnnotationOverlay",
+    "IngestQueueFull",
+    "IngestSpool",
+    "PredictionLog",
+    "PredictionLogCompacted",
+    "insert_annotation_records",
+    "records_digest",
+]
+
+_logger = logging.getLogger("pavo.data.dataset")
+
+
+def insert_annotation_records(
+    provider: AnnotationProvider,
+    image_id: ImageId,
+    records: Sequence[dict[str, Any]],
+) -> None:
+    """insert annotation records in front of an image's annotations
+
+    All records are written with a single copy of the annotations frame.
+    The result is the same as inserting the records one by one at index 0.
+    The previous annotations of the image are not modified.
+    """
+    new = pd.DataFrame(records[::-1], columns=list(AnnotationModel.__fields__))
+    try:
+        df = pd.concat([new, provider[image_id].df], ignore_index=True)
+    except KeyError:
+        df = new
+    provider[image_id] = Annotations(df, image_id=image_id)
+
+
+def records_digest(batch: Mapping[ImageId, Sequence[dict[str, Any]]]) -> str:
+    """a digest of the annotation records of a batch, independent of its order"""
+    h = hashlib.sha256()
+    for image_id_str, records in sorted((k.to_str(), v) for k, v in batch.items()):
+        h.update(image_id_str.encode())
+        h.update(orjson.dumps(records, option=orjson.OPT_SORT_KEYS, default=str))
+    return h.hexdigest()
+
+
+class AnnotationOverlay(AnnotationProvider):
+    """the annotations of a provider with the annotations of some images replaced
+
+    The provider is shared and never modified, writes only replace the
+    annotations of an image in the overlay. An overlay of an overlay
+    copies the replaced images, so overlays don't nest.
+    """
+
+    # noinspection PyMissingConstructor
+    def __init__(self, provider: AnnotationProvider) -> None:
+        self._replaced: dict[ImageId, Annotations] = {}
+        if isinstance(provider, AnnotationOverlay):
+            self.base: AnnotationProvider = provider.base
+            self._replaced.update(provider._replaced)
+        else:
+            self.base = provider
+        self.identifier = self.base.identifier
+
+    @cached_property
+    def df(self) -> pd.DataFrame:
+        if not self._replaced:
+            return self.base.df
+        labels = [image_id.to_str() for image_id in self._replaced]
+        dfs = [self.base.df.drop(index=labels, errors="ignore")]
+        for image_id, replaced in self._replaced.items():
+            df = replaced.df
+            dfs.append(df.set_index(pd.Index([image_id.to_str()] * len(df))))
+        return pd.concat(dfs)
+
+    def __getitem__(self, image_id: ImageId) -> Annotations:
+        try:
+            return self._replaced[image_id]
+        except KeyError:
+            return self.base[image_id]
+
+    def __setitem__(self, image_id: ImageId, value: Annotations) -> None:
+        if not isinstance(image_id, ImageId):
+            raise TypeError(
+                f"keys must be ImageId instances, got {type(image_id).__name__!r}"
+            )
+        if not isinstance(value, Annotations):
+            raise TypeError(f"requires Annotations, got {type(value).__name__}")
+        self._replaced[image_id] = value
+        self.__dict__.pop("df", None)
+
+    def __delitem__(self, image_id: ImageId) -> None:
+        raise RuntimeError(f"can't delete from {type(self).__name__}")
+
+    def __len__(self) -> int:
+        return len(set(self.base).union(self._replaced))
+
+    def __iter__(self) -> Iterator[ImageId]:
+        return iter(dict.fromkeys([*self.base, *self._replaced]))
+
+    def __repr__(self) -> str:
+        return f"{type(self).__name__}({self.base!r}, replaced={len(self._replaced)})"
+
+    def to_parquet(
+        self, urlpath: UrlpathLike, *, storage_options: dict[str, Any] | None = None
+    ) -> None:
+        raise NotImplementedError(f"unsupported operation for {type(self).__name__!r}")
+
+    @classmethod
+    def from_parquet(cls, urlpath: UrlpathLike) -> AnnotationProvider:
+        raise NotImplementedError(f"unsupported operation for {cls.__name__!r}()")
+
+
+def _local_path(cache_path: UrlpathLike | None) -> str | None:
+    """return the path of cache_path if it is on the local filesystem"""
+    if not cache_path:
+        return None
+    fs, path = urlpathlike_to_fs_and_path(cache_path)
+    protocols = (fs.protocol,) if isinstance(fs.protocol, str) else fs.protocol
+    if "file" not in protocols:
+        return None
+    return path
+
+
+def _write_temp(dirname: str, chunks: Iterable[bytes]) -> str:
+    """write chunks to a temporary file in dirname and return its path"""
+    os.makedirs(dirname, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=dirname, suffix=".tmp")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            for chunk in chunks:
+                f.write(chunk)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+    return tmp
+
+
+def _write_atomic(path: str, chunks: Iterable[bytes]) -> None:
+    """write chunks to path, the file only appears once it is complete"""
+    tmp = _write_temp(os.path.dirname(path), chunks)
+    try:
+        os.replace(tmp, path)
+    except BaseException:
+        os.unlink(tmp)
+        raise
+
+
+# --- prediction log ----------------------------------------------------------
+
+
+class PredictionLogCompacted(Exception):
+    """the entries after a log position were merged into a checkpoint"""
+
+
+class PredictionLog:
+    """an append-only log of validated annotation prediction batches of a dataset
+
+    Each batch is a ndjson entry with one line per image, named by its
+    sequence number. Numbers are allocated under a file lock, so that all
+    processes replay the batches, and with them the writes to each image,
+    in the same order. The position of a replay is the number of the last
+    entry it read.
+
+    The log is scoped to a version of the dataset, the base_version of its
+    snapshots. A refresh starts a new log and truncates the logs of the
+    previous versions: like the in-memory writes of the synchronous ingest,
+    the ingested predictions are dropped with the refreshed snapshot.
+
+    Once COMPACT_ENTRIES entries were appended, they are merged with the
+    previous checkpoint into a new checkpoint with one line per image.
+    New snapshots replay the checkpoint and the entries after it. Merged
+    entries are kept for RETAIN_SECONDS, for the processes that are still
+    replaying them.
+    """
+
+    COMPACT_ENTRIES = 64
+    RETAIN_SECONDS = 600.0
+
+    def __init__(self, root: str, urlpath: str) -> None:
+        urlhash = hashlib.sha256(urlpath.encode()).hexdigest()[:16]
+        self.root = os.path.join(root, "prediction_log", urlhash)
+        self._lock_path = f"{self.root}.lock"
+
+    @classmethod
+    def from_cache_path(
+        cls, cache_path: UrlpathLike | None, urlpath: str
+    ) -> PredictionLog | None:
+        """return the log in cache_path if it is on the local filesystem"""
+        path = _local_path(cache_path)
+        return None if path is None else cls(path, urlpath)
+
+    def _path(self, version: str, seq: int, checkpoint: bool = False) -> str:
+        suffix = ".checkpoint.ndjson" if checkpoint else ".ndjson"
+        return os.path.join(self.root, version, f"{seq:012d}{suffix}")
+
+    def _scan(self, version: str) -> tuple[int, list[int]]:
+        """return the checkpoint number (or 0) and the entry numbers in order"""
+        checkpoint, entries = 0, []
+        try:
+            names = os.listdir(os.path.join(self.root, version))
+        except FileNotFoundError:
+            names = []
+        for name in names:
+            if name.endswith(".checkpoint.ndjson"):
+                checkpoint = max(checkpoint, int(name.split(".", 1)[0]))
+            elif name.endswith(".ndjson"):
+                entries.append(int(name.split(".", 1)[0]))
+        return checkpoint, sorted(entries)
+
+    def append(
+        self, batch: Mapping[ImageId, Sequence[dict[str, Any]]], *, version: str
+    ) -> int:
+        """append a batch of annotation records and return its number"""
+        lines = (
+            orjson.dumps({"image_id": image_id.to_str(), "records": records}) + b"\n"
+            for image_id, records in batch.items()
+        )
+        # outside the version directories, a truncate might remove them
+        tmp = _write_temp(self.root, lines)
+        try:
+            with FileLock(self._lock_path):
+                checkpoint, entries = self._scan(version)
+                seq = max([checkpoint, *entries]) + 1
+                os.makedirs(os.path.join(self.root, version), exist_ok=True)
+                os.replace(tmp, self._path(version, seq))
+                pending = [e for e in entries if e > checkpoint]
+                try:
+                    if len(pending) + 1 >= self.COMPACT_ENTRIES:
+                        self._compact(version, checkpoint, [*pending, seq])
+                    self._prune(version)
+                except Exception:
+                    # the batch is appended, compaction is retried later
+                    _logger.exception("could not compact the prediction log")
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        return seq
+
+    def _compact(self, version: str, checkpoint: int, entries: Sequence[int]) -> None:
+        """merge a checkpoint and the entries after it into a new checkpoint"""
+        merged: dict[str, list[dict]] = {}
+        paths = [self._path(version, e) for e in entries]
+        if checkpoint:
+            paths.insert(0, self._path(version, checkpoint, checkpoint=True))
+        for path in paths:
+            for image_id_str, records in self._read(path):
+                merged.setdefault(image_id_str, []).extend(records)
+        _write_atomic(
+            self._path(version, entries[-1], checkpoint=True),
+            (
+                orjson.dumps({"image_id": i, "records": r}) + b"\n"
+                for i, r in merged.items()
+            ),
+        )
+        if checkpoint:
+            os.unlink(self._path(version, checkpoint, checkpoint=True))
+        _logger.info(f"compacted {len(entries)} prediction log entries")
+
+    def _prune(self, version: str) -> None:
+        """remove merged entries that were not modified for RETAIN_SECONDS"""
+        checkpoint, entries = self._scan(version)
+        now = time.time()
+        for seq in entries:
+            if seq > checkpoint:
+                break
+            path = self._path(version, seq)
+            try:
+                if now - os.stat(path).st_mtime > self.RETAIN_SECONDS:
+                    os.unlink(path)
+            except FileNotFoundError:
+                pass
+
+    def truncate(self, version: str) -> None:
+        """remove the logs of all other versions of the dataset"""
+        with FileLock(self._lock_path):
+            try:
+                names = os.listdir(self.root)
+            except FileNotFoundError:
+                return
+            for name in names:
+                path = os.path.join(self.root, name)
+                if name != version and os.path.isdir(path):
+                    shutil.rmtree(path, ignore_errors=True)
+                    _logger.info(f"truncated the prediction log of version {name}")
+
+    def mtime(self, version: str) -> int:
+        """the modification time of the log in ns, changes on append"""
+        try:
+            return os.stat(os.path.join(self.root, version)).st_mtime_ns
+        except FileNotFoundError:
+            return 0
+
+    @staticmethod
+    def _read(path: str) -> Iterator[tuple[str, list[dict]]]:
+        """yield the image id str and records of an entry"""
+        with open(path, "rb") as f:
+            for line in f:
+                obj = orjson.loads(line)
+                yield obj["image_id"], obj["records"]
+
+    def replay(
+        self,
+        provider: AnnotationProvider,
+        registry: ImageIdRegistry,
+        *,
+        version: str,
+        position: int = 0,
+    ) -> tuple[int, set[ImageId]]:
+        """insert the records of the entries after position into provider
+
+        Only records of images in registry are inserted. Returns the new
+        position and the modified image ids. Replaying stops before an
+        entry that can't be read, without inserting any of its records.
+        Raises PredictionLogCompacted if the entries after position are
+        gone, the records then have to be replayed from position 0.
+        """
+        checkpoint, entries = self._scan(version)
+        paths = [self._path(version, e) for e in entries if e > position]
+        if position == 0 and checkpoint:
+            paths = [self._path(version, e) for e in entries if e > checkpoint]
+            paths.insert(0, self._path(version, checkpoint, checkpoint=True))
+        elif position < checkpoint and not set(entries).issuperset(
+            range(position + 1, checkpoint + 1)
+        ):
+            raise PredictionLogCompacted(position)
+        modified: set[ImageId] = set()
+        for path in paths:
+            # an entry is applied completely or not at all
+            staged = AnnotationOverlay(provider)
+            inserted: set[ImageId] = set()
+            try:
+                for image_id_str, records in self._read(path):
+                    (handle,) = registry.handles_from_strs([image_id_str])
+                    if handle < 0:
+                        continue
+                    (image_id,) = registry.image_ids_at([handle])
+                    insert_annotation_records(staged, image_id, records)
+                    inserted.add(image_id)
+            except FileNotFoundError:
+                raise PredictionLogCompacted(position)
+            except Exception:
+                # the position stays before the entry, the next replay retries it
+                _logger.exception(f"could not replay prediction log entry {path!r}")
+                break
+            for image_id in inserted:
+                provider[image_id] = staged[image_id]
+            modified.update(inserted)
+            position = max(position, int(os.path.basename(path).split(".")[0]))
+        return position, modified
+
+
+# --- ingest spool ------------------------------------------------------------
+
+
+class IngestQueueFull(Exception):
+    pass
+
+
+class IngestSpool:
+    """request bodies of queued ingest jobs, waiting for the celery workers
+
+    The number of spooled jobs is the queue depth, it is shared by all
+    processes on the host. A job is written to a temporary file first and
+    is only added if the queue is not full, which is checked under a file
+    lock.
+    """
+
+    def __init__(self, root: str) -> None:
+        self.root = os.path.join(root, "prediction_ingest")
+        self._lock_path = f"{self.root}.lock"
+
+    @classmethod
+    def from_cache_path(cls, cache_path: UrlpathLike | None) -> IngestSpool | None:
+        """return the spool in cache_path if it is on the local filesystem"""
+        path = _local_path(cache_path)
+        return None if path is None else cls(path)
+
+    def path(self, job_id: str) -> str:
+        return os.path.join(self.root, f"{job_id}.ndjson")
+
+    def depth(self) -> int:
+        """the number of spooled jobs"""
+        try:
+            return sum(n.endswith(".ndjson") for n in os.listdir(self.root))
+        except FileNotFoundError:
+            return 0
+
+    def submit(self, chunks: Iterable[bytes], *, max_depth: int) -> str:
+        """spool a job and return its id, raises IngestQueueFull"""
+        msg = f"{max_depth} ingest jobs are queued"
+        # reject early, before the request body is read
+        if self.depth() >= max_depth:
+            raise IngestQueueFull(msg)
+        job_id = uuid.uuid4().hex
+        tmp = _write_temp(self.root, chunks)
+        try:
+            with FileLock(self._lock_path):
+                if self.depth() >= max_depth:
+                    raise IngestQueueFull(msg)
+                os.replace(tmp, self.path(job_id))
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+        return job_id
+
+    def __contains__(self, job_id: str) -> bool:
+        return os.path.isfile(self.path(job_id))
+
+    def discard(self, job_id: str) -> None:
+        try:
+            os.unlink(self.path(job_id))
+        except FileNotFoundError:
+            pass
@@ -10,7 +10,7 @@ from pavo.data import dataset
 
 def get_valid_metadata_attributes(ds: DatasetProxy = dataset) -> List[str]:
     """return all the attributes present in the metadata provider"""
-    return list(ds.metadata.df.columns)
+    return ds.filter_index.metadata_keys
 
 
 def get_valid_metadata_attribute_options(
@@ -18,18 +18,17 @@ def get_valid_metadata_attribute_options(
 ) -> List[str]:
     """return all the options given for a single attribute present in the metadata provider"""
     try:
-        return list(dataset.metadata.df[metadata_attribute].unique())
+        facet = ds.filter_index.facet_catalog[metadata_attribute]
     except KeyError as e:
         raise KeyError(f"Invalid metadata attribute {e} caused a key error.")
+    return [value for value, _ in facet]
 
 
-def get_all_metadata_attribute_options() -> Mapping[str, Sequence]:
+def get_all_metadata_attribute_options(
+    ds: DatasetProxy = dataset,
+) -> Mapping[str, Sequence]:
     """build a mapping from a metadata attribute to a list of all of its valid options in the ds."""
-    metadata_attributes = get_valid_metadata_attributes()
-    valid_metadata_attribute_options = {}
-    for attr in metadata_attributes:
-        valid_metadata_attribute_options[attr] = get_valid_metadata_attribute_options(
-            attr
-        )
-
-    return valid_metadata_attribute_options
+    return {
+        attr: [value for value, _ in facet]
+        for attr, facet in ds.filter_index.facet_catalog.items()
+    }
@@ -1,28 +1,58 @@
 from __future__ import annotations
 
+from typing import Any
+
 import orjson
 from flask import Blueprint
+from flask import Request
+from flask import Response
+from flask import abort
 from flask import jsonify
 from flask import render_template
+from flask import request
+from flask import stream_with_context
 
 from pavo._types import EndpointResponse
+from pavo.api.utils import InvalidFilterParameters
+from pavo.api.utils import get_records_filters
 from pavo.data import dataset
 from pavo.metadata.utils import get_valid_metadata_attribute_options
 from pavo.metadata.utils import get_valid_metadata_attributes
+from pavo.tabular import EXPORT_FORMATS
+from pavo.utils import check_numeric_list
+from pavo.utils import int_ge_0
+from pavo.utils import int_ge_1
 
 # view blueprint for metadata endpoints
 blueprint = Blueprint("metadata", __name__)
 
 
+# columns of the tabular records displayed on the metadata page
+DISPLAY_COLUMNS = [
+    "image_url",
+    "classification",
+    "annotation_type",
+    "annotator_type",
+    "annotator_name",
+    "annotation_metric",
+    "annotation_value",
+    "annotation_area",
+    "annotation_count",
+]
+
+
 @blueprint.route("/metadata")
 def index() -> EndpointResponse:
-    table_json = dataset.get_tabular_records_json()
     xcols_json = get_extra_columns_json()
+    # noinspection PyProtectedMember
+    xcolumns = [c["name"] for c in dataset._metadata_extra_columns or []]
+    available = set(dataset.get_tabular_records_index().columns)
+    record_columns = [c for c in DISPLAY_COLUMNS + xcolumns if c in available]
     return render_template(
         "metadata/index.html",
         page_title="Metadata",
-        metadata=table_json,
         extra_columns=xcols_json,
+        record_columns=orjson.dumps(record_columns).decode(),
     )
 
 
@@ -33,6 +63,141 @@ def get_extra_columns_json() -> str:
     return orjson.dumps([dict(c) for c in xcolumns]).decode()
 
 
+# ---- tabular records endpoints ----------------------------------------------
+
+RECORDS_MAX_LIMIT = 10_000
+
+
+def _unpack_filter_param(request: Request) -> dict[str, Any] | None:
+    """parse the json filter query parameter"""
+    filters = request.args.get("filter", None)
+    try:
+        filters = orjson.loads(filters) if filters else None
+    except orjson.JSONDecodeError as err:
+        abort(400, f"filter is not valid json: {err}")
+    if filters is not None and not isinstance(filters, dict):
+        abort(400, "filter must be a json object")
+    return filters
+
+
+def _unpack_records_params(request: Request) -> dict[str, Any]:
+    """parse the query parameters of the records endpoint"""
+    offset = request.args.get("offset", 0, type=int_ge_0)
+    limit = request.args.get("limit", 1_000, type=int_ge_1)
+    if limit > RECORDS_MAX_LIMIT:
+        abort(400, f"limit must be <= {RECORDS_MAX_LIMIT}")
+
+    sort = []
+    for key in request.args.get("sort", "").split(","):
+        if key:
+            sort.append((key.lstrip("-"), not key.startswith("-")))
+
+    columns = request.args.get("columns", None)
+    return {
+        "filters": _unpack_filter_param(request),
+        "sort": sort,
+        "columns": columns.split(",") if columns else None,
+        "offset": offset,
+        "limit": limit,
+    }
+
+
+@blueprint.route("/metadata/records", methods=["GET"])
+def records() -> EndpointResponse:
+    """return a page of the tabular records
+
+    Query parameters:
+      - offset, limit: the page of matching records
+      - sort: comma separated columns, prefixed with "-" for descending order
+      - columns: comma separated columns to return
+      - filter: json object mapping columns to a list of values, a value or
+        a {"min": ..., "max": ...} range
+
+    """
+    params = _unpack_records_params(request)
+    try:
+        total, page = dataset.get_tabular_records_index().query(**params)
+    except ValueError as err:
+        return f"Error: {err}", 400
+
+    # note: to_json serializes the page columnwise and handles missing values
+    records_json = page.to_json(orient="records")
+    body = (
+        f'{{"total":{total},"offset":{params["offset"]},'
+        f'"limit":{params["limit"]},"records":{records_json}}}'
+    )
+    return Response(body, mimetype="application/json")
+
+
+AGGREGATE_MAX_BINS = 1_000
+
+
+@blueprint.route("/metadata/aggregate", methods=["GET"])
+def aggregate() -> EndpointResponse:
+    """return aggregates of the tabular records per group
+
+    Query parameters:
+      - group_by: comma separated columns, e.g. classification,organ
+      - metrics: comma separated aggregations, "count" or "<agg>:<column>"
+        with agg one of sum, mean or histogram, e.g. mean:annotation_area
+      - bins: number of histogram bins
+      - filter: json object, see the records endpoint
+
+    """
+    group_by = request.args.get("group_by", "")
+    bins = request.args.get("bins", 10, type=int_ge_1)
+    if bins > AGGREGATE_MAX_BINS:
+        abort(400, f"bins must be <= {AGGREGATE_MAX_BINS}")
+    metrics = []
+    for metric in request.args.get("metrics", "count").split(","):
+        agg, _, column = metric.partition(":")
+        metrics.append((agg, column or None))
+
+    try:
+        result = dataset.get_tabular_records_index().aggregate(
+            group_by=[c for c in group_by.split(",") if c],
+            metrics=metrics,
+            filters=_unpack_filter_param(request),
+            bins=bins,
+        )
+    except ValueError as err:
+        return f"Error: {err}", 400
+    return jsonify(result), 200
+
+
+@blueprint.route("/metadata/export.<fmt>", methods=["GET"])
+def export(fmt: str) -> EndpointResponse:
+    """stream the tabular records as arrow ipc, parquet or csv
+
+    Query parameters:
+      - columns: comma separated columns to export
+      - filter: json object, see the records endpoint
+      - filename, metadata_key, metadata_values: see the slides endpoint
+
+    """
+    image_filter = {
+        "filename": request.args.get("filename", None),
+        "metadata_key": request.args.get("metadata_key", None),
+        "metadata_values": check_numeric_list(request.args.getlist("metadata_values")),
+    }
+    columns = request.args.get("columns", None)
+    try:
+        filters = get_records_filters(_unpack_filter_param(request), image_filter)
+        chunks = dataset.get_tabular_records_index().export(
+            fmt,
+            filters=filters,
+            columns=columns.split(",") if columns else None,
+        )
+    except (InvalidFilterParameters, ValueError) as err:
+        return f"Error: {err}", 400
+
+    return Response(
+        stream_with_context(chunks),
+        mimetype=EXPORT_FORMATS[fmt],
+        headers={"Content-Disposition": f"attachment; filename=records.{fmt}"},
+    )
+
+
 # ---- metadata endpoints -----------------------------------------------------
 
 
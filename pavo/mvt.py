@@ -0,0 +1,262 @@
+"""pavo.mvt encodes mapbox vector tiles
+
+A minimal encoder of the vector tile protobuf messages, see:
+https://github.com/mapbox/vector-tile-spec/tree/master/2.1
+
+Geometries are expected in integer tile coordinates, i.e. already
+clipped to the tile (plus buffer) and quantised to the tile extent.
+"""
+from __future__ import annotations
+
+from typing import Any
+from typing import Iterable
+from typing import NamedTuple
+
+import numpy as np
+
+__all__ = [
+    "MVT_EXTENT",
+    "MVTFeature",
+    "encode_layer",
+    "encode_tile",
+    "geometry_commands",
+    "split_collection",
+]
+
+MVT_EXTENT = 4096
+
+# geometry types
+_POINT = 1
+_LINESTRING = 2
+_POLYGON = 3
+
+# geometry command ids
+_MOVE_TO = 1
+_LINE_TO = 2
+_CLOSE_PATH = 7
+
+
+class MVTFeature(NamedTuple):
+    """a feature of a vector tile layer"""
+
+    id: int | None
+    type: int
+    geometry: list[int]  # encoded commands, see geometry_commands
+    properties: dict[str, Any]
+
+
+# --- protobuf wire format ----------------------------------------------------
+
+
+def _varint(value: int) -> bytes:
+    out = bytearray()
+    while True:
+        bits = value & 0x7F
+        value >>= 7
+        if value:
+            out.append(bits | 0x80)
+        else:
+            out.append(bits)
+            return bytes(out)
+
+
+def _zigzag(value: int) -> int:
+    return (value << 1) ^ (value >> 63)
+
+
+def _key(field: int, wire_type: int) -> bytes:
+    return _varint((field << 3) | wire_type)
+
+
+def _len_field(field: int, data: bytes) -> bytes:
+    return _key(field, 2) + _varint(len(data)) + data
+
+
+def _varint_field(field: int, value: int) -> bytes:
+    return _key(field, 0) + _varint(value)
+
+
+def _packed_field(field: int, values: Iterable[int]) -> bytes:
+    return _len_field(field, b"".join(map(_varint, values)))
+
+
+def _value(value: Any) -> bytes:
+    """encode a layer value message"""
+    if isinstance(value, bool):
+        return _varint_field(7, int(value))
+    elif isinstance(value, (int, np.integer)):
+        if value >= 0:
+            return _varint_field(5, int(value))
+        return _varint_field(6, _zigzag(int(value)))
+    elif isinstance(value, (float, np.floating)):
+        return _key(3, 1) + np.float64(value).tobytes()
+    return _len_field(1, str(value).encode())
+
+
+# --- geometry ----------------------------------------------------------------
+
+
+def _command(cmd: int, count: int) -> int:
+    return (cmd & 0x7) | (count << 3)
+
+
+def geometry_commands(geometry: Any) -> tuple[int, list[int]]:
+    """return the geometry type and the encoded commands of a geometry
+
+    Polygon rings are oriented as required by the spec: exterior rings
+    clockwise in the (y down) tile coordinate system, interior rings
+    counter-clockwise. Returns an empty command list for geometries
+    that collapse in tile coordinates.
+    """
+    import shapely
+    from shapely.geometry.polygon import orient
+
+    geom_type = geometry.geom_type
+    parts = shapely.get_parts(geometry)
+    commands: list[int] = []
+    cursor = [0, 0]
+
+    def _append(coords: np.ndarray, close: bool) -> None:
+        coords = np.asarray(coords, dtype=np.int64)
+        dx = np.diff(coords[:, 0], prepend=cursor[0])
+        dy = np.diff(coords[:, 1], prepend=cursor[1])
+        cursor[:] = coords[-1].tolist()
+        commands.append(_command(_MOVE_TO, 1))
+        commands.extend((_zigzag(int(dx[0])), _zigzag(int(dy[0]))))
+        if len(coords) > 1:
+            commands.append(_command(_LINE_TO, len(coords) - 1))
+            for x, y in zip(dx[1:].tolist(), dy[1:].tolist()):
+                commands.extend((_zigzag(x), _zigzag(y)))
+        if close:
+            commands.append(_command(_CLOSE_PATH, 1))
+
+    if geom_type in {"Point", "MultiPoint"}:
+        coords = shapely.get_coordinates(parts).astype(np.int64)
+        dx = np.diff(coords[:, 0], prepend=0)
+        dy = np.diff(coords[:, 1], prepend=0)
+        commands.append(_command(_MOVE_TO, len(coords)))
+        for x, y in zip(dx.tolist(), dy.tolist()):
+            commands.extend((_zigzag(x), _zigzag(y)))
+        return _POINT, commands
+
+    elif geom_type in {"LineString", "MultiLineString"}:
+        for line in parts:
+            coords = _dedupe(shapely.get_coordinates(line))
+            if len(coords) >= 2:
+                _append(coords, close=False)
+        return _LINESTRING, commands
+
+    elif geom_type in {"Polygon", "MultiPolygon"}:
+        for polygon in parts:
+            if polygon.is_empty:
+                continue
+            polygon = orient(polygon, sign=1.0)
+            rings = [polygon.exterior, *polygon.interiors]
+            for idx, ring in enumerate(rings):
+                # rings are implicitly closed, drop the closing coordinate
+                coords = _dedupe(shapely.get_coordinates(ring)[:-1])
+                if len(coords) < 3:
+                    if idx == 0:
+                        break  # the polygon collapsed
+                    continue
+                _append(coords, close=True)
+        return _POLYGON, commands
+
+    elif geom_type == "GeometryCollection":
+        raise ValueError("geometry collections must be split, see split_collection")
+    raise ValueError(f"unsupported geometry type {geom_type!r}")
+
+
+def split_collection(geometry: Any) -> list[Any]:
+    """return the polygonal, lineal and puntal parts of a geometry
+
+    Vector tile features have a single geometry type, so a geometry
+    collection is encoded as up to three features. Other geometries are
+    returned unchanged.
+    """
+    import shapely
+
+    if geometry.geom_type != "GeometryCollection":
+        return [geometry]
+    polygons: list[Any] = []
+    lines: list[Any] = []
+    points: list[Any] = []
+    stack = [geometry]
+    while stack:
+        for part in shapely.get_parts(stack.pop()).tolist():
+            geom_type = part.geom_type
+            if part.is_empty:
+                continue
+            elif geom_type == "GeometryCollection":
+                stack.append(part)
+            elif geom_type in {"Polygon", "MultiPolygon"}:
+                polygons.extend(shapely.get_parts(part).tolist())
+            elif geom_type in {"LineString", "MultiLineString", "LinearRing"}:
+                lines.extend(shapely.get_parts(part).tolist())
+            elif geom_type in {"Point", "MultiPoint"}:
+                points.extend(shapely.get_parts(part).tolist())
+    out: list[Any] = []
+    if polygons:
+        out.append(shapely.multipolygons(polygons))
+    if lines:
+        out.append(shapely.multilinestrings(lines))
+    if points:
+        out.append(shapely.multipoints(points))
+    return out
+
+
+def _dedupe(coords: np.ndarray) -> np.ndarray:
+    """drop repeated consecutive coordinates"""
+    if len(coords) < 2:
+        return coords
+    keep = np.ones(len(coords), dtype=bool)
+    keep[1:] = np.any(coords[1:] != coords[:-1], axis=1)
+    return coords[keep]
+
+
+# --- messages ----------------------------------------------------------------
+
+
+def encode_layer(
+    name: str,
+    features: Iterable[MVTFeature],
+    *,
+    extent: int = MVT_EXTENT,
+) -> bytes:
+    """encode a vector tile layer message"""
+    keys: dict[str, int] = {}
+    values: dict[tuple[type, Any], int] = {}
+    encoded = []
+    for feature in features:
+        if not feature.geometry:
+            continue
+        tags = []
+        for k, v in feature.properties.items():
+            if v is None:
+                continue
+            tags.append(keys.setdefault(k, len(keys)))
+            tags.append(values.setdefault((type(v), v), len(values)))
+        msg = b""
+        if feature.id is not None:
+            msg += _varint_field(1, feature.id)
+        if tags:
+            msg += _packed_field(2, tags)
+        msg += _varint_field(3, feature.type)
+        msg += _packed_field(4, feature.geometry)
+        encoded.append(_len_field(2, msg))
+
+    return b"".join(
+        [
+            _varint_field(15, 2),  # version
+            _len_field(1, name.encode()),
+            *encoded,
+            *(_len_field(3, k.encode()) for k in keys),
+            *(_len_field(4, _value(v)) for _, v in values),
+            _varint_field(5, extent),
+        ]
+    )
+
+
+def encode_tile(layers: Iterable[bytes]) -> bytes:
+    """encode a vector tile message from encoded layers"""
+    return b"".join(_len_field(3, layer) for layer in layers)
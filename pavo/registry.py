@@ -0,0 +1,71 @@
+"""pavo.registry interns the image ids of a dataset
+
+Every image of a dataset snapshot gets a dense integer handle: its
+position in the snapshot index. The registry stores the ImageId, its str
+form and its url id per handle, and looks up handles from any of them
+in constant time. Filters, indexes and caches can then work on integer
+arrays and only convert to ImageIds or urls at the edges.
+"""
+from __future__ import annotations
+
+import base64
+from typing import Any
+from typing import Collection
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+from pado.images import ImageId
+
+__all__ = [
+    "ImageIdRegistry",
+    "url_id",
+]
+
+
+def url_id(image_id_str: str) -> str:
+    """return the url id of an image id str
+
+    equivalent to itsdangerous.base64_encode(image_id_str).decode()
+    """
+    return base64.urlsafe_b64encode(image_id_str.encode()).rstrip(b"=").decode()
+
+
+class ImageIdRegistry:
+    """dense integer handles for the image ids of a dataset snapshot"""
+
+    def __init__(self, image_ids: Sequence[ImageId]) -> None:
+        self.image_ids = list(image_ids)
+        self.strs = np.array([i.to_str() for i in self.image_ids], dtype=object)
+        self.url_ids = np.array([url_id(s) for s in self.strs], dtype=object)
+        self._by_image_id = {i: h for h, i in enumerate(self.image_ids)}
+        self._by_str = pd.Index(self.strs)
+        self._by_url_id = {u: h for h, u in enumerate(self.url_ids)}
+
+    def __len__(self) -> int:
+        return len(self.image_ids)
+
+    def __contains__(self, image_id: object) -> bool:
+        return image_id in self._by_image_id
+
+    def handle(self, image_id: ImageId) -> int:
+        """return the handle of an image id, raises KeyError if unknown"""
+        return self._by_image_id[image_id]
+
+    def handle_from_url_id(self, value: str) -> int | None:
+        """return the handle of a url id or None"""
+        return self._by_url_id.get(value)
+
+    def handles_from_strs(self, image_id_strs: Collection[Any]) -> np.ndarray:
+        """return the handles of image id strs, -1 where unknown"""
+        return self._by_str.get_indexer(list(image_id_strs))
+
+    def image_ids_at(self, handles: Sequence[int] | np.ndarray) -> list[ImageId]:
+        """return the image ids of handles"""
+        image_ids = self.image_ids
+        return [image_ids[h] for h in handles]
+
+    def url_id_of(self, image_id: ImageId) -> str | None:
+        """return the precomputed url id of an image id or None"""
+        handle = self._by_image_id.get(image_id)
+        return None if handle is None else self.url_ids[handle]
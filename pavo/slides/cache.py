@@ -4,9 +4,15 @@ import enum
 import hashlib
 import os
 import shutil
+import tempfile
+import time
 from collections import OrderedDict
 from functools import lru_cache
 from pathlib import Path
+from typing import TYPE_CHECKING
+from typing import Iterable
+from typing import Iterator
+from typing import TypeVar
 
 from filelock import FileLock
 from filelock import Timeout as FileLockTimeout
@@ -14,6 +20,10 @@ from pado.io.files import urlpathlike_to_fs_and_path
 from pado.io.files import urlpathlike_to_string
 from pado.types import UrlpathLike
 
+if TYPE_CHECKING:
+    from pado.images import ImageId
+
+
 # --- slide caching -----------------------------------------------------------
 
 
@@ -118,3 +128,157 @@ class LocalWholeSlideCache:
             lhash, _ = self._mapping.popitem(last=False)
             pth = os.path.join(self.root, lhash)
             shutil.rmtree(pth, ignore_errors=True)
+
+
+# --- annotation caching ------------------------------------------------------
+
+# bump this whenever the annotation serialisations change
+ANNOTATION_CACHE_VERSION = 2
+
+
+# the version directories this process already pruned the others for
+_pruned_versions: set[str] = set()
+
+
+class _AnnotationFileCache:
+    """base class of the annotation caches on the local disk
+
+    Files are stored per dataset version, so that a refresh of the
+    dataset never serves stale annotations. The versions that were not
+    written to for MAX_VERSION_AGE seconds are removed, once a process
+    writes to a new version.
+    """
+
+    directory: str
+    MAX_VERSION_AGE = 600.0
+
+    def __init__(self, root: str | Path) -> None:
+        self.root = os.path.join(os.fspath(root), self.directory)
+
+    @classmethod
+    def from_cache_path(cls: type[_C], cache_path: UrlpathLike | None) -> _C | None:
+        """return a cache in cache_path if it is on the local filesystem"""
+        if not cache_path:
+            return None
+        fs, path = urlpathlike_to_fs_and_path(cache_path)
+        protocols = (fs.protocol,) if isinstance(fs.protocol, str) else fs.protocol
+        if "file" not in protocols:
+            return None
+        return cls(path)
+
+    def _version_path(self, version: str) -> str:
+        return os.path.join(self.root, f"{version}.v{ANNOTATION_CACHE_VERSION}")
+
+    def _image_path(self, version: str, image_id: ImageId, *parts: str) -> str:
+        ihash = hashlib.sha256(image_id.to_str().encode()).hexdigest()[:32]
+        return os.path.join(self._version_path(version), ihash[:2], ihash, *parts)
+
+    def _written(self, version: str) -> None:
+        """mark a version as in use and prune the others on its first write"""
+        path = self._version_path(version)
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            return
+        if path not in _pruned_versions:
+            _pruned_versions.add(path)
+            self.prune(keep=version)
+
+    def prune(self, keep: str | None = None) -> None:
+        """remove the versions that were not written to for MAX_VERSION_AGE"""
+        keep_path = None if keep is None else self._version_path(keep)
+        now = time.time()
+        for fn in os.listdir(self.root):
+            path = os.path.join(self.root, fn)
+            if path == keep_path:
+                continue
+            try:
+                age = now - os.stat(path).st_mtime
+            except FileNotFoundError:
+                continue
+            if age > self.MAX_VERSION_AGE:
+                shutil.rmtree(path, ignore_errors=True)
+
+
+_C = TypeVar("_C", bound=_AnnotationFileCache)
+
+
+class AnnotationTileCache(_AnnotationFileCache):
+    """caches encoded annotation vector tiles on the local disk"""
+
+    directory = "annotation_tiles"
+
+    def _path(
+        self, version: str, image_id: ImageId, level: int, col: int, row: int
+    ) -> str:
+        return self._image_path(version, image_id, str(level), f"{col}_{row}.mvt")
+
+    def get(
+        self, version: str, image_id: ImageId, level: int, col: int, row: int
+    ) -> bytes | None:
+        """return a cached tile or None"""
+        try:
+            with open(self._path(version, image_id, level, col, row), "rb") as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+    def put(
+        self,
+        version: str,
+        image_id: ImageId,
+        level: int,
+        col: int,
+        row: int,
+        data: bytes,
+    ) -> None:
+        """store a tile, concurrent writers of the same tile are fine"""
+        path = self._path(version, image_id, level, col, row)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                f.write(data)
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+        self._written(version)
+
+
+class AnnotationSerializationCache(_AnnotationFileCache):
+    """caches serialized annotations of an image on the local disk
+
+    Serializations are written while they are streamed to the first
+    client and only become visible once they are complete.
+    """
+
+    directory = "annotation_serializations"
+
+    def get_path(self, version: str, image_id: ImageId, fmt: str) -> str | None:
+        """return the path of a cached serialization or None"""
+        path = self._image_path(version, image_id, f"annotations.{fmt}")
+        return path if os.path.isfile(path) else None
+
+    def write_through(
+        self, version: str, image_id: ImageId, fmt: str, chunks: Iterable[bytes]
+    ) -> Iterator[bytes]:
+        """yield the chunks and store them if they are consumed completely"""
+        path = self._image_path(version, image_id, f"annotations.{fmt}")
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        fd, tmp = tempfile.mkstemp(dir=os.path.dirname(path), suffix=".tmp")
+        try:
+            with os.fdopen(fd, "wb") as f:
+                for chunk in chunks:
+                    f.write(chunk)
+                    yield chunk
+        except BaseException:
+            # the client went away or serialization failed
+            os.unlink(tmp)
+            raise
+        try:
+            os.replace(tmp, path)
+        except OSError:
+            os.unlink(tmp)
+            raise
+        self._written(version)
@@ -1,18 +1,24 @@
 from __future__ import annotations
 
+import base64
 import hashlib
 import io
 import math
 import os
+import threading
+import time
 from typing import TYPE_CHECKING
+from typing import Iterator
 from typing import List
 from typing import Mapping
 from typing import NamedTuple
 from typing import Optional
 from typing import Sequence
 from typing import Tuple
+from xml.etree import ElementTree
 
 import fsspec
+import numpy as np
 from flask import current_app
 from pado.images import Image
 from pado.images import ImageId
@@ -22,10 +28,14 @@ from pado.types import UrlpathLike
 from PIL import Image as PILImage
 from werkzeug.datastructures import ImmutableMultiDict
 
-from pavo.api.utils import get_filtered_image_ids
+from pavo.api.utils import get_filtered_positions
 
 if TYPE_CHECKING:
     from pavo.data import DatasetProxy
+    from pavo.data import DatasetSnapshot
+    from pavo.data import GroupedSnapshot
+    from pavo.slides.cache import AnnotationTileCache
+    from pavo.spatial import AnnotationSummary
 
 
 # --- pagination --------------------------------------------------------------
@@ -34,6 +44,8 @@ if TYPE_CHECKING:
 class ImageIdImagePair(NamedTuple):
     id: ImageId
     image: Image
+    placeholder: Optional[str] = None
+    annotations: Optional[AnnotationSummary] = None
 
 
 class PaginatedItems(NamedTuple):
@@ -48,16 +60,28 @@ def get_paginated_images(
     """return filtered and paginated Images"""
     if filter is None:
         filter = {}
-    ds_index = get_filtered_image_ids(filter, ds)
+    filter_index = ds.filter_index
+    positions = get_filtered_positions(
+        filter,
+        filter_index,
+        records=ds.get_tabular_records_index,
+        version=ds.version,
+    )
     idx_start = page * page_size
     idx_end = page * page_size + page_size
     ds_images = ds.images
-    image_ids = ds_index[idx_start:idx_end]
+    summaries = ds.annotation_summaries
+    image_ids = filter_index.image_ids_at(positions[idx_start:idx_end])
     return PaginatedItems(
         page=page,
-        pages=math.ceil(len(ds_index) / page_size),
+        pages=math.ceil(len(positions) / page_size),
         items=[
-            ImageIdImagePair(id=image_id, image=ds_images[image_id])
+            ImageIdImagePair(
+                id=image_id,
+                image=ds_images[image_id],
+                placeholder=get_thumbnail_placeholder(image_id),
+                annotations=summaries.get(image_id),
+            )
             for image_id in image_ids
         ],
     )
@@ -122,6 +146,8 @@ def thumbnail_image(
 
         square = PILImage.new("RGBA", size, (255, 255, 255, 0))
         square.paste(img, ((size[0] - img.size[0]) // 2, (size[1] - img.size[1]) // 2))
+        if size == _sizes[0]:
+            thumbnail_placeholders.set(image_id, placeholder_grid(square))
 
         with io.BytesIO() as f:
             square.save(f, format="png", optimize=True, compress_level=9)
@@ -141,6 +167,209 @@ def thumbnail_image(
             raise
 
 
+# --- placeholders ------------------------------------------------------------
+
+PLACEHOLDER_GRID = 4
+
+
+def placeholder_grid(img: PILImage.Image, grid: int = PLACEHOLDER_GRID) -> np.ndarray:
+    """return the average colours of a grid x grid subdivision of the image"""
+    background = PILImage.new("RGBA", img.size, (255, 255, 255, 255))
+    rgb = PILImage.alpha_composite(background, img.convert("RGBA")).convert("RGB")
+    small = rgb.resize((grid, grid), resample=PILImage.Resampling.BOX)
+    return np.asarray(small, dtype=np.uint8)
+
+
+class ThumbnailPlaceholderIndex:
+    """in-memory, array backed index of low quality image placeholders
+
+    Stores one `grid x grid` rgb average colour grid per image in a single
+    contiguous uint8 array. The placeholders are embedded into paginated
+    slide listings, so that grids can be painted before thumbnails arrive.
+    Their data uris are encoded once, images without a thumbnail are
+    remembered for MISSING_TTL seconds.
+    """
+
+    MISSING_TTL = 30.0
+
+    def __init__(self, grid: int = PLACEHOLDER_GRID, capacity: int = 1024) -> None:
+        self.grid = int(grid)
+        self._rows: dict[ImageId, int] = {}
+        self._data = np.zeros((capacity, self.grid, self.grid, 3), dtype=np.uint8)
+        self._uris: dict[ImageId, str] = {}
+        self._missing: dict[ImageId, float] = {}
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def __contains__(self, image_id: object) -> bool:
+        return image_id in self._rows
+
+    def set(self, image_id: ImageId, colors: np.ndarray) -> None:
+        """store the placeholder grid for an image"""
+        if colors.shape != (self.grid, self.grid, 3):
+            raise ValueError(f"expected grid shape {(self.grid, self.grid, 3)!r}")
+        with self._lock:
+            try:
+                row = self._rows[image_id]
+            except KeyError:
+                row = len(self._rows)
+                if row >= self._data.shape[0]:
+                    self._data = np.concatenate([self._data, np.zeros_like(self._data)])
+            self._data[row] = colors
+            self._rows[image_id] = row
+            self._uris.pop(image_id, None)
+            self._missing.pop(image_id, None)
+
+    def set_missing(self, image_id: ImageId) -> None:
+        """remember that an image has no thumbnail yet"""
+        with self._lock:
+            self._missing[image_id] = time.monotonic() + self.MISSING_TTL
+
+    def is_missing(self, image_id: ImageId) -> bool:
+        """true if an image had no thumbnail within the last MISSING_TTL seconds"""
+        with self._lock:
+            expires = self._missing.get(image_id)
+            if expires is None:
+                return False
+            if expires < time.monotonic():
+                del self._missing[image_id]
+                return False
+            return True
+
+    def get(self, image_id: ImageId) -> np.ndarray | None:
+        """return the placeholder grid for an image or None"""
+        with self._lock:
+            try:
+                row = self._rows[image_id]
+            except KeyError:
+                return None
+            return self._data[row].copy()
+
+    def data_uri(self, image_id: ImageId) -> str | None:
+        """return the placeholder as a tiny png data uri"""
+        with self._lock:
+            uri = self._uris.get(image_id)
+            if uri is not None:
+                return uri
+            try:
+                row = self._rows[image_id]
+            except KeyError:
+                return None
+            # encoding a grid x grid png is cheap, it's done under the lock
+            # so that a concurrent set can't be overwritten by a stale uri
+            with io.BytesIO() as f:
+                PILImage.fromarray(self._data[row], mode="RGB").save(f, format="png")
+                data = base64.b64encode(f.getvalue()).decode()
+            uri = self._uris[image_id] = f"data:image/png;base64,{data}"
+            return uri
+
+
+thumbnail_placeholders = ThumbnailPlaceholderIndex()
+
+
+def get_thumbnail_placeholder(
+    image_id: ImageId,
+    *,
+    index: ThumbnailPlaceholderIndex = thumbnail_placeholders,
+) -> str | None:
+    """return a placeholder data uri for an image if its thumbnail exists
+
+    Thumbnails that were created by another process (cli or worker) are
+    picked up from the smallest cached thumbnail on first access.
+    """
+    if image_id not in index:
+        if index.is_missing(image_id):
+            return None
+        fs, path = thumbnail_fs_and_path(image_id, size=min(THUMBNAIL_SIZES))
+        try:
+            with fsopen(fs, path, mode="rb") as f:
+                img = PILImage.open(f)
+                img.load()
+        except (FileNotFoundError, OSError):
+            index.set_missing(image_id)
+            return None
+        index.set(image_id, placeholder_grid(img, grid=index.grid))
+    return index.data_uri(image_id)
+
+
+# --- annotation tiles --------------------------------------------------------
+
+
+class DeepZoomGrid(NamedTuple):
+    """the tile grid of the deep zoom pyramid of a slide"""
+
+    tile_size: int
+    level_size: Mapping[int, Tuple[int, int]]  # number of tiles per level
+
+    @classmethod
+    def from_dzi(
+        cls, dzi: str, level_size: Mapping[int, Tuple[int, int]]
+    ) -> DeepZoomGrid:
+        tile_size = int(ElementTree.fromstring(dzi).attrib["TileSize"])
+        return cls(tile_size=tile_size, level_size=level_size)
+
+    @property
+    def max_level(self) -> int:
+        """the full resolution level"""
+        return max(self.level_size)
+
+    def downsample(self, level: int) -> float:
+        """return the full resolution pixels per pixel of level"""
+        if level not in self.level_size:
+            raise ValueError(f"invalid level {level}")
+        return float(2 ** (self.max_level - level))
+
+    def tile_bounds(self, level: int, col: int, row: int) -> Tuple[float, ...]:
+        """return the full resolution bounds of a tile"""
+        cols, rows = self.level_size[level] if level in self.level_size else (0, 0)
+        if not (0 <= col < cols and 0 <= row < rows):
+            raise ValueError(f"invalid tile {level}/{col}_{row}")
+        size = self.tile_size * self.downsample(level)
+        return col * size, row * size, (col + 1) * size, (row + 1) * size
+
+    def tiles_in(
+        self, level: int, bounds: Sequence[float]
+    ) -> Iterator[Tuple[int, int]]:
+        """yield the col and row of the tiles of level intersecting bounds"""
+        size = self.tile_size * self.downsample(level)
+        cols, rows = self.level_size[level]
+        col0, row0 = max(int(bounds[0] // size), 0), max(int(bounds[1] // size), 0)
+        col1 = min(int(bounds[2] // size) + 1, cols)
+        row1 = min(int(bounds[3] // size) + 1, rows)
+        for col in range(col0, col1):
+            for row in range(row0, row1):
+                yield col, row
+
+
+def get_annotation_tile(
+    snapshot: DatasetSnapshot | GroupedSnapshot,
+    image_id: ImageId,
+    level: int,
+    col: int,
+    row: int,
+    grid: DeepZoomGrid,
+    *,
+    tile_cache: AnnotationTileCache | None = None,
+) -> bytes:
+    """return the annotation vector tile of a deep zoom tile
+
+    Raises KeyError if the image has no annotations and ValueError for
+    tiles outside of the grid.
+    """
+    bounds = grid.tile_bounds(level, col, row)
+    if tile_cache is not None:
+        data = tile_cache.get(snapshot.version, image_id, level, col, row)
+        if data is not None:
+            return data
+    index = snapshot.annotation_indexes[image_id]
+    data = index.mvt_tile(bounds, downsample=grid.downsample(level))
+    if tile_cache is not None:
+        tile_cache.put(snapshot.version, image_id, level, col, row, data)
+    return data
+
+
 # --- filtering ---------------------------------------------------------------
 
 
@@ -1,12 +1,17 @@
 from __future__ import annotations
 
+import hashlib
+import math
 import re
 import uuid
 from typing import TYPE_CHECKING
 from typing import Any
+from typing import Iterator
 
+import orjson
 from flask import Blueprint
 from flask import Request
+from flask import Response
 from flask import abort
 from flask import current_app
 from flask import jsonify
@@ -15,7 +20,6 @@ from flask import render_template
 from flask import request
 from flask import send_file
 from pado.annotations import Annotation
-from pado.annotations import Annotations
 from pado.images.providers import image_cached_percentage
 from pado.images.providers import image_is_cached_or_local
 from pado.io.files import fsopen
@@ -28,19 +32,32 @@ from pado.predictions.providers import ImagePredictions
 from tiffslide.deepzoom import MinimalComputeAperioDZGenerator
 
 from pavo._types import EndpointResponse
+from pavo.api.utils import InvalidFilterParameters
+from pavo.api.utils import get_filtered_positions
 from pavo.data import DatasetState
 from pavo.data import dataset
 from pavo.extensions import cache
 from pavo.metadata.utils import get_all_metadata_attribute_options
+from pavo.slides.cache import ANNOTATION_CACHE_VERSION
+from pavo.slides.cache import AnnotationSerializationCache
+from pavo.slides.cache import AnnotationTileCache
+from pavo.slides.utils import DeepZoomGrid
+from pavo.slides.utils import PaginatedItems
+from pavo.slides.utils import get_annotation_tile
 from pavo.slides.utils import get_paginated_images
 from pavo.slides.utils import thumbnail_fs_and_path
 from pavo.slides.utils import thumbnail_image
+from pavo.spatial import AnnotationSelection
+from pavo.spatial import AnnotationSpatialIndex
+from pavo.spatial import annotation_arrow_chunks
 from pavo.utils import check_numeric_list
 from pavo.utils import int_ge_0
 from pavo.utils import int_ge_1
+from pavo.utils import json_array_chunks
 
 if TYPE_CHECKING:
     from pado.images import ImageId
+    from shapely.geometry.base import BaseGeometry
 
 
 # view blueprint for slide endpoints
@@ -63,17 +80,28 @@ def _unpack_filter_params(request: Request) -> tuple[int, int, dict[str, Any]]:
         "filename": request.args.get("filename", None),
         "metadata_key": request.args.get("metadata_key", None),
         "metadata_values": check_numeric_list(request.args.getlist("metadata_values")),
+        "query": request.args.get("query", None),
+        "order": request.args.get("order", None) or current_app.config["SLIDES_ORDER"],
     }
 
     return page, page_size, filter
 
 
+def _get_paginated_images(
+    page: int, page_size: int, filter: dict[str, Any]
+) -> PaginatedItems:
+    try:
+        return get_paginated_images(
+            dataset, page=page, page_size=page_size, filter=filter
+        )
+    except InvalidFilterParameters as e:
+        abort(400, f"{e}")
+
+
 @blueprint.route("/")
 def index() -> EndpointResponse:
     page, page_size, filter = _unpack_filter_params(request)
-    page_images = get_paginated_images(
-        dataset, page=page, page_size=page_size, filter=filter
-    )
+    page_images = _get_paginated_images(page, page_size, filter)
 
     return render_template(
         "slides/index.html",
@@ -89,9 +117,7 @@ def index() -> EndpointResponse:
 @blueprint.route("/thumbnails", methods=["GET"])
 def thumbnails() -> EndpointResponse:
     page, page_size, filter = _unpack_filter_params(request)
-    page_images = get_paginated_images(
-        dataset, page=page, page_size=page_size, filter=filter
-    )
+    page_images = _get_paginated_images(page, page_size, filter)
 
     return render_template(
         "slides/thumbnails.html",
@@ -104,6 +130,43 @@ def thumbnails() -> EndpointResponse:
     )
 
 
+@blueprint.route("/facets", methods=["GET"])
+def facets() -> EndpointResponse:
+    """return the metadata values with their image counts
+
+    Query parameters:
+      - keys: comma separated metadata keys (default: all)
+      - the filter parameters of the slides index: counts are restricted
+        to the matching images (drill-down)
+
+    """
+    _, _, filter = _unpack_filter_params(request)
+    keys = request.args.get("keys", None)
+    filter_index = dataset.filter_index
+    try:
+        if any(
+            filter[k] for k in ("filename", "metadata_key", "metadata_values", "query")
+        ):
+            positions = get_filtered_positions(
+                filter,
+                filter_index,
+                records=dataset.get_tabular_records_index,
+                version=dataset.version,
+            )
+        else:
+            positions = None
+        result = filter_index.facets(keys.split(",") if keys else None, positions)
+    except (InvalidFilterParameters, KeyError) as e:
+        return f"Error: {e}", 400
+
+    return jsonify(
+        {
+            key: [{"value": value, "count": count} for value, count in facet]
+            for key, facet in result.items()
+        }
+    )
+
+
 @blueprint.route("/thumbnail_<image_id:image_id>_<int:size>.jpg")
 def thumbnail(image_id: ImageId, size: int) -> EndpointResponse:
     if size not in {100, 200}:
@@ -151,7 +214,7 @@ def viewer_openseadragon(image_id: ImageId) -> EndpointResponse:
     show_image_predictions = request.args.getlist("show_image_predictions", int)
 
     # check if we have annotations
-    has_annotations = len(dataset.annotations.get(image_id, [])) > 0
+    has_annotations = image_id in dataset.annotation_summaries
 
     # get a list of the image_predictions
     image_predictions = []
@@ -283,41 +346,308 @@ def slide_tile(image_id: ImageId, level: int, col: int, row: int) -> EndpointRes
 
 @blueprint.route("/viewer/<image_id:image_id>/annotations.geojson")
 def serve_geojson_annotations(image_id: ImageId) -> EndpointResponse:
+    """return the annotations of an image as a geojson FeatureCollection
+
+    With the level of detail parameters (see `_annotation_lod_response`)
+    geometries are simplified and small annotations are clustered.
+    """
+    if _has_lod_params(request):
+        return _annotation_lod_response(image_id, "geojson")
+    return _annotation_serialization_response(image_id, "geojson")
+
+
+@blueprint.route("/viewer/<image_id:image_id>/annotations.json")
+def serve_w3c_annotations(image_id: ImageId) -> EndpointResponse:
+    """return the annotations of an image as w3c annotations
+
+    With the level of detail parameters (see `_annotation_lod_response`)
+    geometries are simplified and small annotations are omitted.
+    """
+    if _has_lod_params(request):
+        return _annotation_lod_response(image_id, "json")
+    return _annotation_serialization_response(image_id, "json")
+
+
+def _annotation_etag(version: str, image_id: ImageId, fmt: str) -> str:
+    """the etag of an annotation response of the current request"""
+    args = sorted(request.args.items(multi=True))
+    key = orjson.dumps(
+        [version, ANNOTATION_CACHE_VERSION, image_id.to_str(), fmt, args]
+    )
+    return hashlib.sha256(key).hexdigest()[:32]
+
+
+def _not_modified(etag: str) -> Response | None:
+    """return a 304 response if the client has the current representation"""
+    if not request.if_none_match.contains_weak(etag):
+        return None
+    response = Response(status=304)
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+def _annotation_serialization_response(image_id: ImageId, fmt: str) -> Response:
+    """stream all annotations of an image as json
+
+    Serializations are cached on disk per dataset version (if the cache
+    path is local) and carry an etag, so that repeated requests are
+    served from the cache or answered with 304 Not Modified.
+    """
+    snapshot = dataset.snapshot
+    etag = _annotation_etag(snapshot.version, image_id, fmt)
+    response = _not_modified(etag)
+    if response is not None:
+        return response
+
+    serialization_cache = AnnotationSerializationCache.from_cache_path(
+        current_app.config.get("CACHE_PATH")
+    )
+    path = None
+    if serialization_cache is not None:
+        path = serialization_cache.get_path(snapshot.version, image_id, fmt)
+
+    if path is not None:
+        response = send_file(path, mimetype="application/json", etag=False)
+    else:
+        try:
+            index = snapshot.annotation_indexes[image_id]
+        except KeyError:
+            abort(404, f"No annotations found for {image_id!r}")
+        chunks = _annotation_json_chunks(index, fmt)
+        if serialization_cache is not None:
+            chunks = serialization_cache.write_through(
+                snapshot.version, image_id, fmt, chunks
+            )
+        response = Response(chunks, mimetype="application/json")
+
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
+
+
+def _annotation_json_chunks(index: AnnotationSpatialIndex, fmt: str) -> Iterator[bytes]:
+    """serialize all annotations of an index as geojson or w3c annotations"""
+    positions = index.query()
+    if fmt == "geojson":
+        return json_array_chunks(
+            index.geojson_features(positions),
+            head=b'{"type":"FeatureCollection","features":[',
+            tail=b"]}",
+        )
+    return json_array_chunks(
+        w3c_like_region(
+            index.geometries[pos], index.classifications[pos], uid=str(index.ids[pos])
+        )
+        for pos in positions.tolist()
+    )
+
+
+@blueprint.route(
+    "/viewer/<image_id:image_id>/annotations/viewport.<any(geojson, json):fmt>"
+)
+def serve_viewport_annotations(image_id: ImageId, fmt: str) -> EndpointResponse:
+    """return the annotations intersecting a viewport
+
+    Query parameters:
+      - bbox: "x0,y0,x1,y1" in full resolution slide pixels
+      - the level of detail parameters (see `_annotation_lod_response`)
+
+    Returns a geojson FeatureCollection or a list of w3c annotations.
+    Features have ids derived from their content, which are stable
+    across annotation writes, so viewers can request annotations
+    incrementally while panning and skip the ones they already have.
+    """
+    bbox = _unpack_bbox(request)
+    if bbox is None:
+        return abort(400, "bbox is required")
+    return _annotation_lod_response(image_id, fmt, bbox)
+
+
+@blueprint.route("/viewer/<image_id:image_id>/annotations.arrow")
+def serve_arrow_annotations(image_id: ImageId) -> EndpointResponse:
+    """stream the annotations of an image as an arrow ipc stream
+
+    Geometries are flat coordinate arrays with offsets (geoarrow) and the
+    properties are separate columns: id, classification, color, area and
+    predicted. Takes an optional bbox and the level of detail parameters
+    (see `_annotation_lod_response`), small annotations are omitted.
+    """
+    bbox = _unpack_bbox(request)
+    index, selection = _select_annotations(image_id, bbox, clusters=False)
+    return Response(
+        annotation_arrow_chunks(index, selection),
+        mimetype="application/vnd.apache.arrow.stream",
+        headers={
+            "X-Annotation-Count": str(len(selection.positions)),
+            "X-Annotation-Vertices": str(selection.vertices),
+            "X-Annotation-Vertices-Full": str(selection.vertices_full),
+        },
+    )
+
+
+def _has_lod_params(request: Request) -> bool:
+    return any(k in request.args for k in ("level", "tolerance", "clusters"))
+
+
+def _unpack_bbox(request: Request) -> list[float] | None:
+    if "bbox" not in request.args:
+        return None
     try:
-        annotations: Annotations = dataset.annotations[image_id]
+        bbox = [float(x) for x in request.args["bbox"].split(",")]
+        if len(bbox) != 4 or bbox[0] > bbox[2] or bbox[1] > bbox[3]:
+            raise ValueError(bbox)
+    except ValueError:
+        abort(400, "bbox must be x0,y0,x1,y1 with x0 <= x1 and y0 <= y1")
+    return bbox
+
+
+def _select_annotations(
+    image_id: ImageId, bbox: list[float] | None, *, clusters: bool
+) -> tuple[AnnotationSpatialIndex, AnnotationSelection]:
+    """select the annotations of the level of detail request parameters"""
+    level = request.args.get("level", default=None, type=int_ge_0)
+    tolerance = request.args.get("tolerance", default=None, type=float)
+    clusters &= bool(request.args.get("clusters", default=1, type=int))
+    if tolerance is not None and not tolerance >= 0:
+        abort(400, "tolerance must be >= 0")
+
+    try:
+        index = dataset.annotation_indexes[image_id]
     except KeyError:
-        return abort(404, f"No annotations found for {image_id!r}")
+        abort(404, f"No annotations found for {image_id!r}")
 
-    data = [
+    if level is None:
+        downsample = None
+    else:
+        try:
+            md = dataset.images[image_id].metadata
+        except (KeyError, RuntimeError) as err:
+            abort(404, str(err))
+        # the full resolution level of the deep zoom pyramid
+        max_level = math.ceil(math.log2(max(md.width, md.height, 1)))
+        if level > max_level:
+            abort(403, "requested level invalid")
+        downsample = float(2 ** (max_level - level))
+
+    selection = index.select(
+        bbox, downsample=downsample, tolerance=tolerance, clusters=clusters
+    )
+    return index, selection
+
+
+def _annotation_lod_response(
+    image_id: ImageId, fmt: str, bbox: list[float] | None = None
+) -> EndpointResponse:
+    """return the annotations of an image at a level of detail
+
+    Query parameters:
+      - level: the deep zoom level of the viewer. Annotations smaller than
+        a screen pixel at this level are omitted, or aggregated into point
+        clusters (geojson only), and geometries are simplified to half a
+        screen pixel.
+      - tolerance: the simplification tolerance in full resolution pixels,
+        overrides the tolerance of the level
+      - clusters: 0 omits small annotations instead of clustering them
+
+    The simplified geometries are computed once per level and cached with
+    the spatial index of the image. The vertex counts and the payload
+    size are reported in X-Annotation-* response headers.
+    """
+    etag = _annotation_etag(dataset.version, image_id, fmt)
+    not_modified = _not_modified(etag)
+    if not_modified is not None:
+        return not_modified
+
+    index, selection = _select_annotations(image_id, bbox, clusters=fmt == "geojson")
+
+    data: dict[str, Any] | list[dict[str, Any]]
+    if fmt == "geojson":
+        features = list(
+            index.geojson_features(selection.positions, selection.geometries)
+        )
+        if selection.clusters is not None:
+            features.extend(index.cluster_features(selection.clusters))
+        data = {"type": "FeatureCollection", "features": features}
+    else:
+        data = [
+            w3c_like_region(
+                geometry, index.classifications[pos], uid=str(index.ids[pos])
+            )
+            for pos, geometry in zip(selection.positions.tolist(), selection.geometries)
+        ]
+
+    response = jsonify(data)
+    num_clusters = 0 if selection.clusters is None else len(selection.clusters.ids)
+    response.headers.update(
         {
-            "type": "Feature",
-            "geometry": {
-                "type": "Polygon",
-                "coordinates": [list(annotation.geometry.exterior.coords)],
-            },
-            "properties": {
-                "classification": {
-                    "name": annotation.classification,
-                    "color": list(annotation.color.as_rgb_tuple(alpha=False)),
-                },
-                "area": annotation.geometry.area,
-                "object_type": "annotation",
-            },
+            "X-Annotation-Count": str(len(selection.positions)),
+            "X-Annotation-Clusters": str(num_clusters),
+            "X-Annotation-Vertices": str(selection.vertices),
+            "X-Annotation-Vertices-Full": str(selection.vertices_full),
+            "X-Annotation-Bytes": str(response.content_length),
         }
-        for annotation in annotations
-    ]
-    return jsonify({"type": "FeatureCollection", "features": data}), 200
+    )
+    response.set_etag(etag)
+    response.cache_control.no_cache = True
+    return response
 
 
-@blueprint.route("/viewer/<image_id:image_id>/annotations.json")
-def serve_w3c_annotations(image_id: ImageId) -> EndpointResponse:
+def annotation_tile_grid(image_id: ImageId) -> DeepZoomGrid:
+    """return the deep zoom tile grid of a slide as served by slide_tile"""
+    dz = _slide_get_deep_zoom_from_session(image_id)
+    return DeepZoomGrid.from_dzi(dz.get_dzi(), dz.level_size)
+
+
+@blueprint.route(
+    "/viewer/<image_id:image_id>/annotations/<int:level>/<int:col>_<int:row>.mvt"
+)
+def serve_annotation_tile(
+    image_id: ImageId, level: int, col: int, row: int
+) -> EndpointResponse:
+    """return the annotations of a deep zoom tile as a mapbox vector tile
+
+    The tiles are aligned with the tiles of slide_tile. Geometries are
+    clipped and quantised per tile, with the level of detail of the zoom
+    level, and the tiles are cached on disk per dataset version.
+    """
+    snapshot = dataset.snapshot
+    etag = _annotation_etag(snapshot.version, image_id, f"{level}/{col}_{row}.mvt")
+    # conditional requests are answered without opening the slide
+    not_modified = _not_modified(etag)
+    if not_modified is not None:
+        return not_modified
+    try:
+        grid = annotation_tile_grid(image_id)
+    except (KeyError, FileNotFoundError) as err:
+        return abort(404, str(err))
+
+    tile_cache = AnnotationTileCache.from_cache_path(
+        current_app.config.get("CACHE_PATH")
+    )
     try:
-        annotations: Annotations = dataset.annotations[image_id]
+        tile = get_annotation_tile(
+            snapshot, image_id, level, col, row, grid, tile_cache=tile_cache
+        )
     except KeyError:
         return abort(404, f"No annotations found for {image_id!r}")
+    except ValueError:
+        return abort(404, "tile not found")
 
-    w3c_annotations = [w3c_like_annotation(annotation) for annotation in annotations]
-    return jsonify(w3c_annotations), 200
+    resp = make_response(tile)
+    resp.mimetype = "application/vnd.mapbox-vector-tile"
+    resp.set_etag(etag)
+    resp.cache_control.no_cache = True
+    return resp
+
+
+# style information of svg paths, removed for w3c annotations
+_SVG_STYLE_RE = re.compile(
+    r'(fill|stroke)="#[0-9a-f]{6}" ?'
+    r'|fill-rule="evenodd" ?'
+    r'|(stroke-width|opacity)="[0-9]*([.][0-9]*)?" ?'
+)
+_CLASS_NAME_RE = re.compile("[^A-Za-z0-9]+")
 
 
 def w3c_like_annotation(annotation: Annotation, prefix: str = "anno") -> dict:
@@ -326,25 +656,31 @@ def w3c_like_annotation(annotation: Annotation, prefix: str = "anno") -> dict:
     see: https://www.w3.org/TR/annotation-vocab/#annotation
 
     """
+    return w3c_like_region(annotation.geometry, annotation.classification, prefix)
 
-    region = annotation.geometry
-    class_name = annotation.classification
-    safe_class_name = re.sub("[^A-Za-z0-9]+", "", class_name)
 
-    # remove style information from svg for w3c annotation
-    _svg_style_re = re.compile(
-        r'(fill|stroke)="#[0-9a-f]{6}" ?'
-        r'|fill-rule="evenodd" ?'
-        r'|(stroke-width|opacity)="[0-9]*([.][0-9]*)?" ?'
-    )
+def w3c_like_region(
+    region: BaseGeometry,
+    class_name: str,
+    prefix: str = "anno",
+    *,
+    uid: str | None = None,
+) -> dict:
+    """make a w3c annotation like annotation from a geometry
+
+    uid makes the annotation id stable, otherwise a random uuid is used.
+    """
+    if uid is None:
+        uid = str(uuid.uuid4())
+    safe_class_name = _CLASS_NAME_RE.sub("", class_name)
 
     svg_path = region.svg()
     # strip all style information
-    svg_path = _svg_style_re.sub("", svg_path)
+    svg_path = _SVG_STYLE_RE.sub("", svg_path)
 
     return {
         "@context": "http://www.w3.org/ns/anno.jsonld",
-        "id": f"{prefix}-{safe_class_name.replace(' ', '').replace(':', '')}-{uuid.uuid4()}",
+        "id": f"{prefix}-{safe_class_name.replace(' ', '').replace(':', '')}-{uid}",
         "type": "Annotation",
         "body": [
             {
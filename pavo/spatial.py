@@ -0,0 +1,786 @@
+"""pavo.spatial provides spatial indexes over the annotations of an image
+
+The annotations of an image are indexed by an STR-tree over their
+bounding boxes, so that the annotations in a viewport are found without
+looking at all annotations of the slide. Indexes are built on first
+access, kept in a bounded cache per dataset snapshot, and are replaced
+with the snapshot on refresh.
+
+Note: shapely is imported lazily to keep it out of the startup path.
+"""
+from __future__ import annotations
+
+import threading
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Collection
+from typing import Iterator
+from typing import Mapping
+from typing import NamedTuple
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+from pado.images import ImageId
+from pandas import DataFrame
+
+from pavo.mvt import MVT_EXTENT
+from pavo.mvt import MVTFeature
+from pavo.mvt import encode_layer
+from pavo.mvt import encode_tile
+from pavo.mvt import geometry_commands
+from pavo.mvt import split_collection
+from pavo.utils import ChunkSink
+
+if TYPE_CHECKING:
+    from pado.annotations import AnnotationProvider
+
+__all__ = [
+    "ARROW_BATCH_SIZE",
+    "AnnotationClusters",
+    "AnnotationIndexes",
+    "AnnotationSelection",
+    "AnnotationSpatialIndex",
+    "AnnotationSummary",
+    "AnnotationSummaryIndex",
+    "CLUSTER_SIZE",
+    "LOD_TOLERANCE",
+    "MVT_BUFFER",
+    "annotation_arrow_chunks",
+]
+
+# simplification tolerance of geometries in screen pixels
+LOD_TOLERANCE = 0.5
+# size of the grid cells in screen pixels that small annotations are
+# aggregated in at low zoom levels
+CLUSTER_SIZE = 64
+# buffer around vector tiles in tile extent units
+MVT_BUFFER = 64
+# number of annotations per record batch of the columnar export
+ARROW_BATCH_SIZE = 65_536
+
+
+def _geometries(values: Any) -> np.ndarray:
+    """return shapely geometries of wkt, wkb or shapely values"""
+    import shapely
+
+    values = np.asarray(values, dtype=object)
+    if not len(values):
+        return values
+    elif isinstance(values[0], str):
+        return shapely.from_wkt(values)
+    elif isinstance(values[0], bytes):
+        return shapely.from_wkb(values)
+    return values
+
+
+def _rgb(colors: Any) -> np.ndarray:
+    """return the rgb tuples of color strs, parsing each distinct color once"""
+    from pydantic.color import Color
+
+    codes, uniques = pd.factorize(np.asarray(colors, dtype=object))
+    table = np.array(
+        [Color(c).as_rgb_tuple(alpha=False) for c in uniques] + [(0, 0, 0)],
+        dtype=np.uint8,
+    ).reshape(-1, 3)
+    return table[codes]
+
+
+def _annotator_types(annotators: Any) -> np.ndarray:
+    """return the annotator type of annotator dicts or json strs"""
+    import orjson
+
+    def _type(annotator: Any) -> Any:
+        if isinstance(annotator, (str, bytes)):
+            try:
+                annotator = orjson.loads(annotator)
+            except orjson.JSONDecodeError:
+                return None
+        if isinstance(annotator, dict):
+            return annotator.get("type")
+        return None
+
+    return np.array([_type(a) for a in annotators], dtype=object)
+
+
+def _annotation_ids(
+    geometries: np.ndarray, classifications: np.ndarray, annotators: Any
+) -> np.ndarray:
+    """return content derived ids of annotations
+
+    The ids don't change when annotations are inserted or removed. They
+    are 53 bit integers, so that they are exact in javascript. Identical
+    annotations are told apart by their occurrence.
+    """
+    import shapely
+
+    content = pd.DataFrame(
+        {
+            "geometry": shapely.to_wkb(geometries, hex=True),
+            "classification": pd.Series(classifications, dtype=object).astype(str),
+            "annotator": pd.Series(annotators, dtype=object).astype(str),
+        }
+    )
+    ids = pd.util.hash_pandas_object(content, index=False).to_numpy()
+    occurrence = pd.Series(ids).groupby(ids).cumcount().to_numpy()
+    if occurrence.any():
+        ids = pd.util.hash_pandas_object(
+            pd.DataFrame({"id": ids, "occurrence": occurrence}), index=False
+        ).to_numpy()
+    return ids >> np.uint64(11)
+
+
+class AnnotationClusters(NamedTuple):
+    """point clusters of annotations too small to show at a zoom level"""
+
+    ids: list[str]
+    x: np.ndarray
+    y: np.ndarray
+    counts: np.ndarray
+    classes: np.ndarray  # position of a representative annotation
+
+
+class AnnotationSelection(NamedTuple):
+    """the annotations to show in a viewport at a level of detail"""
+
+    positions: np.ndarray
+    geometries: np.ndarray  # aligned with positions, possibly simplified
+    clusters: AnnotationClusters | None
+    vertices: int  # number of coordinates of the geometries
+    vertices_full: int  # ... at full resolution, including clustered ones
+
+
+class AnnotationSpatialIndex:
+    """an STR-tree over the annotations of an image
+
+    Annotations are addressed by their position in the annotation
+    provider of the image. The ids in the serialisations are derived from
+    their content instead, so they are stable across writes. Simplified
+    geometries are computed for all annotations once per tolerance (i.e.
+    per pyramid level) and cached.
+    """
+
+    MAX_CACHED_TOLERANCES = 32
+
+    def __init__(self, df: DataFrame) -> None:
+        import shapely
+
+        self.geometries = _geometries(df["geometry"].to_numpy(dtype=object))
+        self.classifications = df["classification"].to_numpy(dtype=object)
+        self.colors = _rgb(df["color"])
+        if "annotator" in df.columns:
+            annotators = df["annotator"].to_numpy(dtype=object)
+            self.predicted = _annotator_types(annotators) == "model"
+        else:
+            annotators = np.full(len(df), None, dtype=object)
+            self.predicted = np.zeros(len(df), dtype=bool)
+        self.ids = _annotation_ids(self.geometries, self.classifications, annotators)
+        self.bounds = shapely.bounds(self.geometries).reshape(-1, 4)
+        self.areas = shapely.area(self.geometries)
+        self.num_coordinates = shapely.get_num_coordinates(self.geometries)
+        self.tree = shapely.STRtree(self.geometries)
+        self._class_codes, _ = pd.factorize(self.classifications)
+        self._simplified: OrderedDict[float, tuple[np.ndarray, np.ndarray]]
+        self._simplified = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.geometries)
+
+    @property
+    def total_bounds(self) -> tuple[float, float, float, float] | None:
+        """the bounding box of all annotations"""
+        if not len(self):
+            return None
+        x0, y0 = np.nanmin(self.bounds[:, :2], axis=0)
+        x1, y1 = np.nanmax(self.bounds[:, 2:], axis=0)
+        return float(x0), float(y0), float(x1), float(y1)
+
+    def query(
+        self,
+        bbox: Sequence[float] | None = None,
+        *,
+        min_size: float = 0,
+    ) -> np.ndarray:
+        """return the sorted positions of the annotations intersecting bbox
+
+        Annotations whose bounding box is smaller than min_size in both
+        width and height are omitted, i.e. ones that would be smaller than
+        a screen pixel at the requested zoom level.
+        """
+        import shapely
+
+        if bbox is None:
+            positions = np.arange(len(self))
+        else:
+            positions = self.tree.query(shapely.box(*bbox), predicate="intersects")
+            positions.sort()
+        if min_size > 0:
+            positions = positions[self._sizes(positions) >= min_size]
+        return positions
+
+    def _sizes(self, positions: np.ndarray) -> np.ndarray:
+        b = self.bounds[positions]
+        return np.maximum(b[:, 2] - b[:, 0], b[:, 3] - b[:, 1])
+
+    def simplified(self, tolerance: float) -> tuple[np.ndarray, np.ndarray]:
+        """return the geometries and their coordinate counts simplified to tolerance"""
+        import shapely
+
+        if tolerance <= 0:
+            return self.geometries, self.num_coordinates
+        with self._lock:
+            try:
+                self._simplified.move_to_end(tolerance)
+                return self._simplified[tolerance]
+            except KeyError:
+                pass  # cache miss
+        geometries = shapely.simplify(
+            self.geometries, tolerance, preserve_topology=True
+        )
+        # keep the original where simplification collapsed a geometry
+        collapsed = shapely.is_empty(geometries)
+        geometries[collapsed] = self.geometries[collapsed]
+        result = geometries, shapely.get_num_coordinates(geometries)
+        with self._lock:
+            self._simplified[tolerance] = result
+            while len(self._simplified) > self.MAX_CACHED_TOLERANCES:
+                self._simplified.popitem(last=False)
+        return result
+
+    def select(
+        self,
+        bbox: Sequence[float] | None = None,
+        *,
+        downsample: float | None = None,
+        tolerance: float | None = None,
+        clusters: bool = False,
+    ) -> AnnotationSelection:
+        """return the annotations in bbox at the level of detail of a zoom level
+
+        downsample is the number of full resolution pixels per screen pixel
+        at the zoom level. Annotations smaller than a screen pixel are
+        omitted, or aggregated into point clusters per CLUSTER_SIZE screen
+        pixels and classification. Geometries are simplified to tolerance,
+        which defaults to LOD_TOLERANCE screen pixels.
+        """
+        positions = self.query(bbox)
+        vertices_full = int(self.num_coordinates[positions].sum())
+
+        point_clusters = None
+        if downsample:
+            small = self._sizes(positions) < downsample
+            if clusters and small.any():
+                point_clusters = self._clusters(positions[small], downsample)
+            positions = positions[~small]
+            if tolerance is None:
+                tolerance = downsample * LOD_TOLERANCE
+
+        geometries, num_coordinates = self.simplified(tolerance or 0)
+        return AnnotationSelection(
+            positions=positions,
+            geometries=geometries[positions],
+            clusters=point_clusters,
+            vertices=int(num_coordinates[positions].sum()),
+            vertices_full=vertices_full,
+        )
+
+    def _clusters(self, positions: np.ndarray, downsample: float) -> AnnotationClusters:
+        b = self.bounds[positions]
+        x = (b[:, 0] + b[:, 2]) / 2
+        y = (b[:, 1] + b[:, 3]) / 2
+        cell = CLUSTER_SIZE * downsample
+        keys = np.stack(
+            [
+                np.floor(x / cell).astype(np.int64),
+                np.floor(y / cell).astype(np.int64),
+                self._class_codes[positions],
+            ],
+            axis=1,
+        )
+        cells, first, inverse = np.unique(
+            keys, axis=0, return_index=True, return_inverse=True
+        )
+        inverse = inverse.reshape(-1)
+        counts = np.bincount(inverse)
+        d = int(round(downsample))
+        names = self.classifications[positions[first]]
+        return AnnotationClusters(
+            ids=[
+                f"cluster-{d}-{cx}-{cy}-{name}"
+                for (cx, cy, _), name in zip(cells.tolist(), names)
+            ],
+            x=np.bincount(inverse, weights=x) / counts,
+            y=np.bincount(inverse, weights=y) / counts,
+            counts=counts,
+            classes=positions[first],
+        )
+
+    def geojson_features(
+        self,
+        positions: np.ndarray,
+        geometries: np.ndarray | None = None,
+    ) -> Iterator[dict[str, Any]]:
+        """yield the geojson features of the annotations at positions"""
+        from shapely.geometry import mapping
+
+        if geometries is None:
+            geometries = self.geometries[positions]
+        for pos, geometry in zip(positions.tolist(), geometries):
+            if geometry.geom_type == "Polygon":
+                geom = {
+                    "type": "Polygon",
+                    "coordinates": [list(geometry.exterior.coords)],
+                }
+            else:
+                geom = mapping(geometry)
+            yield {
+                "type": "Feature",
+                "id": int(self.ids[pos]),
+                "geometry": geom,
+                "properties": {
+                    "classification": self._classification(pos),
+                    "area": float(self.areas[pos]),
+                    "object_type": "annotation",
+                },
+            }
+
+    def cluster_features(
+        self, clusters: AnnotationClusters
+    ) -> Iterator[dict[str, Any]]:
+        """yield the geojson point features of annotation clusters"""
+        for cid, x, y, count, pos in zip(
+            clusters.ids,
+            clusters.x.tolist(),
+            clusters.y.tolist(),
+            clusters.counts.tolist(),
+            clusters.classes.tolist(),
+        ):
+            yield {
+                "type": "Feature",
+                "id": cid,
+                "geometry": {"type": "Point", "coordinates": [x, y]},
+                "properties": {
+                    "classification": self._classification(pos),
+                    "count": count,
+                    "object_type": "cluster",
+                },
+            }
+
+    def mvt_tile(
+        self,
+        bounds: Sequence[float],
+        *,
+        downsample: float,
+        extent: int = MVT_EXTENT,
+        buffer: int = MVT_BUFFER,
+    ) -> bytes:
+        """return the annotations in bounds as a mapbox vector tile
+
+        The tile has an "annotations" and a "predictions" layer, with the
+        level of detail of `select` at downsample. Geometries are clipped
+        to bounds plus a buffer and quantised to the tile extent.
+        """
+        import shapely
+
+        x0, y0, x1, y1 = map(float, bounds)
+        scale = extent / (x1 - x0)
+        pad = buffer / scale
+        bbox = (x0 - pad, y0 - pad, x1 + pad, y1 + pad)
+        selection = self.select(bbox, downsample=downsample, clusters=True)
+
+        geometries = shapely.clip_by_rect(selection.geometries, *bbox)
+        geometries = shapely.transform(
+            geometries, lambda c: np.round((c - (x0, y0)) * scale)
+        )
+        layers: tuple[list[MVTFeature], list[MVTFeature]] = ([], [])
+        for pos, geometry in zip(selection.positions.tolist(), geometries):
+            if geometry.is_empty:
+                continue
+            # the parts of a collection are features with the same id
+            for part in split_collection(geometry):
+                geom_type, commands = geometry_commands(part)
+                layers[int(self.predicted[pos])].append(
+                    MVTFeature(
+                        id=int(self.ids[pos]),
+                        type=geom_type,
+                        geometry=commands,
+                        properties={
+                            **self._mvt_properties(pos),
+                            "area": float(self.areas[pos]),
+                            "object_type": "annotation",
+                        },
+                    )
+                )
+
+        clusters = selection.clusters
+        if clusters is not None:
+            inside = (
+                (clusters.x >= x0)
+                & (clusters.x < x1)
+                & (clusters.y >= y0)
+                & (clusters.y < y1)
+            )
+            for x, y, count, pos in zip(
+                np.round((clusters.x[inside] - x0) * scale).astype(int).tolist(),
+                np.round((clusters.y[inside] - y0) * scale).astype(int).tolist(),
+                clusters.counts[inside].tolist(),
+                clusters.classes[inside].tolist(),
+            ):
+                layers[int(self.predicted[pos])].append(
+                    MVTFeature(
+                        id=None,
+                        type=1,
+                        geometry=geometry_commands(shapely.Point(x, y))[1],
+                        properties={
+                            **self._mvt_properties(pos),
+                            "count": count,
+                            "object_type": "cluster",
+                        },
+                    )
+                )
+
+        return encode_tile(
+            encode_layer(name, features, extent=extent)
+            for name, features in zip(("annotations", "predictions"), layers)
+            if features
+        )
+
+    def _mvt_properties(self, pos: int) -> dict[str, Any]:
+        return {
+            "classification": self.classifications[pos],
+            "color": "#{:02x}{:02x}{:02x}".format(*self.colors[pos].tolist()),
+        }
+
+    def _classification(self, pos: int) -> dict[str, Any]:
+        return {
+            "name": self.classifications[pos],
+            "color": self.colors[pos].tolist(),
+        }
+
+
+class AnnotationIndexes:
+    """a bounded cache of the spatial indexes of the images of a snapshot"""
+
+    MAX_CACHED_INDEXES = 16
+
+    def __init__(self, annotations: AnnotationProvider) -> None:
+        self._annotations = annotations
+        self._indexes: OrderedDict[ImageId, AnnotationSpatialIndex] = OrderedDict()
+        self._building: dict[ImageId, threading.Lock] = {}
+        self._lock = threading.Lock()
+
+    def __getitem__(self, image_id: ImageId) -> AnnotationSpatialIndex:
+        """return the index of an image, raises KeyError without annotations"""
+        with self._lock:
+            try:
+                self._indexes.move_to_end(image_id)
+                return self._indexes[image_id]
+            except KeyError:
+                pass  # cache miss
+            lock = self._building.setdefault(image_id, threading.Lock())
+        # only one thread builds the index of an image, the others wait for it
+        with lock:
+            with self._lock:
+                index = self._indexes.get(image_id)
+            if index is None:
+                try:
+                    index = AnnotationSpatialIndex(self._annotations[image_id].df)
+                    with self._lock:
+                        self._indexes[image_id] = index
+                        while len(self._indexes) > self.MAX_CACHED_INDEXES:
+                            self._indexes.popitem(last=False)
+                finally:
+                    with self._lock:
+                        self._building.pop(image_id, None)
+        return index
+
+    def replaced(
+        self, annotations: AnnotationProvider, image_ids: Collection[ImageId]
+    ) -> AnnotationIndexes:
+        """a cache for new annotations, keeping the indexes of unchanged images"""
+        indexes = AnnotationIndexes(annotations)
+        with self._lock:
+            indexes._indexes.update(
+                (k, v) for k, v in self._indexes.items() if k not in image_ids
+            )
+        return indexes
+
+
+# --- summaries ---------------------------------------------------------------
+
+
+class AnnotationSummary(NamedTuple):
+    """the summary of the annotations of an image"""
+
+    num_annotations: int
+    num_predicted: int  # annotations by a model
+    bounds: tuple[float, float, float, float]
+    areas: dict[str, float]  # total area per classification
+
+
+class AnnotationSummaryIndex:
+    """per image summaries of the annotations of a dataset snapshot
+
+    The geometries are parsed once per snapshot, the snapshots published
+    for annotation writes only parse those of the written images (see
+    replaced). The summaries are kept as a table with one row per image
+    and classification, sorted by image, so that the summary of an image
+    is a slice of the table.
+    """
+
+    def __init__(
+        self, rows: DataFrame, annotation_areas: pd.Series | None = None
+    ) -> None:
+        pairs = (
+            rows.groupby(["image_id", "classification"], sort=True)
+            .agg(**_SUMMARY_AGGREGATES)
+            .reset_index()
+        )
+        images = pairs.groupby("image_id", sort=True).agg(**_SUMMARY_AGGREGATES)
+        self._pairs = pairs
+        self._classes = pairs["classification"].to_numpy(dtype=object)
+        self._areas = pairs["area"].to_numpy(dtype=float)
+        self.image_ids = images.index.to_numpy(dtype=object)
+        self.counts = images["count"].to_numpy(dtype=np.int64)
+        self.predicted = images["predicted"].to_numpy(dtype=np.int64)
+        self.bounds = images[["x0", "y0", "x1", "y1"]].to_numpy(dtype=float)
+        self._offsets = np.append(
+            np.searchsorted(pairs["image_id"].to_numpy(dtype=object), self.image_ids),
+            len(pairs),
+        )
+        # the area of each annotation, keyed by image and row of the image,
+        # so that the tabular records don't parse the geometries again
+        if annotation_areas is not None and not annotation_areas.index.is_unique:
+            annotation_areas = None  # an image in several datasets
+        self.annotation_areas = annotation_areas
+
+    @classmethod
+    def from_annotations(cls, df: DataFrame) -> AnnotationSummaryIndex:
+        """build the summaries from an annotations frame"""
+        return cls(*_summary_rows(df))
+
+    def replaced(self, frames: Mapping[ImageId, DataFrame]) -> AnnotationSummaryIndex:
+        """the summaries with those of the images in frames rebuilt"""
+        labels = [image_id.to_str() for image_id in frames]
+        pairs = self._pairs.loc[~self._pairs["image_id"].isin(labels)]
+        if not frames:
+            return type(self)(pairs, self.annotation_areas)
+        rows, areas = _summary_rows(
+            pd.concat(
+                [df.assign(image_id=i) for i, df in zip(labels, frames.values())],
+                ignore_index=True,
+            )
+        )
+        annotation_areas = self.annotation_areas
+        if annotation_areas is not None:
+            keep = ~annotation_areas.index.get_level_values(0).isin(labels)
+            annotation_areas = pd.concat([annotation_areas.loc[keep], areas])
+        return type(self)(pd.concat([pairs, rows]), annotation_areas)
+
+    def areas_of(self, df: DataFrame) -> np.ndarray | None:
+        """the areas of the rows of an annotations frame, None if unknown"""
+        if self.annotation_areas is None:
+            return None
+        pos = self.annotation_areas.index.get_indexer(_row_keys(df))
+        if (pos < 0).any():
+            return None
+        return self.annotation_areas.to_numpy(dtype=float)[pos]
+
+    @classmethod
+    def concat(
+        cls, indexes: Sequence[AnnotationSummaryIndex]
+    ) -> AnnotationSummaryIndex:
+        """combine the summaries of several datasets"""
+        rows = pd.concat([i._pairs for i in indexes], ignore_index=True)
+        areas = [i.annotation_areas for i in indexes]
+        if any(a is None for a in areas):
+            return cls(rows)
+        return cls(rows, annotation_areas=pd.concat(areas))
+
+    def __len__(self) -> int:
+        return len(self.image_ids)
+
+    def _position(self, image_id: ImageId) -> int | None:
+        key = image_id.to_str()
+        pos = int(np.searchsorted(self.image_ids, key))
+        if pos < len(self.image_ids) and self.image_ids[pos] == key:
+            return pos
+        return None
+
+    def __contains__(self, image_id: object) -> bool:
+        if not isinstance(image_id, ImageId):
+            return False
+        return self._position(image_id) is not None
+
+    def __getitem__(self, image_id: ImageId) -> AnnotationSummary:
+        """return the summary of an image, raises KeyError without annotations"""
+        pos = self._position(image_id)
+        if pos is None:
+            raise KeyError(image_id)
+        start, stop = self._offsets[pos], self._offsets[pos + 1]
+        x0, y0, x1, y1 = self.bounds[pos].tolist()
+        return AnnotationSummary(
+            num_annotations=int(self.counts[pos]),
+            num_predicted=int(self.predicted[pos]),
+            bounds=(x0, y0, x1, y1),
+            areas=dict(
+                zip(
+                    self._classes[start:stop].tolist(), self._areas[start:stop].tolist()
+                )
+            ),
+        )
+
+    def get(
+        self, image_id: ImageId, default: AnnotationSummary | None = None
+    ) -> AnnotationSummary | None:
+        try:
+            return self[image_id]
+        except KeyError:
+            return default
+
+
+_SUMMARY_AGGREGATES = {
+    "count": ("count", "sum"),
+    "predicted": ("predicted", "sum"),
+    "area": ("area", "sum"),
+    "x0": ("x0", "min"),
+    "y0": ("y0", "min"),
+    "x1": ("x1", "max"),
+    "y1": ("y1", "max"),
+}
+
+
+def _row_keys(df: DataFrame) -> pd.MultiIndex:
+    """key the rows of an annotations frame by image and row of the image"""
+    image_ids = df["image_id"].to_numpy(dtype=object)
+    rows = df.groupby(image_ids, sort=False).cumcount().to_numpy()
+    return pd.MultiIndex.from_arrays([image_ids, rows])
+
+
+def _summary_rows(df: DataFrame) -> tuple[DataFrame, pd.Series]:
+    """the summary row and the area of each annotation of a frame"""
+    import shapely
+
+    geometries = _geometries(df["geometry"].to_numpy(dtype=object))
+    areas = np.asarray(shapely.area(geometries), dtype=float).reshape(-1)
+    bounds = np.asarray(shapely.bounds(geometries), dtype=float).reshape(-1, 4)
+    if "annotator" in df.columns:
+        predicted = _annotator_types(df["annotator"]) == "model"
+    else:
+        predicted = np.zeros(len(df), dtype=bool)
+    rows = DataFrame(
+        {
+            "image_id": df["image_id"].to_numpy(dtype=object),
+            "classification": df["classification"].fillna("None").to_numpy(),
+            "count": np.ones(len(df), dtype=np.int64),
+            "predicted": predicted.astype(np.int64),
+            "area": areas,
+            "x0": bounds[:, 0],
+            "y0": bounds[:, 1],
+            "x1": bounds[:, 2],
+            "y1": bounds[:, 3],
+        }
+    )
+    return rows, pd.Series(areas, index=_row_keys(df))
+
+
+# --- columnar export ---------------------------------------------------------
+
+# geoarrow extension names of the shapely ragged array geometry types
+_GEOARROW_TYPES = {
+    0: "geoarrow.point",
+    1: "geoarrow.linestring",
+    3: "geoarrow.polygon",
+    4: "geoarrow.multipoint",
+    5: "geoarrow.multilinestring",
+    6: "geoarrow.multipolygon",
+}
+
+
+def annotation_arrow_chunks(
+    index: AnnotationSpatialIndex,
+    selection: AnnotationSelection,
+    *,
+    batch_size: int = ARROW_BATCH_SIZE,
+) -> Iterator[bytes]:
+    """serialize the selected annotations as an arrow ipc stream
+
+    Geometries are stored geoarrow style: a flat array of interleaved
+    x/y coordinates with nested offsets per ring, part and geometry. If
+    the geometry types can't share one layout, they are stored as wkb.
+    Properties are stored in separate columns.
+    """
+    import pyarrow as pa
+
+    positions = selection.positions
+    geometry = _geoarrow_geometry(selection.geometries)
+    classes = pd.Index(index.classifications).unique().dropna()
+    codes = classes.get_indexer(index.classifications[positions])
+    colors = index.colors[positions]
+    table = pa.table(
+        {
+            "id": pa.array(index.ids[positions], type=pa.uint64()),
+            "geometry": geometry.array,
+            "classification": pa.DictionaryArray.from_arrays(
+                pa.array(codes, type=pa.int32(), mask=codes < 0),
+                pa.array(classes.to_numpy(dtype=object), type=pa.string()),
+            ),
+            "color": pa.FixedSizeListArray.from_arrays(
+                pa.array(colors.reshape(-1), type=pa.uint8()), 3
+            ),
+            "area": pa.array(index.areas[positions], type=pa.float64()),
+            "predicted": pa.array(index.predicted[positions], type=pa.bool_()),
+        }
+    )
+    field = table.schema.field("geometry")
+    schema = table.schema.set(
+        table.schema.get_field_index("geometry"),
+        field.with_metadata(
+            {
+                "ARROW:extension:name": geometry.extension_name,
+                "ARROW:extension:metadata": "{}",
+            }
+        ),
+    )
+
+    sink = ChunkSink()
+    writer = pa.ipc.new_stream(sink, schema)
+    for batch in table.to_batches(max_chunksize=batch_size):
+        writer.write_batch(pa.RecordBatch.from_arrays(batch.columns, schema=schema))
+        data = sink.drain()
+        if data:
+            yield data
+    writer.close()
+    data = sink.drain()
+    if data:
+        yield data
+
+
+class _GeoArrowArray(NamedTuple):
+    array: Any
+    extension_name: str
+
+
+def _geoarrow_geometry(geometries: np.ndarray) -> _GeoArrowArray:
+    import pyarrow as pa
+    import shapely
+
+    try:
+        if len(geometries):
+            type_id, coords, offsets = shapely.to_ragged_array(geometries)
+        else:
+            zero = np.zeros(1, dtype=np.int64)
+            type_id, coords, offsets = 3, np.empty((0, 2)), (zero, zero)
+    except ValueError:
+        # mixed geometry types without a common layout
+        return _GeoArrowArray(
+            pa.array(shapely.to_wkb(geometries), type=pa.binary()), "geoarrow.wkb"
+        )
+    array = pa.FixedSizeListArray.from_arrays(
+        pa.array(coords.reshape(-1), type=pa.float64()), 2
+    )
+    for o in offsets:
+        array = pa.ListArray.from_arrays(pa.array(o, type=pa.int32()), array)
+    return _GeoArrowArray(array, _GEOARROW_TYPES[int(type_id)])
@@ -44,6 +44,156 @@ function getOptimalThumbnailSize(nodeHeight, nodeWidth, numImages) {
   return Math.max(sx, sy);
 }
 
+/**
+ * load pages of the records endpoint on demand
+ *
+ * Sorting and filtering happen on the server, the table only holds the
+ * pages that were scrolled into view.
+ */
+class RecordsPager {
+  constructor(url, columns, pageSize = 1000) {
+    this.url = url;
+    this.columns = columns;
+    this.pageSize = pageSize;
+    this.sort = [];
+    this.filter = {};
+    this.records = [];
+    this.total = Infinity;
+    this.pending = null;
+    this.generation = 0;
+  }
+
+  get complete() {
+    return this.records.length >= this.total;
+  }
+
+  /**
+   * drop the loaded records and load the first page for a sort and filter
+   * @param sort list of columns, prefixed with "-" for descending order
+   * @param filter object mapping columns to values or {min, max} ranges
+   * @returns {Promise<Object[]>}
+   */
+  reset(sort = this.sort, filter = this.filter) {
+    this.sort = sort;
+    this.filter = filter;
+    this.records = [];
+    this.total = Infinity;
+    this.pending = null;
+    this.generation += 1;
+    return this.next();
+  }
+
+  /**
+   * load the next page, concurrent calls share the request
+   * @returns {Promise<Object[]>}
+   */
+  next() {
+    if (this.complete) {
+      return Promise.resolve(this.records);
+    }
+    if (this.pending === null) {
+      const generation = this.generation;
+      this.pending = this.fetchPage(this.records.length).then((page) => {
+        if (generation === this.generation) {
+          this.total = page.total;
+          this.records = this.records.concat(page.records);
+          this.pending = null;
+        }
+        return this.records;
+      });
+    }
+    return this.pending;
+  }
+
+  async fetchPage(offset) {
+    const params = new URLSearchParams({
+      offset: offset,
+      limit: this.pageSize,
+      columns: this.columns.join(","),
+    });
+    if (this.sort.length > 0) {
+      params.set("sort", this.sort.join(","));
+    }
+    if (Object.keys(this.filter).length > 0) {
+      params.set("filter", JSON.stringify(this.filter));
+    }
+    const response = await fetch(`${this.url}?${params}`);
+    if (!response.ok) {
+      throw new Error(`fetching records failed: ${response.status}`);
+    }
+    return response.json();
+  }
+}
+
+/**
+ * return the server side sort of a lineup ranking
+ * @param ranking
+ * @returns {string[]}
+ */
+function rankingSort(ranking) {
+  return ranking
+    .getSortCriteria()
+    .filter(({ col }) => col.desc.column)
+    .map(({ col, asc }) => (asc ? "" : "-") + col.desc.column);
+}
+
+/**
+ * return the server side filter of a lineup ranking
+ * @param ranking
+ * @returns {Object}
+ */
+function rankingFilter(ranking) {
+  const filter = {};
+  for (const col of ranking.flatColumns) {
+    const key = col.desc.column;
+    if (!key || typeof col.getFilter !== "function") {
+      continue;
+    }
+    const value = col.getFilter();
+    if (value === null || value === undefined) {
+      continue;
+    }
+    if (Array.isArray(value.filter)) {
+      // categorical columns
+      filter[key] = value.filter;
+    } else if (Number.isFinite(value.min) || Number.isFinite(value.max)) {
+      // numerical columns
+      const range = {};
+      if (Number.isFinite(value.min)) {
+        range.min = value.min;
+      }
+      if (Number.isFinite(value.max)) {
+        range.max = value.max;
+      }
+      filter[key] = range;
+    }
+  }
+  return filter;
+}
+
+/**
+ * load the next page when a scroll container is close to its end
+ * @param node
+ * @param pager
+ * @param onPage
+ */
+function loadPagesOnScroll(node, pager, onPage) {
+  node.addEventListener(
+    "scroll",
+    (event) => {
+      const el = event.target;
+      if (pager.complete || !(el instanceof Element)) {
+        return;
+      }
+      if (el.scrollTop + el.clientHeight >= el.scrollHeight - 500) {
+        pager.next().then(onPage);
+      }
+    },
+    // scroll events don't bubble
+    true
+  );
+}
+
 /**
  * setup our lineup viewer
  */
@@ -51,11 +201,34 @@ function setupLineUp(options) {
   const defaultOptions = {
     id: null,
     metadata: [],
+    recordsUrl: null,
+    recordColumns: [],
     extraColumns: [],
   };
   const luOptions = Object.assign({}, defaultOptions, options);
   const luElement = document.getElementById(luOptions.id);
 
+  if (luOptions.recordsUrl !== null) {
+    // only request the columns displayed by lineup
+    const pager = new RecordsPager(
+      luOptions.recordsUrl,
+      luOptions.recordColumns
+    );
+    return pager.reset().then((records) => {
+      const lineup = setupLineUp(
+        Object.assign({}, luOptions, { recordsUrl: null, metadata: records })
+      );
+      const update = (records) => lineup.data.setData(records);
+      const ranking = lineup.data.getFirstRanking();
+      const reload = () =>
+        pager.reset(rankingSort(ranking), rankingFilter(ranking)).then(update);
+      ranking.on("sortCriteriaChanged.pavo", reload);
+      ranking.on("filterChanged.pavo", reload);
+      loadPagesOnScroll(luElement, pager, update);
+      return lineup;
+    });
+  }
+
   /* --- Renderers --------------------------------------------------------- */
 
   class ThumbnailRenderer {
@@ -428,6 +601,8 @@ function setupLineUp(options) {
     // Simulate an HTTP redirect:
     window.location.href = `/slides/viewer/${imageId}/osd`;
   }
+
+  return lineup;
 }
 
 export default {
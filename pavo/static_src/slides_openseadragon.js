@@ -34,6 +34,7 @@ function setupOpenSeadragonViewer(options, annoOptions) {
   };
   const defaultAnnoOptions = {
     annotationUrl: null,
+    viewportUrl: null,
     formatter: formatter,
   };
 
@@ -71,14 +72,71 @@ function setupOpenSeadragonViewer(options, annoOptions) {
       SelectorPack(anno);
 
       // Load annotations in W3C WebAnnotation format
-      const annotation_url = aOptions.annotationUrl;
-      anno.loadAnnotations(annotation_url);
+      if (aOptions.viewportUrl) {
+        // incrementally, only the annotations in view
+        loadViewportAnnotations(osdviewer, anno, aOptions.viewportUrl);
+      } else {
+        const annotation_url = aOptions.annotationUrl;
+        anno.loadAnnotations(annotation_url);
+      }
 
       resolve(osdviewer);
     });
   });
 }
 
+/**
+ * Load the annotations in the viewport whenever the view changes
+ * @param viewer
+ * @param anno
+ * @param viewportUrl
+ */
+function loadViewportAnnotations(viewer, anno, viewportUrl) {
+  const loaded = new Map(); // maps annotation ids to their level of detail
+  let pending = null;
+
+  function update() {
+    const tiledImage = viewer.world.getItemAt(0);
+    if (!tiledImage) {
+      return;
+    }
+    const bounds = viewer.viewport.viewportToImageRectangle(viewer.viewport.getBounds(true));
+    const zoom = viewer.viewport.viewportToImageZoom(viewer.viewport.getZoom(true));
+    const maxLevel = tiledImage.source.maxLevel;
+    const level = Math.max(0, Math.min(maxLevel, maxLevel + Math.ceil(Math.log2(zoom))));
+    const bbox = [bounds.x, bounds.y, bounds.x + bounds.width, bounds.y + bounds.height];
+    const url = `${viewportUrl}?bbox=${bbox.map(Math.round).join(",")}&level=${level}`;
+
+    if (pending !== null) {
+      pending.abort();
+    }
+    pending = new AbortController();
+    fetch(url, {signal: pending.signal})
+      .then(response => response.ok ? response.json() : [])
+      .then(annotations => {
+        for (const annotation of annotations) {
+          // geometries are simplified at low levels: replace them when zooming in
+          const loadedLevel = loaded.get(annotation.id);
+          if (loadedLevel === undefined || loadedLevel < level) {
+            if (loadedLevel !== undefined) {
+              anno.removeAnnotation(annotation.id);
+            }
+            loaded.set(annotation.id, level);
+            anno.addAnnotation(annotation);
+          }
+        }
+      })
+      .catch(err => {
+        if (err.name !== "AbortError") {
+          throw err;
+        }
+      });
+  }
+
+  viewer.addHandler("open", update);
+  viewer.addHandler("animation-finish", update);
+}
+
 /**
  * return the corresponding Openseadragon instance
  * @param viewerId
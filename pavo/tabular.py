@@ -0,0 +1,1097 @@
+"""pavo.tabular builds and persists the tabular records table
+
+The table is assembled from per-image partitions. Each partition is keyed
+by a digest of the image's metadata, annotation and prediction rows, so
+that a dataset refresh only recomputes the images that actually changed.
+"""
+from __future__ import annotations
+
+import hashlib
+import io
+import logging
+import os
+import tempfile
+import threading
+import warnings
+from collections import OrderedDict
+from typing import TYPE_CHECKING
+from typing import Any
+from typing import Callable
+from typing import Collection
+from typing import Iterator
+from typing import NamedTuple
+from typing import Sequence
+
+import numpy as np
+import orjson
+import pandas as pd
+from filelock import FileLock
+from filelock import Timeout as FileLockTimeout
+from pado.io.files import urlpathlike_to_fs_and_path
+from pado.types import UrlpathLike
+from pandas import DataFrame
+
+from pavo.registry import url_id
+from pavo.tissue import TissueAreaService
+from pavo.utils import ChunkSink
+
+if TYPE_CHECKING:
+    from pado import PadoDataset
+
+__all__ = [
+    "EXPORT_FORMATS",
+    "TABULAR_RECORDS_VERSION",
+    "TabularRecords",
+    "TabularRecordsEngine",
+    "TabularRecordsIndex",
+    "TabularRecordsStore",
+]
+
+_logger = logging.getLogger("pavo.data.caches")
+
+# bump this whenever the output of the tabular records pipeline changes
+TABULAR_RECORDS_VERSION = 5
+
+# export formats of the tabular records and their mimetypes
+EXPORT_FORMATS = {
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet",
+    "csv": "text/csv",
+}
+EXPORT_BATCH_SIZE = 65_536
+
+
+# noinspection PyMethodMayBeStatic
+class _Normalize:
+    """normization of metadata"""
+
+    def column_names_inplace(self, mdf: DataFrame) -> None:
+        mdf.rename(
+            columns={
+                "finding_type": "classification",
+            },
+            inplace=True,
+        )
+
+    def annotator_name(self, x: str) -> str:
+        """take care of legacy names"""
+        if x.lower().startswith("tg"):
+            return f"TG-{x[2:].title()}"
+        elif x.startswith("ai"):
+            return f"AI{x[2:]}"
+        elif len(x) <= 2:
+            return x.upper()
+        else:
+            return x
+
+    def model_names(self, model_metadata: DataFrame) -> np.ndarray:
+        """construct compatible model names from decoded model metadata"""
+        m = _field(model_metadata, "model").fillna("unknown").astype(str)
+        v = _field(model_metadata, "iteration").fillna("0.0.0").astype(str)
+        return np.where(v == "v0", m, m + "-" + v).astype(object)
+
+
+# --- inputs and partitions ---------------------------------------------------
+
+
+class TabularRecordsInputs(NamedTuple):
+    """the dataset frames the tabular records are computed from"""
+
+    identifier: str
+    metadata: DataFrame
+    annotations: DataFrame
+    image_predictions: DataFrame
+    metadata_predictions: DataFrame
+    tissue_area: pd.Series
+    # precomputed geometry areas aligned with the annotations rows
+    annotation_areas: np.ndarray | None = None
+
+    @classmethod
+    def from_dataset(
+        cls,
+        ds: PadoDataset,
+        tissue_areas: TissueAreaService | None = None,
+        annotation_areas: np.ndarray | None = None,
+        annotations: DataFrame | None = None,
+        tissue_area: pd.Series | None = None,
+    ) -> TabularRecordsInputs:
+        """collect the input frames from a dataset
+
+        annotations replaces the annotations frame of the dataset, e.g.
+        with the annotations of a snapshot including in-memory writes.
+        tissue_area replaces the output of tissue_areas, if it was loaded
+        already.
+        """
+        if tissue_area is None:
+            if tissue_areas is None:
+                tissue_areas = TissueAreaService(None, "")
+            tissue_area = tissue_areas.load(ds)
+        if annotations is None:
+            annotations = ds.annotations.df
+        if annotation_areas is not None and len(annotation_areas) != len(annotations):
+            annotation_areas = None  # not computed from these annotations
+        return cls(
+            identifier=ds.metadata.identifier,
+            metadata=ds.metadata.df,
+            annotations=annotations,
+            image_predictions=ds.predictions.images.df,
+            metadata_predictions=ds.predictions.metadata.df,
+            tissue_area=tissue_area,
+            annotation_areas=annotation_areas,
+        )
+
+    def subset(self, image_ids: Collection[str]) -> TabularRecordsInputs:
+        """restrict the inputs to the partitions of image_ids"""
+        ids = list(image_ids)
+        annotations_mask = self.annotations["image_id"].isin(ids).to_numpy()
+        annotation_areas = self.annotation_areas
+        if annotation_areas is not None:
+            annotation_areas = annotation_areas[annotations_mask]
+        return self._replace(
+            metadata=self.metadata.loc[self.metadata.index.isin(ids)],
+            annotations=self.annotations.loc[annotations_mask],
+            annotation_areas=annotation_areas,
+            image_predictions=self.image_predictions.loc[
+                self.image_predictions["image_id"].isin(ids)
+            ],
+            metadata_predictions=self.metadata_predictions.loc[
+                self.metadata_predictions["image_id"].isin(ids)
+            ],
+            tissue_area=self.tissue_area.loc[self.tissue_area.index.isin(ids)],
+        )
+
+    def partition_digests(self) -> pd.Series:
+        """return one digest per image over all rows of its partition"""
+        parts = {
+            "metadata": _sum_by_image(self.metadata, self.metadata.index),
+            "annotations": _sum_by_image(
+                self.annotations, self.annotations["image_id"]
+            ),
+            "image_predictions": _sum_by_image(
+                self.image_predictions, self.image_predictions["image_id"]
+            ),
+            "metadata_predictions": _sum_by_image(
+                self.metadata_predictions, self.metadata_predictions["image_id"]
+            ),
+            "tissue_area": _sum_by_image(
+                self.tissue_area.to_frame(), self.tissue_area.index
+            ),
+        }
+        df = pd.DataFrame(parts).fillna(0).astype(np.uint64)
+        return pd.util.hash_pandas_object(df, index=True).rename("digest")
+
+
+def _row_hashes(df: DataFrame) -> np.ndarray:
+    """hash each row of a dataframe, including unhashable object columns"""
+    hashes = np.zeros(len(df), dtype=np.uint64)
+    for name in df.columns:
+        col = df[name]
+        try:
+            h = pd.util.hash_pandas_object(col, index=False)
+        except TypeError:
+            h = pd.util.hash_pandas_object(col.astype(str), index=False)
+        # combine position dependent, so that swapped values change the hash
+        hashes = hashes * np.uint64(1000003) ^ h.to_numpy()
+    return hashes
+
+
+def _sum_by_image(df: DataFrame, image_ids: Any) -> pd.Series:
+    """order independent digest of the rows of each image"""
+    hashes = pd.Series(_row_hashes(df), index=np.asarray(image_ids))
+    return hashes.groupby(level=0).sum()
+
+
+# --- table engine ------------------------------------------------------------
+
+
+class TabularRecords(NamedTuple):
+    """the tabular records table and the digests of its partitions"""
+
+    df: DataFrame
+    digests: pd.Series
+    key: str
+
+
+class TabularRecordsEngine:
+    """computes the tabular records table from per-image partitions"""
+
+    OUTPUT_COLUMNS = (
+        "image_id",
+        "image_url",
+        "classification",
+        "annotation_type",
+        "annotator_type",
+        "annotator_name",
+        "annotation_area",
+        "annotation_count",
+        "annotation_metric",
+        "annotation_value",
+    )
+    CATEGORICAL_COLUMNS = (
+        "classification",
+        "annotation_type",
+        "annotator_type",
+        "annotator_name",
+        "annotation_metric",
+    )
+    NUMERIC_COLUMNS = (
+        "annotation_area",
+        "annotation_count",
+        "annotation_value",
+    )
+
+    def __init__(
+        self,
+        extra_columns: Sequence[str] = (),
+        extra_column_mode: str | None = None,
+        tissue_areas: TissueAreaService | None = None,
+    ) -> None:
+        self.extra_columns = list(extra_columns)
+        self.extra_column_mode = extra_column_mode
+        self.tissue_areas = tissue_areas
+
+    def key(self, inputs: TabularRecordsInputs) -> str:
+        """partitions can only be reused if this key does not change"""
+        xcolumns = [c for c in self.extra_columns if c in inputs.metadata.columns]
+        h = hashlib.sha256(f"v{TABULAR_RECORDS_VERSION}".encode())
+        h.update(repr((inputs.identifier, xcolumns, self.extra_column_mode)).encode())
+        return h.hexdigest()
+
+    def build(
+        self,
+        ds: PadoDataset,
+        previous: TabularRecords | None = None,
+        *,
+        annotations: DataFrame | None = None,
+        annotation_areas: np.ndarray | None = None,
+        tissue_area: pd.Series | None = None,
+    ) -> TabularRecords:
+        """build the table, recomputing only the partitions that changed
+
+        annotations replaces the annotations frame of ds. annotation_areas
+        are the geometry areas of its rows, if they are known already,
+        e.g. from the annotation summaries. tissue_area is the output of
+        load_tissue_area, if it was loaded already.
+        """
+        inputs = TabularRecordsInputs.from_dataset(
+            ds, self.tissue_areas, annotation_areas, annotations, tissue_area
+        )
+        key = self.key(inputs)
+        digests = inputs.partition_digests()
+
+        if previous is None or previous.key != key:
+            df = self.compute(inputs)
+
+        else:
+            prev_digests = previous.digests.reindex(digests.index)
+            changed = digests.index[prev_digests.ne(digests)]
+            removed = previous.digests.index.difference(digests.index)
+            stale = changed.union(removed)
+            _logger.info(
+                f"tabular records: recomputing {len(changed)} of {len(digests)} "
+                f"partitions, dropping {len(removed)}"
+            )
+            keep = previous.df.loc[~previous.df["image_id"].isin(stale)]
+            if len(changed) == 0:
+                df = keep
+            else:
+                part = self.compute(inputs.subset(changed))
+                df = pd.concat([keep, part], axis=0, ignore_index=True)
+
+        df = _categorize(df.reset_index(drop=True), self.CATEGORICAL_COLUMNS)
+        df = _to_float(df, self.NUMERIC_COLUMNS)
+        return TabularRecords(df=df, digests=digests, key=key)
+
+    def load_tissue_area(self, ds: PadoDataset) -> pd.Series:
+        """return the tissue area per image id str, see TissueAreaService.load"""
+        tissue_areas = self.tissue_areas
+        if tissue_areas is None:
+            tissue_areas = TissueAreaService(None, "")
+        return tissue_areas.load(ds)
+
+    @staticmethod
+    def tissue_area_digest(tissue_area: pd.Series) -> str:
+        """a digest of the tissue areas, they change when failed masks succeed"""
+        hashes = pd.util.hash_pandas_object(tissue_area, index=True).to_numpy()
+        return hashlib.sha256(hashes.tobytes()).hexdigest()
+
+    @classmethod
+    def concat(cls, dfs: Sequence[DataFrame]) -> DataFrame:
+        """combine the tables of several datasets"""
+        df = pd.concat(dfs, axis=0, ignore_index=True)
+        df = _categorize(df, cls.CATEGORICAL_COLUMNS)
+        return _to_float(df, cls.NUMERIC_COLUMNS)
+
+    def compute(self, inputs: TabularRecordsInputs) -> DataFrame:
+        """compute the table rows for all partitions in inputs
+
+        All steps operate on whole columns: json is decoded in batches via
+        arrow, struct fields are extracted columnwise, and name normalization
+        and url encoding run once per unique value instead of once per row.
+        """
+        OUTPUT_COLUMNS = list(self.OUTPUT_COLUMNS)
+        xcolumns = self.extra_columns
+        normalize = _Normalize()
+
+        # === prepare metadata df for joining =================================
+        mdf = inputs.metadata.copy(deep=False)
+        normalize.column_names_inplace(mdf)
+        available_xcolumns = [c for c in xcolumns if c in mdf.columns]
+
+        if set(available_xcolumns) != set(xcolumns):
+            if self.extra_column_mode == "ignore_missing":
+                warnings.warn("requested columns are not available in dataframe")
+            else:
+                raise ValueError()
+        OUTPUT_COLUMNS.extend(available_xcolumns)
+
+        mdf = mdf[["classification", *available_xcolumns]]
+        mdf = mdf.reset_index(names="image_id")
+        mdf["annotator_name"] = normalize.annotator_name(inputs.identifier)
+        mdf["annotator_type"] = "dataset"
+        mdf["annotation_area"] = None
+        mdf["annotation_count"] = None
+        mdf["classification"] = mdf["classification"].fillna("None")
+        mdf["annotation_type"] = "slide"
+        mdf["annotation_metric"] = None
+        mdf["annotation_value"] = None
+
+        _xcolumn_map = {
+            c: mdf[["image_id", c]].drop_duplicates().set_index("image_id")[c]
+            for c in available_xcolumns
+        }
+
+        # === prepare the annotation df for joining ===========================
+        _adf = inputs.annotations
+        _annotator = _struct_fields(_adf["annotator"], ["type", "name"])
+        adf = DataFrame(
+            {
+                "image_id": _adf["image_id"].to_numpy(),
+                "classification": _adf["classification"].to_numpy(),
+                "annotator_type": _annotator["type"],
+                "annotator_name": _map_unique(
+                    _annotator["name"], normalize.annotator_name
+                ),
+                "area": _annotation_area(_adf, inputs.annotation_areas),
+            }
+        )
+        adf = (
+            adf.groupby(
+                ["image_id", "classification", "annotator_type", "annotator_name"]
+            )["area"]
+            .agg(["sum", "count"])
+            .rename(columns={"sum": "annotation_area", "count": "annotation_count"})
+            .reset_index()
+        )
+        for xcol in available_xcolumns:
+            adf[xcol] = adf["image_id"].map(_xcolumn_map[xcol])
+        adf["annotation_type"] = "contour"
+
+        _tissue_area = adf["image_id"].map(inputs.tissue_area)
+        adf["annotation_area"] = adf["annotation_area"] / _tissue_area * 100
+
+        count_mask = adf["classification"].str.lower().str.contains("mitosis")
+        adf["annotation_metric"] = None
+        adf.loc[~count_mask, "annotation_metric"] = "area"
+        adf.loc[count_mask, "annotation_area"] = None
+        adf.loc[count_mask, "annotation_metric"] = "count"
+        adf.loc[~count_mask, "annotation_count"] = None
+        adf["annotation_value"] = None
+
+        # === prepare image prediction dataframe for joining ==================
+        _model_metadata = _decode_json(inputs.image_predictions["extra_metadata"])
+
+        ipdf = inputs.image_predictions[["image_id"]].copy()
+        ipdf["classification"] = _field(_model_metadata, "classes").to_numpy()
+        ipdf["annotator_name"] = normalize.model_names(_model_metadata)
+        ipdf["annotator_type"] = "model"
+        for xcol in available_xcolumns:
+            ipdf[xcol] = ipdf["image_id"].map(_xcolumn_map[xcol])
+
+        ipdf["annotation_type"] = "heatmap"  # fixme: segmentation vs others...
+        ipdf["annotation_metric"] = "area"  # fixme
+        ipdf["annotation_value"] = None
+        ipdf["annotation_area"] = None  # provided via MetadataPredictionProvider
+        ipdf["annotation_count"] = None  # fixme: calculate
+
+        ipdf = ipdf.explode("classification")
+        ipdf = ipdf.loc[ipdf["classification"] != "other", :]
+        ipdf["classification"] = ipdf["classification"].str.title()
+
+        # === prepare metadata prediction dataframe for joining ===============
+        _mp = inputs.metadata_predictions
+        _model_metadata = _decode_json(_mp["model_extra_json"])
+        _row_data = _decode_json(_mp["row_json"])
+        mpdf = _mp[["image_id"]].copy()
+        mpdf["classification"] = (
+            _field(_row_data, "classification").str.title().to_numpy()
+        )
+        mpdf["annotator_name"] = normalize.model_names(_model_metadata)
+        mpdf["annotator_type"] = "model"
+        for xcol in available_xcolumns:
+            mpdf[xcol] = mpdf["image_id"].map(_xcolumn_map[xcol])
+
+        _metric = _field(_row_data, "metric").to_numpy()
+        _score = pd.to_numeric(_field(_row_data, "value")).to_numpy()
+        _mask = mpdf["annotator_name"].str.startswith("AIg") | (
+            mpdf["annotator_name"] == "MultiClassSegmentation-v0.1"
+        )
+
+        mpdf["annotation_type"] = "slide"
+        mpdf.loc[_mask, "annotation_type"] = "heatmap"
+        mpdf["annotation_area"] = _score * 100
+        mpdf.loc[~_mask, "annotation_area"] = None
+        mpdf["annotation_count"] = None  # fixme: calculate
+        mpdf["annotation_metric"] = _metric
+        mpdf.loc[_mask, "annotation_metric"] = "area"
+        mpdf["annotation_value"] = _score
+        mpdf.loc[_mask, "annotation_value"] = None
+
+        mpdf = mpdf.loc[mpdf["classification"] != "Other", :]
+
+        # === transfer area score for segmentation models =====================
+        ipdf = ipdf.loc[
+            ~(
+                (ipdf["annotator_name"].str.startswith("AIg"))
+                | (ipdf["annotator_name"] == "MultiClassSegmentation-v0.1")
+            )
+        ]
+
+        # === join and validate ===============================================
+        table = pd.concat([mdf, adf, ipdf, mpdf], axis=0)
+        table["image_url"] = _map_unique(table["image_id"], url_id)
+
+        if set(table.columns) != set(OUTPUT_COLUMNS):
+            raise RuntimeError(f"expected {OUTPUT_COLUMNS!r} got {table.columns!r}")
+        return table
+
+
+def _categorize(df: DataFrame, columns: Sequence[str]) -> DataFrame:
+    """store repeated strings as categoricals"""
+    for col in columns:
+        if col in df.columns and not isinstance(df[col].dtype, pd.CategoricalDtype):
+            df[col] = df[col].astype("category")
+    return df
+
+
+def _to_float(df: DataFrame, columns: Sequence[str]) -> DataFrame:
+    """store numeric columns as float64, missing values (None) become nan"""
+    for col in columns:
+        if col in df.columns and df[col].dtype != np.float64:
+            df[col] = pd.to_numeric(df[col], errors="coerce").astype(np.float64)
+    return df
+
+
+def _map_unique(values: Any, func: Callable[[Any], Any]) -> np.ndarray:
+    """apply func once per unique value and broadcast the result"""
+    codes, uniques = pd.factorize(np.asarray(values, dtype=object))
+    mapped = np.empty(len(uniques) + 1, dtype=object)
+    mapped[:-1] = [func(u) for u in uniques]
+    mapped[-1] = None  # code -1 marks missing values
+    return mapped[codes]
+
+
+def _struct_fields(values: pd.Series, names: Sequence[str]) -> dict[str, np.ndarray]:
+    """extract fields from a column of dicts"""
+    import pyarrow as pa
+
+    if len(values) == 0:
+        return {name: np.empty(0, dtype=object) for name in names}
+    arr = pa.array(values.to_numpy(dtype=object))
+    if isinstance(arr, pa.ChunkedArray):
+        arr = arr.combine_chunks()
+    return {
+        name: arr.field(name).to_numpy(zero_copy_only=False).astype(object)
+        for name in names
+    }
+
+
+def _decode_json(values: pd.Series) -> DataFrame:
+    """decode a column of json objects into a dataframe in one batch"""
+    import pyarrow as pa
+    import pyarrow.json
+
+    if len(values) == 0:
+        return DataFrame(index=pd.RangeIndex(0))
+    arr = values.to_numpy(dtype=object)
+    try:
+        buf = "\n".join(arr).encode()
+        if buf.count(b"\n") != len(arr) - 1:
+            raise ValueError("json documents contain raw newlines")
+        table = pyarrow.json.read_json(io.BytesIO(buf))
+    except (TypeError, ValueError, pa.ArrowException):
+        # mixed types or pretty printed json, fall back to per row decoding
+        df = DataFrame.from_records([orjson.loads(x) for x in arr])
+    else:
+        df = table.to_pandas()
+        for name in df.columns:
+            if isinstance(table.schema.field(name).type, pa.ListType):
+                df[name] = df[name].map(_as_list)
+    return df
+
+
+def _as_list(x: Any) -> Any:
+    return x.tolist() if isinstance(x, np.ndarray) else x
+
+
+def _field(df: DataFrame, name: str) -> pd.Series:
+    """return a decoded json field, or missing values if no row has it"""
+    try:
+        return df[name]
+    except KeyError:
+        return pd.Series([None] * len(df), index=df.index, dtype=object)
+
+
+def _annotation_area(adf: DataFrame, areas: np.ndarray | None = None) -> np.ndarray:
+    """return the geometry area of all annotations"""
+    if areas is not None:
+        return areas
+    elif "area" in adf.columns:
+        return adf["area"].to_numpy(dtype=float)
+    import shapely
+
+    geometry = adf["geometry"].to_numpy(dtype=object)
+    if len(geometry) and isinstance(geometry[0], bytes):
+        geoms = shapely.from_wkb(geometry)
+    else:
+        geoms = shapely.from_wkt(geometry)
+    return shapely.area(geoms)
+
+
+# --- querying ----------------------------------------------------------------
+
+
+class TabularRecordsIndex:
+    """answers filtered, sorted and paginated queries over the table
+
+    Categorical columns are indexed by posting lists: the row positions
+    of each category are stored contiguously, so that a filter on a
+    category is a slice instead of a scan over the column. Sort orders
+    are computed once per sort key and reused by all queries.
+    """
+
+    MAX_CACHED_ORDERS = 32
+    MAX_CACHED_AGGREGATES = 256
+    AGGREGATIONS = ("count", "sum", "mean", "histogram")
+
+    def __init__(self, df: DataFrame) -> None:
+        self.df = df.reset_index(drop=True)
+        self._postings: dict[str, tuple[pd.Index, np.ndarray, np.ndarray]] = {}
+        for col, values in self.df.items():
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                codes = values.cat.codes.to_numpy()
+                order = np.argsort(codes, kind="stable")
+                # note: code -1 (missing) sorts first and is never looked up
+                bounds = np.searchsorted(
+                    codes[order], np.arange(len(values.cat.categories) + 1)
+                )
+                self._postings[str(col)] = (values.cat.categories, order, bounds)
+        self._orders: dict[tuple[tuple[str, bool], ...], np.ndarray] = {}
+        self._aggregates: OrderedDict[bytes, dict[str, Any]] = OrderedDict()
+        self._aggregates_lock = threading.Lock()
+
+    def __len__(self) -> int:
+        return len(self.df)
+
+    @property
+    def columns(self) -> list[str]:
+        return list(map(str, self.df.columns))
+
+    def positions(self, column: str, values: Collection[Any]) -> np.ndarray:
+        """return the sorted row positions where column is one of values"""
+        categories, order, bounds = self._postings[column]
+        codes = categories.get_indexer(list(values))
+        parts = [order[bounds[c] : bounds[c + 1]] for c in codes if c >= 0]
+        if not parts:
+            return np.empty(0, dtype=np.intp)
+        return np.sort(np.concatenate(parts))
+
+    def mask(self, filters: dict[str, Any]) -> np.ndarray:
+        """return a boolean row mask for the filters
+
+        A filter maps a column to a list of accepted values, a single value
+        or a ``{"min": ..., "max": ...}`` range. All filters must match.
+        """
+        mask = np.ones(len(self.df), dtype=bool)
+        for column, condition in filters.items():
+            if column not in self.df.columns:
+                raise ValueError(f"unknown filter column {column!r}")
+            if isinstance(condition, dict):
+                unknown = set(condition).difference({"min", "max"})
+                if unknown:
+                    raise ValueError(f"unknown range bounds {sorted(unknown)!r}")
+                values = pd.to_numeric(self.df[column], errors="coerce").to_numpy()
+                if condition.get("min") is not None:
+                    mask &= values >= float(condition["min"])
+                if condition.get("max") is not None:
+                    mask &= values <= float(condition["max"])
+                continue
+            if not isinstance(condition, list):
+                condition = [condition]
+            if column in self._postings:
+                selected = np.zeros(len(self.df), dtype=bool)
+                selected[self.positions(column, condition)] = True
+            else:
+                selected = self.df[column].isin(condition).to_numpy()
+            mask &= selected
+        return mask
+
+    def order(self, sort: Sequence[tuple[str, bool]]) -> np.ndarray:
+        """return the row permutation for a sort key of (column, ascending)"""
+        key = tuple(sort)
+        try:
+            return self._orders[key]
+        except KeyError:
+            pass  # cache miss
+        for column, _ in key:
+            if column not in self.df.columns:
+                raise ValueError(f"unknown sort column {column!r}")
+        if key:
+            order = (
+                self.df[[c for c, _ in key]]
+                .sort_values(
+                    by=[c for c, _ in key],
+                    ascending=[a for _, a in key],
+                    kind="stable",
+                    na_position="last",
+                )
+                .index.to_numpy()
+            )
+        else:
+            order = np.arange(len(self.df))
+        if len(self._orders) >= self.MAX_CACHED_ORDERS:
+            self._orders.pop(next(iter(self._orders)), None)
+        self._orders[key] = order
+        return order
+
+    def query(
+        self,
+        *,
+        filters: dict[str, Any] | None = None,
+        sort: Sequence[tuple[str, bool]] = (),
+        columns: Sequence[str] | None = None,
+        offset: int = 0,
+        limit: int | None = None,
+    ) -> tuple[int, DataFrame]:
+        """return the total number of matches and the requested page"""
+        if columns is not None:
+            unknown = set(columns).difference(self.df.columns)
+            if unknown:
+                raise ValueError(f"unknown columns {sorted(unknown)!r}")
+        order = self.order(sort)
+        if filters:
+            order = order[self.mask(filters)[order]]
+        stop = None if limit is None else offset + limit
+        page = self.df.take(order[offset:stop])
+        if columns is not None:
+            page = page[list(columns)]
+        return len(order), page
+
+    def aggregate(
+        self,
+        *,
+        group_by: Sequence[str] = (),
+        metrics: Sequence[tuple[str, str | None]] = (("count", None),),
+        filters: dict[str, Any] | None = None,
+        bins: int = 10,
+    ) -> dict[str, Any]:
+        """aggregate the matching records per group
+
+        metrics are (aggregation, column) pairs, with aggregation one of
+        count, sum, mean or histogram. Histograms share their bin edges
+        across all groups. Results are cached per query.
+        """
+        key = orjson.dumps(
+            [list(group_by), [list(m) for m in metrics], filters, bins],
+            option=orjson.OPT_SORT_KEYS,
+        )
+        with self._aggregates_lock:
+            try:
+                self._aggregates.move_to_end(key)
+                return self._aggregates[key]
+            except KeyError:
+                pass  # cache miss
+        result = self._aggregate(group_by, metrics, filters, bins)
+        with self._aggregates_lock:
+            self._aggregates[key] = result
+            while len(self._aggregates) > self.MAX_CACHED_AGGREGATES:
+                self._aggregates.popitem(last=False)
+        return result
+
+    def _aggregate(
+        self,
+        group_by: Sequence[str],
+        metrics: Sequence[tuple[str, str | None]],
+        filters: dict[str, Any] | None,
+        bins: int,
+    ) -> dict[str, Any]:
+        for name in group_by:
+            if name not in self.df.columns:
+                raise ValueError(f"unknown group_by column {name!r}")
+        for agg, column in metrics:
+            if agg not in self.AGGREGATIONS:
+                raise ValueError(f"unknown aggregation {agg!r}")
+            if agg == "count":
+                continue
+            if column not in self.df.columns:
+                raise ValueError(f"unknown {agg} column {column!r}")
+            if not pd.api.types.is_numeric_dtype(self.df[column].dtype):
+                raise ValueError(f"can't compute {agg} of non numeric {column!r}")
+        if bins < 1:
+            raise ValueError("bins must be >= 1")
+
+        mask = self.mask(filters) if filters else None
+        rows: slice | np.ndarray = slice(None) if mask is None else mask
+
+        # group on integer codes: missing values form their own group (-1)
+        codes: dict[str, np.ndarray] = {}
+        uniques: dict[str, Any] = {}
+        for name in group_by:
+            values = self.df[name]
+            if isinstance(values.dtype, pd.CategoricalDtype):
+                codes[name] = values.cat.codes.to_numpy()[rows]
+                uniques[name] = values.cat.categories
+            else:
+                codes[name], uniques[name] = pd.factorize(
+                    values.to_numpy()[rows], sort=True
+                )
+        num_rows = len(self.df) if mask is None else int(mask.sum())
+        frame = pd.DataFrame(codes, index=pd.RangeIndex(num_rows))
+        if not group_by:
+            frame["_all"] = 0
+        keys = list(group_by) or ["_all"]
+        for name in {c for agg, c in metrics if c is not None and agg != "count"}:
+            frame[name] = self.df[name].to_numpy(dtype=float)[rows]
+
+        grouped = frame.groupby(keys, sort=True)
+        out: dict[str, Any] = {"count": grouped.size()}
+        edges: dict[str, list[float]] = {}
+        for agg, column in metrics:
+            if agg == "sum":
+                out[f"sum:{column}"] = grouped[column].sum(min_count=1)
+            elif agg == "mean":
+                out[f"mean:{column}"] = grouped[column].mean()
+            elif agg == "histogram":
+                assert column is not None
+                values = frame[column].to_numpy()
+                finite = np.isfinite(values)
+                e = np.histogram_bin_edges(values[finite], bins=bins)
+                b = np.clip(np.searchsorted(e, values, side="right") - 1, 0, bins - 1)
+                counts = (
+                    frame.loc[finite, keys]
+                    .assign(_bin=b[finite])
+                    .groupby([*keys, "_bin"], sort=True)
+                    .size()
+                    .unstack("_bin", fill_value=0)
+                    .reindex(columns=range(bins), fill_value=0)
+                )
+                out[f"histogram:{column}"] = counts
+                edges[column] = e.tolist()
+
+        groups = []
+        count = out["count"]
+        for idx, group_codes in enumerate(count.index):
+            if not isinstance(group_codes, tuple):
+                group_codes = (group_codes,)
+            group: dict[str, Any] = {
+                "key": {
+                    c: (None if code < 0 else _json_scalar(uniques[c][code]))
+                    for c, code in zip(group_by, group_codes)
+                },
+                "count": int(count.iloc[idx]),
+            }
+            for agg, column in metrics:
+                if agg == "count":
+                    continue
+                result = out[f"{agg}:{column}"]
+                if agg == "histogram":
+                    row = result.reindex([count.index[idx]], fill_value=0)
+                    value: Any = row.iloc[0].astype(int).tolist()
+                else:
+                    value = _json_scalar(result.iloc[idx])
+                group.setdefault(agg, {})[column] = value
+            groups.append(group)
+
+        return {
+            "total": int(count.sum()),
+            "group_by": list(group_by),
+            "groups": groups,
+            "histogram_edges": edges,
+        }
+
+    def export(
+        self,
+        fmt: str,
+        *,
+        filters: dict[str, Any] | None = None,
+        columns: Sequence[str] | None = None,
+        batch_size: int = EXPORT_BATCH_SIZE,
+    ) -> Iterator[bytes]:
+        """return the matching records serialized in chunks
+
+        fmt is one of EXPORT_FORMATS. The records are converted and written
+        in batches of batch_size rows, so that the memory overhead does not
+        grow with the size of the export. Invalid arguments raise before
+        the first chunk is produced.
+        """
+        if fmt not in EXPORT_FORMATS:
+            raise ValueError(f"unknown export format {fmt!r}")
+        if batch_size < 1:
+            raise ValueError("batch_size must be >= 1")
+        if columns is not None:
+            unknown = set(columns).difference(self.df.columns)
+            if unknown:
+                raise ValueError(f"unknown columns {sorted(unknown)!r}")
+        df = self.df if columns is None else self.df[list(columns)]
+        if filters:
+            positions = np.flatnonzero(self.mask(filters))
+        else:
+            positions = np.arange(len(df))
+        return _export_chunks(df, positions, fmt, batch_size)
+
+
+def _json_scalar(value: Any) -> Any:
+    """convert numpy scalars and missing values for json"""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    if isinstance(value, np.generic):
+        value = value.item()
+        if isinstance(value, float) and np.isnan(value):
+            return None
+    return value
+
+
+# --- export ------------------------------------------------------------------
+
+
+def _export_chunks(
+    df: DataFrame, positions: np.ndarray, fmt: str, batch_size: int
+) -> Iterator[bytes]:
+    """serialize the rows at positions in record batches"""
+    import pyarrow as pa
+
+    schema = _export_schema(df, positions, fmt)
+    sink = ChunkSink()
+    writer = _export_writer(fmt, sink, schema)
+    for start in range(0, len(positions), batch_size):
+        chunk = df.iloc[positions[start : start + batch_size]]
+        batch = pa.RecordBatch.from_pandas(chunk, schema=schema, preserve_index=False)
+        writer.write_batch(batch)
+        data = sink.drain()
+        if data:
+            yield data
+    writer.close()
+    data = sink.drain()
+    if data:
+        yield data
+
+
+def _export_schema(df: DataFrame, positions: np.ndarray, fmt: str) -> Any:
+    """return a schema valid for all record batches of the export"""
+    import pyarrow as pa
+
+    fields = []
+    for field in pa.Schema.from_pandas(df.iloc[:0], preserve_index=False):
+        if pa.types.is_null(field.type):
+            # object columns are typed by a sample of their values
+            values = df[field.name].to_numpy()[positions]
+            sample = values[pd.notna(values)][:1_000]
+            field = field.with_type(pa.infer_type(sample) if len(sample) else pa.null())
+        elif fmt == "csv" and pa.types.is_dictionary(field.type):
+            # the csv writer can't write dictionary encoded columns
+            field = field.with_type(field.type.value_type)
+        fields.append(field)
+    return pa.schema(fields)
+
+
+def _export_writer(fmt: str, sink: ChunkSink, schema: Any) -> Any:
+    import pyarrow as pa
+
+    if fmt == "arrow":
+        return pa.ipc.new_stream(sink, schema)
+    elif fmt == "parquet":
+        import pyarrow.parquet as pq
+
+        return pq.ParquetWriter(sink, schema)
+    elif fmt == "csv":
+        import pyarrow.csv
+
+        return pyarrow.csv.CSVWriter(sink, schema)
+    else:
+        raise ValueError(f"unknown export format {fmt!r}")
+
+
+# --- persistence -------------------------------------------------------------
+
+
+class TabularRecordsStore:
+    """stores the tabular records table as uncompressed arrow files
+
+    The table is keyed by a fingerprint of the dataset files and the extra
+    column configuration. Only one process builds a missing table, while all
+    others wait on a file lock and load the result. Numeric columns without
+    nulls are read-only views of the memory-mapped file, string columns are
+    materialised as python objects by pandas.
+    """
+
+    def __init__(
+        self,
+        root: str | os.PathLike[str],
+        urlpath: str,
+        *,
+        timeout: float = -1,
+    ) -> None:
+        urlhash = hashlib.sha256(urlpath.encode()).hexdigest()[:16]
+        self.root = os.path.join(os.fspath(root), "tabular", urlhash)
+        os.makedirs(self.root, exist_ok=True)
+        self.timeout = float(timeout)
+
+    @classmethod
+    def from_cache_path(
+        cls, cache_path: UrlpathLike | None, urlpath: str
+    ) -> TabularRecordsStore | None:
+        """return a store in cache_path if it is on the local filesystem"""
+        if not cache_path:
+            return None
+        fs, path = urlpathlike_to_fs_and_path(cache_path)
+        protocols = (fs.protocol,) if isinstance(fs.protocol, str) else fs.protocol
+        if "file" not in protocols:
+            _logger.warning("tabular records cache requires a local CACHE_PATH")
+            return None
+        return cls(path, urlpath)
+
+    @staticmethod
+    def fingerprint(ds: PadoDataset, *config: Any) -> str:
+        """return a fingerprint of the dataset files and the config"""
+        # noinspection PyProtectedMember
+        fs, root = ds._fs, ds._root
+        h = hashlib.sha256(f"v{TABULAR_RECORDS_VERSION}".encode())
+        h.update(repr(config).encode())
+        for x in sorted(fs.ls(root, detail=True, refresh=True), key=_name):
+            stamp = x.get("ETag") or x.get("LastModified") or x.get("mtime")
+            h.update(f"{x['name']}:{x.get('size')}:{stamp}\n".encode())
+        return h.hexdigest()
+
+    def _paths(self, fingerprint: str) -> tuple[str, str]:
+        """return the table and digests path for a fingerprint"""
+        base = os.path.join(self.root, fingerprint)
+        return f"{base}.arrow", f"{base}.digests.arrow"
+
+    def load(self, fingerprint: str) -> TabularRecords | None:
+        """load a stored table (see the class docstring) or return None"""
+        import pyarrow as pa
+        import pyarrow.feather as feather
+
+        table_path, digests_path = self._paths(fingerprint)
+        try:
+            table = feather.read_table(table_path, memory_map=True)
+            digests = feather.read_table(digests_path, memory_map=True)
+        except FileNotFoundError:
+            return None
+        except (OSError, pa.ArrowInvalid) as err:
+            _logger.warning(f"ignoring unreadable tabular records cache: {err!r}")
+            return None
+        key = (digests.schema.metadata or {}).get(b"pavo.key", b"").decode()
+        ddf = digests.to_pandas()
+        return TabularRecords(
+            # split blocks: numeric columns stay views of the mapped file
+            df=table.to_pandas(split_blocks=True),
+            digests=pd.Series(
+                ddf["digest"].to_numpy(),
+                index=pd.Index(ddf["image_id"], name=None),
+                name="digest",
+            ),
+            key=key,
+        )
+
+    def latest(self) -> TabularRecords | None:
+        """return the most recently stored table, whatever its fingerprint"""
+        suffix = ".digests.arrow"
+        stored = [
+            os.path.join(self.root, fn)
+            for fn in os.listdir(self.root)
+            if fn.endswith(suffix)
+        ]
+        if not stored:
+            return None
+        newest = max(stored, key=os.path.getmtime)
+        return self.load(os.path.basename(newest)[: -len(suffix)])
+
+    def store(self, fingerprint: str, records: TabularRecords) -> None:
+        """atomically store a table and prune outdated tables"""
+        import pyarrow as pa
+
+        table_path, digests_path = self._paths(fingerprint)
+        digests = pa.table(
+            {
+                "image_id": records.digests.index.to_numpy(dtype=object),
+                "digest": records.digests.to_numpy(dtype=np.uint64),
+            },
+            metadata={"pavo.key": records.key},
+        )
+        # note: the digests are written last, they mark a complete entry
+        self._write(pa.Table.from_pandas(records.df, preserve_index=False), table_path)
+        self._write(digests, digests_path)
+
+        for fn in os.listdir(self.root):
+            # other builders might write their tmp files
+            if fn.startswith(fingerprint) or fn.endswith(".tmp"):
+                continue
+            path = os.path.join(self.root, fn)
+            try:
+                if fn.endswith(".lock"):
+                    # only locks that no other builder holds
+                    with FileLock(path, timeout=0):
+                        os.unlink(path)
+                else:
+                    os.unlink(path)
+            except (OSError, FileLockTimeout):
+                pass
+
+    def _write(self, table: Any, path: str) -> None:
+        """write an arrow table atomically"""
+        import pyarrow.feather as feather
+
+        fd, tmp = tempfile.mkstemp(dir=self.root, suffix=".arrow.tmp")
+        os.close(fd)
+        try:
+            # uncompressed, so numeric columns can be mapped without copies
+            feather.write_feather(table, tmp, compression="uncompressed")
+            os.replace(tmp, path)
+        except BaseException:
+            os.unlink(tmp)
+            raise
+
+    def get_or_build(
+        self,
+        fingerprint: str,
+        build: Callable[[], TabularRecords],
+    ) -> TabularRecords:
+        """load the table for fingerprint or build it once across processes"""
+        records = self.load(fingerprint)
+        if records is not None:
+            return records
+        lock = os.path.join(self.root, f"{fingerprint}.lock")
+        try:
+            with FileLock(lock, timeout=self.timeout):
+                # another process might have finished while we were waiting
+                records = self.load(fingerprint)
+                if records is None:
+                    _logger.info(f"building tabular records {fingerprint[:8]}")
+                    records = build()
+                    try:
+                        self.store(fingerprint, records)
+                    except (OSError, ValueError, TypeError) as err:
+                        _logger.warning(f"could not persist tabular records: {err!r}")
+                    else:
+                        # return the same mapped table as the other workers
+                        mapped = self.load(fingerprint)
+                        if mapped is not None:
+                            records = mapped
+        except FileLockTimeout:
+            raise TimeoutError(fingerprint)
+        return records
+
+
+def _name(x: dict[str, Any]) -> str:
+    return str(x["name"])
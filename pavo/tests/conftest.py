@@ -0,0 +1,23 @@
+from __future__ import annotations
+
+import pytest
+
+
+def _annotation_record(image_id, x):
+    return {
+        "image_id": image_id.to_str(),
+        "project": None,
+        "annotator": {"type": "model", "name": "m"},
+        "state": "not_set",
+        "classification": "tumor",
+        "color": "rgb(255, 0, 0)",
+        "description": "",
+        "comment": "",
+        "geometry": f"POLYGON (({x} 0, {x + 1} 0, {x + 1} 1, {x} 0))",
+    }
+
+
+@pytest.fixture
+def annotation_record():
+    """a factory of model annotation records of an image, shifted by x"""
+    return _annotation_record
@@ -16,3 +16,20 @@ def test_pavo_command():
     )
     assert output.returncode == 0
     assert "pavo" in output.stdout.decode()
+
+
+def test_pavo_version_does_not_import_heavy_modules():
+    code = (
+        "import sys\n"
+        "sys.argv = ['pavo', 'version']\n"
+        "from pavo.__main__ import cli\n"
+        "try:\n"
+        "    cli()\n"
+        "except SystemExit:\n"
+        "    pass\n"
+        "heavy = {'flask', 'dynaconf', 'pandas', 'pado', 'celery'}\n"
+        "print(sorted(heavy.intersection(sys.modules)))\n"
+    )
+    output = subprocess.run([sys.executable, "-c", code], capture_output=True)
+    assert output.returncode == 0
+    assert output.stdout.decode().splitlines()[-1] == "[]"
@@ -0,0 +1,285 @@
+from __future__ import annotations
+
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+import pandas as pd
+import pytest
+from pado.mock import mock_dataset
+
+from pavo.api.utils import get_filtered_positions
+from pavo.data import DatasetEntry
+from pavo.data import DatasetProxy
+from pavo.data import DatasetState
+from pavo.data import _dataset_name
+from pavo.data import build_once_property
+from pavo.ingest import PredictionLog
+from pavo.tabular import TabularRecordsIndex
+from pavo.tabular import _struct_fields
+
+
+def test_build_once_property_computes_once_under_concurrency():
+    calls = []
+
+    class Snapshot:
+        @build_once_property
+        def value(self) -> object:
+            calls.append(threading.get_ident())
+            time.sleep(0.05)
+            return object()
+
+    snapshot = Snapshot()
+    with ThreadPoolExecutor(8) as pool:
+        values = list(pool.map(lambda _: snapshot.value, range(8)))
+
+    assert len(calls) == 1
+    assert all(v is values[0] for v in values)
+
+
+def test_dataset_names_are_unique_and_url_safe():
+    taken: dict[str, None] = {}
+    for urlpath in ["s3://bucket/study A/", "/data/study A", "/data/"]:
+        taken[_dataset_name(urlpath, taken)] = None
+    assert list(taken) == ["study-A", "study-A-2", "data"]
+
+
+def _entry(tmp_path):
+    ds = mock_dataset(str(tmp_path / "ds"), num_images=2)
+    refresh = tmp_path / "refresh"
+    refresh.touch()
+    log = PredictionLog(str(tmp_path), ds.urlpath)
+    entry = DatasetEntry(
+        "ds", ds.urlpath, modified_file=str(refresh), prediction_log=log
+    )
+    return entry, log
+
+
+def test_dataset_entry_publishes_writes_under_concurrent_readers(
+    tmp_path, annotation_record
+):
+    entry, log = _entry(tmp_path)
+    snapshot = entry.get_snapshot()
+    image_id = snapshot.index[0]
+    before = len(snapshot.annotations[image_id])
+    assert snapshot.annotation_summaries[image_id].num_annotations == before
+    assert len(snapshot.filter_index) == 2
+    seen: dict[object, set[int]] = {}
+    done = threading.Event()
+
+    def _read() -> None:
+        while not done.is_set():
+            s = entry.get_snapshot(check_refresh=True)
+            # a published snapshot never changes
+            for _ in range(3):
+                seen.setdefault(s, set()).add(len(s.annotations[image_id]))
+
+    with ThreadPoolExecutor(4) as pool:
+        readers = [pool.submit(_read) for _ in range(3)]
+        for x in range(10):
+            entry.insert_annotations({image_id: [annotation_record(image_id, x)]})
+            entry.log_annotations({image_id: [annotation_record(image_id, 100 + x)]})
+        time.sleep(1.1)  # appends within the mtime granularity
+        entry.get_snapshot(check_refresh=True)
+        done.set()
+        for r in readers:
+            r.result()
+
+    assert all(len(counts) == 1 for counts in seen.values())
+    assert len(snapshot.annotations[image_id]) == before
+    current = entry.get_snapshot()
+    assert len(current.annotations[image_id]) == before + 20
+    # caches independent of the annotations are shared with the writes
+    assert current.registry is snapshot.registry
+    assert current.filter_index is snapshot.filter_index
+    # the summaries are updated, not rebuilt
+    assert "annotation_summaries" in current.__dict__
+    assert current.annotation_summaries[image_id].num_annotations == before + 20
+
+
+def test_dataset_entry_refresh_publishes_warm_snapshot(
+    tmp_path, monkeypatch, annotation_record
+):
+    entry, log = _entry(tmp_path)
+    # the mocked metadata has no classification column
+    monkeypatch.setattr(entry, "_build_tabular_records_df", lambda s: None)
+    snapshot = entry.get_snapshot()
+    image_id = snapshot.index[1]
+    before = len(snapshot.annotations[image_id])
+    entry.log_annotations({image_id: [annotation_record(image_id, 0)]})
+    entry.insert_annotations({image_id: [annotation_record(image_id, 1)]})
+
+    # no refresh requested: the log is replayed into a new snapshot
+    written = entry.check_refresh(entry.get_snapshot())
+    assert len(written.annotations[image_id]) == before + 2
+
+    ts = time.time() + 10
+    os.utime(entry._modified_file, (ts, ts))
+    refreshed = entry.check_refresh(written, warmup=True)
+    assert refreshed is entry.get_snapshot()
+    assert refreshed.refreshed == ts
+    assert "_tabular_records_df" in refreshed.__dict__
+    assert "annotation_summaries" in refreshed.__dict__
+    # in-memory writes and the log of the previous version are dropped
+    assert len(refreshed.annotations[image_id]) == before
+    assert log.mtime(written.base_version) == 0
+    assert len(written.annotations[image_id]) == before + 2
+    assert entry.check_refresh(refreshed) is refreshed
+
+
+def test_dataset_entry_writes_during_refresh_warmup(
+    tmp_path, monkeypatch, annotation_record
+):
+    entry, log = _entry(tmp_path)
+    # a worker process logging the ingested predictions
+    worker = DatasetEntry(
+        "ds", entry.urlpath, modified_file=entry._modified_file, prediction_log=log
+    )
+    snapshot = entry.get_snapshot()
+    image_id = snapshot.index[0]
+    before = len(snapshot.annotations[image_id])
+    warming, release = threading.Event(), threading.Event()
+
+    def _warmup(s):
+        warming.set()
+        assert release.wait(10)
+
+    monkeypatch.setattr(entry, "warmup", _warmup)
+    ts = time.time() + 10
+    os.utime(entry._modified_file, (ts, ts))
+    with ThreadPoolExecutor(1) as pool:
+        refresh = pool.submit(entry.check_refresh, snapshot, warmup=True)
+        assert warming.wait(10)
+        # writes and ingests are not blocked by the warmup
+        written = entry.insert_annotations({image_id: [annotation_record(image_id, 0)]})
+        assert entry.get_snapshot() is written
+        # the worker logs them for the refreshed version
+        worker.log_annotations({image_id: [annotation_record(image_id, 1)]})
+        release.set()
+        refreshed = refresh.result()
+
+    assert refreshed is entry.get_snapshot()
+    assert refreshed.refreshed == ts
+    # the predictions ingested during the warmup are replayed
+    assert len(refreshed.annotations[image_id]) == before + 1
+    assert refreshed.filter_index is not snapshot.filter_index
+
+
+def test_dataset_proxy_restarts_warmup_after_fork(
+    tmp_path, monkeypatch, annotation_record
+):
+    entry, _ = _entry(tmp_path)
+    proxy = DatasetProxy()
+    proxy.entries[entry.name] = entry
+    proxy.state = DatasetState.READY
+    proxy._refresh_interval = 0
+    snapshot = entry.get_snapshot()
+    image_id = snapshot.index[0]
+    # the parent forked while its warmup thread held these locks
+    locks = snapshot.__dict__.setdefault("_build_once_locks", {})
+    locks.setdefault("description", threading.Lock()).acquire()
+    entry._lock.acquire()
+    warmed = []
+    monkeypatch.setattr(entry, "warmup", lambda: warmed.append(entry.get_snapshot()))
+
+    proxy._restart_after_fork()
+    assert proxy._warm.wait(10)
+    assert proxy.ready
+    assert warmed == [snapshot]
+    with ThreadPoolExecutor(1) as pool:
+        assert pool.submit(lambda: snapshot.description).result(10)
+        write = pool.submit(
+            entry.insert_annotations, {image_id: [annotation_record(image_id, 0)]}
+        )
+        assert write.result(10) is entry.get_snapshot()
+
+
+def test_dataset_proxy_without_background_threads(tmp_path, monkeypatch):
+    entry, _ = _entry(tmp_path)
+    proxy = DatasetProxy()
+    proxy.entries[entry.name] = entry
+    proxy.state = DatasetState.READY
+    proxy._background = False
+    monkeypatch.setattr(entry, "warmup", lambda: pytest.fail("warmup started"))
+
+    # e.g. a forked celery worker: datasets are built on access
+    proxy._restart_after_fork()
+    assert proxy.ready
+    assert proxy._watcher is None
+
+
+def test_dataset_snapshot_version_is_shared_across_processes(
+    tmp_path, annotation_record
+):
+    entry, log = _entry(tmp_path)
+    # a second process serving the same dataset and log
+    other = DatasetEntry(
+        "ds", entry.urlpath, modified_file=entry._modified_file, prediction_log=log
+    )
+    snapshot = entry.get_snapshot()
+    assert other.get_snapshot().version == snapshot.version
+
+    image_id = snapshot.index[0]
+    entry.log_annotations({image_id: [annotation_record(image_id, 0)]})
+    time.sleep(1.1)  # appends within the mtime granularity
+    replayed = entry.check_refresh(entry.get_snapshot())
+    assert replayed.version != snapshot.version
+    assert other.check_refresh(other.get_snapshot()).version == replayed.version
+
+    written = entry.insert_annotations({image_id: [annotation_record(image_id, 1)]})
+    assert written.version != replayed.version
+    assert other.insert_annotations(
+        {image_id: [annotation_record(image_id, 1)]}
+    ).version == (written.version)
+    assert other.insert_annotations(
+        {image_id: [annotation_record(image_id, 2)]}
+    ).version != (
+        entry.insert_annotations({image_id: [annotation_record(image_id, 3)]}).version
+    )
+
+
+def _model_records(snapshot):
+    # the mocked metadata has no classification column, so only the
+    # annotator columns of the tabular records are derived
+    adf = snapshot.annotations.df
+    annotator = _struct_fields(adf["annotator"], ["type", "name"])
+    return TabularRecordsIndex(
+        pd.DataFrame(
+            {
+                "image_id": pd.Categorical(adf["image_id"].to_numpy()),
+                "annotator_type": pd.Categorical(annotator["type"]),
+                "annotator_name": pd.Categorical(annotator["name"]),
+            }
+        )
+    )
+
+
+def test_filter_results_follow_prediction_ingests(tmp_path, annotation_record):
+    entry, _ = _entry(tmp_path)
+    snapshot = entry.get_snapshot()
+    image_id = snapshot.index[0]
+    query = {"query": {"prediction": "newmodel"}}
+
+    def filtered(s):
+        positions = get_filtered_positions(
+            query,
+            s.filter_index,
+            records=lambda: _model_records(s),
+            version=s.version,
+        )
+        return positions.tolist()
+
+    assert filtered(snapshot) == []
+    record = annotation_record(image_id, 0)
+    record["annotator"] = {"type": "model", "name": "newmodel"}
+    written = entry.insert_annotations({image_id: [record]})
+    assert filtered(written) == [0]
+    assert filtered(snapshot) == []
+    # results independent of the annotations are shared with the writes
+    metadata_only = {"query": {"filename": {"glob": "*"}}}
+    assert get_filtered_positions(
+        metadata_only, written.filter_index, version=written.version
+    ) is get_filtered_positions(
+        metadata_only, snapshot.filter_index, version=snapshot.version
+    )
@@ -0,0 +1,123 @@
+from __future__ import annotations
+
+import pandas as pd
+import pytest
+from pado.images import ImageId
+
+from pavo.api.utils import InvalidFilterParameters
+from pavo.api.utils import decode_cursor
+from pavo.api.utils import encode_cursor
+from pavo.filters import ImageFilterIndex
+from pavo.filters import query_mask
+from pavo.filters import query_uses_records
+from pavo.registry import ImageIdRegistry
+from pavo.tabular import TabularRecordsIndex
+
+
+def test_image_filter_index():
+    ids = [
+        ImageId("a.svs", site="mock"),
+        ImageId("x", "b.svs", site="mock"),
+        ImageId("y", "b.svs", site="mock"),
+    ]
+    metadata = pd.DataFrame(
+        {"organ": ["liver", "lung", "liver", "liver", None]},
+        index=[ids[0].to_str(), ids[0].to_str(), ids[1].to_str(), ids[2].to_str()]
+        + ["ImageId('unknown.svs', site='mock')"],
+    )
+    index = ImageFilterIndex(ImageIdRegistry(ids), metadata)
+
+    assert index.filename("b.svs").tolist() == [1, 2]
+    assert index.metadata("organ", ["liver"]).tolist() == [0, 1, 2]
+    assert index.metadata("organ", ["lung", "liver"]).tolist() == [0, 1, 2]
+    assert index.metadata("organ", ["kidney"]).tolist() == []
+    assert not index.has_metadata_value("organ", "kidney")
+
+    positions = index.intersect(
+        index.filename("b.svs"), index.metadata("organ", ["liver"])
+    )
+    assert index.image_ids_at(positions) == ids[1:]
+
+
+def test_image_filter_index_sort():
+    ids = [ImageId(f"{name}.svs", site="mock") for name in "cab"]
+    metadata = pd.DataFrame(
+        {"organ": ["lung", None, "liver"]}, index=[i.to_str() for i in ids]
+    )
+    index = ImageFilterIndex(ImageIdRegistry(ids), metadata)
+    positions = index.all()
+    assert index.sort(positions, "index").tolist() == [0, 1, 2]
+    assert index.sort(positions, "filename").tolist() == [1, 2, 0]
+    assert index.sort(positions, "-filename").tolist() == [0, 2, 1]
+    assert index.sort(positions, "organ").tolist() == [2, 0, 1]
+    assert index.sort(positions, "-organ").tolist() == [0, 2, 1]
+
+    result = index.cached(b"key", lambda: index.sort(positions, "filename"))
+    assert index.cached(b"key", lambda: positions) is result
+
+
+def test_query_mask():
+    ids = [ImageId(f"{name}.svs", site="mock") for name in ["a_HE", "b_HE", "c_IHC"]]
+    strs = [i.to_str() for i in ids]
+    metadata = pd.DataFrame(
+        {"organ": ["liver", "lung", "liver"], "dose": [0, 10, 100]}, index=strs
+    )
+    records = TabularRecordsIndex(
+        pd.DataFrame(
+            {
+                "image_id": pd.Categorical([strs[0], strs[1], strs[2]]),
+                "classification": pd.Categorical(["Necrosis", "Necrosis", "Fibrosis"]),
+                "annotator_type": pd.Categorical(["human", "human", "model"]),
+                "annotator_name": pd.Categorical(["A", "A", "m1"]),
+                "annotation_area": [1.0, 7.0, 50.0],
+            }
+        )
+    )
+    index = ImageFilterIndex(ImageIdRegistry(ids), metadata)
+
+    def matches(query):
+        return query_mask(query, index, lambda: records).nonzero()[0].tolist()
+
+    assert matches({"filename": {"glob": "*_HE.svs"}}) == [0, 1]
+    assert matches({"filename": {"contains": "IHC"}}) == [2]
+    assert matches({"metadata": {"organ": "liver", "dose": {"min": 50}}}) == [2]
+    assert matches({"not": {"metadata": {"organ": ["liver"]}}}) == [1]
+    assert matches(
+        {
+            "or": [
+                {"filename": "a_HE.svs"},
+                {"metadata": {"dose": {"max": 100, "min": 50}}},
+            ]
+        }
+    ) == [0, 2]
+    area = {"classification": "Necrosis", "annotation_area": {"min": 5}}
+    assert matches({"records": area}) == [1]
+    assert matches({"prediction": "m1", "metadata": {"organ": "liver"}}) == [2]
+
+    with pytest.raises(ValueError):
+        matches({"unknown": 1})
+    with pytest.raises(ValueError):
+        query_mask({"prediction": "m1"}, index)
+
+    assert query_uses_records({"or": [{"filename": "a"}, {"not": {"records": area}}]})
+    assert not query_uses_records({"and": [{"metadata": {"records": 1}}]})
+
+
+def test_image_filter_index_facets():
+    ids = [ImageId(f"{i}.svs", site="mock") for i in range(4)]
+    metadata = pd.DataFrame(
+        {"organ": ["liver", "lung", "liver", None]}, index=[i.to_str() for i in ids]
+    )
+    index = ImageFilterIndex(ImageIdRegistry(ids), metadata)
+    assert index.facets() == {"organ": [("liver", 2), ("lung", 1)]}
+    assert index.facets(["organ"], index.filename("1.svs")) == {"organ": [("lung", 1)]}
+
+
+def test_filter_cursors_expire_with_the_dataset_version():
+    filter = {"filename": "a.svs", "order": "index"}
+    cursor = encode_cursor(filter, 20, "v0")
+    assert decode_cursor(cursor, dict(filter), "v0") == 20
+    with pytest.raises(InvalidFilterParameters, match="expired"):
+        decode_cursor(cursor, filter, "v1")
+    with pytest.raises(InvalidFilterParameters, match="filter"):
+        decode_cursor(cursor, {"filename": "b.svs", "order": "index"}, "v0")
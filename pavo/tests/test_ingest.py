@@ -0,0 +1,137 @@
+from __future__ import annotations
+
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+from pado.annotations import AnnotationProvider
+from pado.images import ImageId
+
+from pavo.ingest import IngestQueueFull
+from pavo.ingest import IngestSpool
+from pavo.ingest import PredictionLog
+from pavo.ingest import PredictionLogCompacted
+from pavo.registry import ImageIdRegistry
+
+
+def test_ingest_spool_depth(tmp_path):
+    spool = IngestSpool(str(tmp_path))
+    job_id = spool.submit([b'{"a": 1}\n'], max_depth=1)
+    assert job_id in spool
+    with pytest.raises(IngestQueueFull):
+        spool.submit([b""], max_depth=1)
+    spool.discard(job_id)
+    assert spool.depth() == 0
+
+
+def test_ingest_spool_depth_is_checked_under_a_lock(tmp_path):
+    spool = IngestSpool(str(tmp_path))
+
+    def _submit(_):
+        try:
+            return spool.submit([b'{"a": 1}\n'], max_depth=3)
+        except IngestQueueFull:
+            return None
+
+    with ThreadPoolExecutor(8) as pool:
+        job_ids = list(pool.map(_submit, range(16)))
+    assert spool.depth() == 3
+    assert len([j for j in job_ids if j is not None]) == 3
+
+
+def test_prediction_log_replay(tmp_path, annotation_record):
+    a, b = ImageId("a.svs", site="mock"), ImageId("b.svs", site="mock")
+    log = PredictionLog(str(tmp_path), "memory://ds")
+    assert (
+        log.append(
+            {a: [annotation_record(a, 0), annotation_record(a, 1)]}, version="v1"
+        )
+        == 1
+    )
+    assert (
+        log.append(
+            {a: [annotation_record(a, 2)], b: [annotation_record(b, 0)]}, version="v1"
+        )
+        == 2
+    )
+
+    provider = AnnotationProvider({})
+    registry = ImageIdRegistry([a])
+    assert log.replay(provider, registry, version="v1") == (2, {a})
+    # records are inserted in front, the last record first
+    assert provider[a].df["geometry"].tolist()[0].startswith("POLYGON ((2 ")
+    assert len(provider[a]) == 3
+    assert log.replay(provider, registry, version="v1", position=2) == (2, set())
+
+
+def test_prediction_log_is_scoped_to_the_dataset_version(tmp_path, annotation_record):
+    a = ImageId("a.svs", site="mock")
+    registry = ImageIdRegistry([a])
+    log = PredictionLog(str(tmp_path), "memory://ds")
+    other = PredictionLog(str(tmp_path), "memory://other")
+    log.append({a: [annotation_record(a, 0)]}, version="v1")
+    other.append({a: [annotation_record(a, 0)]}, version="v1")
+    assert log.append({a: [annotation_record(a, 1)]}, version="v2") == 1
+    assert log.replay(AnnotationProvider({}), registry, version="v2") == (1, {a})
+
+    # a refresh truncates the logs of the previous versions of the dataset
+    log.truncate("v2")
+    assert log.mtime("v1") == 0
+    assert log.replay(AnnotationProvider({}), registry, version="v1") == (0, set())
+    assert log.replay(AnnotationProvider({}), registry, version="v2") == (1, {a})
+    assert other.replay(AnnotationProvider({}), registry, version="v1") == (1, {a})
+
+
+def test_prediction_log_replay_stops_at_a_broken_entry(tmp_path, annotation_record):
+    a, b = ImageId("a.svs", site="mock"), ImageId("b.svs", site="mock")
+    log = PredictionLog(str(tmp_path), "memory://ds")
+    log.append({a: [annotation_record(a, 0)]}, version="v1")
+    log.append(
+        {a: [annotation_record(a, 1)], b: [annotation_record(b, 1)]}, version="v1"
+    )
+    log.append({b: [annotation_record(b, 2)]}, version="v1")
+    broken = log._path("v1", 2)
+    with open(broken, "rb") as f:
+        lines = f.readlines()
+    with open(broken, "wb") as f:
+        f.write(lines[0] + b"{broken\n")
+
+    provider = AnnotationProvider({})
+    registry = ImageIdRegistry([a, b])
+    # none of the records of the broken entry are inserted
+    assert log.replay(provider, registry, version="v1") == (1, {a})
+    assert len(provider[a]) == 1
+    assert b not in provider
+
+    with open(broken, "wb") as f:
+        f.writelines(lines)
+    assert log.replay(provider, registry, version="v1", position=1) == (3, {a, b})
+    assert len(provider[a]) == 2
+    assert len(provider[b]) == 2
+
+
+def test_prediction_log_compaction(tmp_path, monkeypatch, annotation_record):
+    monkeypatch.setattr(PredictionLog, "COMPACT_ENTRIES", 4)
+    a, b = ImageId("a.svs", site="mock"), ImageId("b.svs", site="mock")
+    registry = ImageIdRegistry([a, b])
+    log = PredictionLog(str(tmp_path), "memory://ds")
+    behind = AnnotationProvider({})
+    log.append({a: [annotation_record(a, 0)]}, version="v1")
+    assert log.replay(behind, registry, version="v1") == (1, {a})
+    for x in range(1, 10):
+        log.append(
+            {a: [annotation_record(a, x)], b: [annotation_record(b, x)]}, version="v1"
+        )
+
+    # the merged entries are retained for the processes still replaying them
+    assert log.replay(behind, registry, version="v1", position=1) == (10, {a, b})
+    assert log._scan("v1") == (8, list(range(1, 11)))
+    provider = AnnotationProvider({})
+    assert log.replay(provider, registry, version="v1") == (10, {a, b})
+    assert provider[a].df.equals(behind[a].df)
+    assert provider[b].df.equals(behind[b].df)
+
+    monkeypatch.setattr(PredictionLog, "RETAIN_SECONDS", -1)
+    log.append({a: [annotation_record(a, 10)]}, version="v1")
+    assert log._scan("v1") == (8, [9, 10, 11])
+    with pytest.raises(PredictionLogCompacted):
+        log.replay(AnnotationProvider({}), registry, version="v1", position=1)
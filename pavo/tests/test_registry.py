@@ -0,0 +1,19 @@
+from __future__ import annotations
+
+from pado.images import ImageId
+
+from pavo.registry import ImageIdRegistry
+from pavo.utils import ImageIdConverter
+
+
+def test_image_id_registry():
+    ids = [ImageId(f"{i}.svs", site="mock") for i in range(3)]
+    registry = ImageIdRegistry(ids)
+    converter = ImageIdConverter(None)  # type: ignore[arg-type]
+
+    assert registry.handle(ids[1]) == 1
+    assert registry.url_id_of(ids[2]) == converter.to_url(ids[2])
+    assert registry.handle_from_url_id(converter.to_url(ids[0])) == 0
+    assert registry.handle_from_url_id("unknown") is None
+    assert registry.handles_from_strs([ids[2].to_str(), "x"]).tolist() == [2, -1]
+    assert registry.image_ids_at([2, 0]) == [ids[2], ids[0]]
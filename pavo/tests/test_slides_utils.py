@@ -0,0 +1,83 @@
+from __future__ import annotations
+
+import os
+import time
+
+import numpy as np
+from pado.images import ImageId
+from PIL import Image as PILImage
+
+from pavo.slides.cache import AnnotationSerializationCache
+from pavo.slides.utils import ThumbnailPlaceholderIndex
+from pavo.slides.utils import placeholder_grid
+
+
+def test_placeholder_grid_average_colors():
+    img = PILImage.new("RGB", (32, 32), (255, 0, 0))
+    img.paste((0, 0, 255), (16, 0, 32, 32))
+    grid = placeholder_grid(img, grid=2)
+    assert grid.shape == (2, 2, 3)
+    assert grid.dtype == np.uint8
+    assert tuple(grid[0, 0]) == (255, 0, 0)
+    assert tuple(grid[0, 1]) == (0, 0, 255)
+
+
+def test_placeholder_index_grows_and_encodes():
+    index = ThumbnailPlaceholderIndex(grid=4, capacity=1)
+    ids = [ImageId(f"image_{i}.svs", site="mock") for i in range(3)]
+    for i, image_id in enumerate(ids):
+        index.set(image_id, np.full((4, 4, 3), i, dtype=np.uint8))
+    assert len(index) == 3
+    assert index.get(ids[2])[0, 0, 0] == 2
+    assert index.get(ImageId("missing.svs", site="mock")) is None
+    assert index.data_uri(ids[0]).startswith("data:image/png;base64,")
+    # encoded once, re-encoded after an update
+    assert index.data_uri(ids[0]) is index.data_uri(ids[0])
+    uri = index.data_uri(ids[0])
+    index.set(ids[0], np.full((4, 4, 3), 9, dtype=np.uint8))
+    assert index.data_uri(ids[0]) != uri
+
+
+def test_placeholder_index_missing_ttl(monkeypatch):
+    index = ThumbnailPlaceholderIndex(grid=4)
+    image_id = ImageId("image.svs", site="mock")
+    index.set_missing(image_id)
+    assert index.is_missing(image_id)
+    monkeypatch.setattr(index, "MISSING_TTL", -1.0)
+    index.set_missing(image_id)
+    assert not index.is_missing(image_id)
+    index.set_missing(image_id)
+    index.set(image_id, np.zeros((4, 4, 3), dtype=np.uint8))
+    assert not index.is_missing(image_id)
+
+
+def test_annotation_serialization_cache_write_through(tmp_path):
+    cache = AnnotationSerializationCache(tmp_path)
+    image_id = ImageId("a.svs", site="mock")
+
+    # an aborted stream is not cached
+    chunks = cache.write_through("v1", image_id, "json", iter([b"[", b"1", b"]"]))
+    assert next(chunks) == b"["
+    chunks.close()
+    assert cache.get_path("v1", image_id, "json") is None
+
+    chunks = cache.write_through("v1", image_id, "json", iter([b"[", b"1", b"]"]))
+    assert b"".join(chunks) == b"[1]"
+    path = cache.get_path("v1", image_id, "json")
+    assert path is not None and open(path, "rb").read() == b"[1]"
+    assert cache.get_path("v2", image_id, "json") is None
+
+
+def test_annotation_cache_prunes_unused_versions(tmp_path):
+    cache = AnnotationSerializationCache(tmp_path)
+    image_id = ImageId("a.svs", site="mock")
+    b"".join(cache.write_through("v1", image_id, "json", iter([b"[]"])))
+    b"".join(cache.write_through("v2", image_id, "json", iter([b"[]"])))
+    old = time.time() - 2 * cache.MAX_VERSION_AGE
+    os.utime(cache._version_path("v1"), (old, old))
+    os.utime(cache._version_path("v2"), (old, old))
+
+    b"".join(cache.write_through("v3", image_id, "json", iter([b"[]"])))
+    assert cache.get_path("v1", image_id, "json") is None
+    assert cache.get_path("v2", image_id, "json") is None
+    assert cache.get_path("v3", image_id, "json") is not None
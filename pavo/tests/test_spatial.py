@@ -0,0 +1,300 @@
+from __future__ import annotations
+
+import math
+
+import numpy as np
+import pandas as pd
+import pytest
+from pado.images import ImageId
+
+from pavo.spatial import AnnotationSpatialIndex
+from pavo.spatial import AnnotationSummaryIndex
+from pavo.spatial import annotation_arrow_chunks
+
+
+def test_annotation_spatial_index():
+    df = pd.DataFrame(
+        {
+            "geometry": [
+                "POLYGON ((0 0, 10 0, 10 10, 0 10, 0 0))",
+                "POLYGON ((100 100, 101 100, 101 101, 100 101, 100 100))",
+                "POLYGON ((50 0, 150 0, 150 40, 50 40, 50 0))",
+            ],
+            "classification": ["tumor", "cell", "tumor"],
+            "color": ["rgb(255, 0, 0)", "rgb(0, 0, 255)", "rgb(255, 0, 0)"],
+        }
+    )
+    index = AnnotationSpatialIndex(df)
+
+    assert len(index) == 3
+    assert index.total_bounds == (0.0, 0.0, 150.0, 101.0)
+    assert index.query((0, 0, 200, 200)).tolist() == [0, 1, 2]
+    assert index.query((5, 5, 60, 60)).tolist() == [0, 2]
+    assert index.query((90, 90, 200, 200)).tolist() == [1]
+    assert index.query((0, 0, 200, 200), min_size=2).tolist() == [0, 2]
+
+    (feature,) = index.geojson_features(index.query((90, 90, 200, 200)))
+    assert feature["id"] == index.ids[1]
+    assert feature["geometry"]["type"] == "Polygon"
+    assert feature["properties"]["classification"] == {
+        "name": "cell",
+        "color": [0, 0, 255],
+    }
+    assert feature["properties"]["area"] == 1.0
+
+
+def test_annotation_spatial_index_select():
+    circle = (
+        "POLYGON (("
+        + ", ".join(
+            f"{100 + 50 * math.cos(a / 32 * math.tau):.3f} "
+            f"{100 + 50 * math.sin(a / 32 * math.tau):.3f}"
+            for a in [*range(32), 0]
+        )
+        + "))"
+    )
+    cells = [
+        f"POLYGON (({x} {y}, {x + 1} {y}, {x + 1} {y + 1}, {x} {y + 1}, {x} {y}))"
+        for x, y in [(300, 300), (302, 304), (900, 900)]
+    ]
+    df = pd.DataFrame(
+        {
+            "geometry": [circle, *cells],
+            "classification": ["tumor", "cell", "cell", "cell"],
+            "color": ["rgb(255, 0, 0)"] + ["rgb(0, 0, 255)"] * 3,
+        }
+    )
+    index = AnnotationSpatialIndex(df)
+
+    full = index.select()
+    assert full.positions.tolist() == [0, 1, 2, 3]
+    assert full.vertices == full.vertices_full == 33 + 3 * 5
+    assert full.clusters is None
+
+    lod = index.select(downsample=8, clusters=True)
+    assert lod.positions.tolist() == [0]
+    assert lod.vertices < 33
+    assert lod.vertices_full == 33 + 3 * 5
+    assert lod.clusters is not None
+    assert lod.clusters.counts.tolist() == [2, 1]
+    assert lod.clusters.x.tolist() == [301.5, 900.5]
+    # simplified geometries are cached per tolerance
+    assert index.simplified(4)[0] is index.simplified(4)[0]
+
+    dropped = index.select((0, 0, 500, 500), downsample=8)
+    assert dropped.positions.tolist() == [0]
+    assert dropped.clusters is None
+
+
+def test_annotation_spatial_index_ids_are_stable():
+    df = pd.DataFrame(
+        {
+            "geometry": ["POLYGON ((0 0, 10 0, 10 10, 0 0))"] * 2
+            + ["POLYGON ((5 5, 6 5, 6 6, 5 5))"],
+            "classification": ["tumor", "tumor", "cell"],
+            "color": ["rgb(255, 0, 0)"] * 3,
+        }
+    )
+    ids = AnnotationSpatialIndex(df).ids
+    assert len(set(ids.tolist())) == 3
+    assert ids.max() < 2**53
+
+    # inserting an annotation in front keeps the ids of the others
+    inserted = pd.concat([df.iloc[[2]].assign(classification="other"), df])
+    assert AnnotationSpatialIndex(inserted).ids[1:].tolist() == ids.tolist()
+
+
+def _decode(data):
+    """decode protobuf messages into {field: [values]}"""
+
+    def varint(pos):
+        shift = value = 0
+        while True:
+            b = data[pos]
+            value |= (b & 0x7F) << shift
+            pos += 1
+            shift += 7
+            if not b & 0x80:
+                return value, pos
+
+    fields = {}
+    pos = 0
+    while pos < len(data):
+        key, pos = varint(pos)
+        field, wire_type = key >> 3, key & 0x7
+        if wire_type == 0:
+            value, pos = varint(pos)
+        elif wire_type == 2:
+            length, pos = varint(pos)
+            value, pos = data[pos : pos + length], pos + length
+        else:
+            value, pos = data[pos : pos + 8], pos + 8
+        fields.setdefault(field, []).append(value)
+    return fields
+
+
+def _unpack(data):
+    """decode packed varints"""
+    values, value, shift = [], 0, 0
+    for b in data:
+        value |= (b & 0x7F) << shift
+        shift += 7
+        if not b & 0x80:
+            values.append(value)
+            value = shift = 0
+    return values
+
+
+def _unzigzag(values):
+    values = np.asarray(values)
+    return (values >> 1) ^ -(values & 1)
+
+
+def test_annotation_spatial_index_mvt_tile():
+    df = pd.DataFrame(
+        {
+            "geometry": [
+                "POLYGON ((0 0, 0 128, 128 128, 128 0, 0 0))",
+                "POLYGON ((200 200, 300 200, 300 300, 200 300, 200 200))",
+            ],
+            "classification": ["tumor", "tumor"],
+            "color": ["rgb(255, 0, 0)", "rgb(255, 0, 0)"],
+            "annotator": [{"type": "human"}, {"type": "model"}],
+        }
+    )
+    index = AnnotationSpatialIndex(df)
+
+    tile = _decode(index.mvt_tile((0, 0, 256, 256), downsample=1, extent=256))
+    annotations, predictions = (_decode(layer) for layer in tile[3])
+    assert annotations[1] == [b"annotations"]
+    assert predictions[1] == [b"predictions"]
+    assert annotations[5] == [256]
+
+    (feature,) = (_decode(f) for f in annotations[2])
+    assert feature[1] == [index.ids[0]]
+    assert feature[3] == [3]  # polygon
+    commands = _unpack(feature[4][0])
+    assert commands[0] == 9 and commands[3] == 26 and commands[-1] == 15
+    ring = np.cumsum(_unzigzag(commands[1:3] + commands[4:-1]).reshape(-1, 2), axis=0)
+    assert sorted(map(tuple, ring.tolist())) == [(0, 0), (0, 128), (128, 0), (128, 128)]
+    # exterior rings have a positive area in tile coordinates
+    x, y = ring.T
+    assert np.sum(x * np.roll(y, -1) - np.roll(x, -1) * y) > 0
+    keys = [k.decode() for k in annotations[3]]
+    assert keys == ["classification", "color", "area", "object_type"]
+
+    (feature,) = (_decode(f) for f in predictions[2])
+    # extends beyond the tile into the buffer
+    assert feature[1] == [index.ids[1]]
+    assert _unzigzag(_unpack(feature[4][0])[1:3]).tolist() == [200, 200]
+
+
+def test_annotation_spatial_index_mvt_tile_geometry_collection():
+    df = pd.DataFrame(
+        {
+            "geometry": [
+                "GEOMETRYCOLLECTION ("
+                "POLYGON ((0 0, 0 64, 64 64, 64 0, 0 0)), "
+                "LINESTRING (100 100, 150 100), "
+                "POINT (200 200))",
+                "POLYGON ((128 0, 128 64, 192 64, 192 0, 128 0))",
+            ],
+            "classification": ["tumor", "tumor"],
+            "color": ["rgb(255, 0, 0)", "rgb(255, 0, 0)"],
+            "annotator": [{"type": "human"}, {"type": "human"}],
+        }
+    )
+    index = AnnotationSpatialIndex(df)
+
+    tile = _decode(index.mvt_tile((0, 0, 256, 256), downsample=1, extent=256))
+    annotations = _decode(tile[3][0])
+    features = [_decode(f) for f in annotations[2]]
+    # the collection is split into a polygon, a line and a point feature
+    assert sorted((f[1][0], f[3][0]) for f in features) == sorted(
+        [(index.ids[0], 3), (index.ids[0], 2), (index.ids[0], 1), (index.ids[1], 3)]
+    )
+
+
+def test_annotation_arrow_chunks():
+    pa = pytest.importorskip("pyarrow")
+
+    df = pd.DataFrame(
+        {
+            "geometry": [
+                "POLYGON ((0 0, 0 2, 2 2, 2 0, 0 0))",
+                "MULTIPOLYGON (((5 5, 6 5, 6 6, 5 5)), ((7 7, 8 7, 8 8, 7 7)))",
+                "POLYGON ((9 9, 9 10, 10 10, 9 9))",
+            ],
+            "classification": ["tumor", "cell", "tumor"],
+            "color": ["rgb(255, 0, 0)", "rgb(0, 0, 255)", "rgb(255, 0, 0)"],
+            "annotator": [{"type": "human"}, {"type": "model"}, None],
+        }
+    )
+    index = AnnotationSpatialIndex(df)
+    chunks = list(annotation_arrow_chunks(index, index.select(), batch_size=2))
+    assert len(chunks) > 2  # schema and batches are streamed separately
+
+    table = pa.ipc.open_stream(b"".join(chunks)).read_all()
+    field = table.schema.field("geometry")
+    assert field.metadata[b"ARROW:extension:name"] == b"geoarrow.multipolygon"
+    assert table["id"].to_pylist() == index.ids.tolist()
+    assert table["classification"].to_pylist() == ["tumor", "cell", "tumor"]
+    assert table["predicted"].to_pylist() == [False, True, False]
+    assert table["geometry"].to_pylist()[1] == [
+        [[[5, 5], [6, 5], [6, 6], [5, 5]]],
+        [[[7, 7], [8, 7], [8, 8], [7, 7]]],
+    ]
+
+
+def test_annotation_summary_index():
+    a, b = ImageId("a.svs", site="mock"), ImageId("b.svs", site="mock")
+    df = pd.DataFrame(
+        {
+            "image_id": [a.to_str(), b.to_str(), a.to_str()],
+            "geometry": [
+                "POLYGON ((0 0, 2 0, 2 2, 0 2, 0 0))",
+                "POLYGON ((5 5, 7 5, 7 7, 5 5))",
+                "POLYGON ((4 4, 5 4, 5 6, 4 6, 4 4))",
+            ],
+            "classification": ["tumor", None, "tumor"],
+            "annotator": [{"type": "model"}, {"type": "human"}, None],
+        }
+    )
+    summaries = AnnotationSummaryIndex.from_annotations(df)
+    assert len(summaries) == 2
+    assert summaries.annotation_areas.tolist() == [4.0, 2.0, 2.0]
+
+    summary = summaries[a]
+    assert summary.num_annotations == 2
+    assert summary.num_predicted == 1
+    assert summary.bounds == (0.0, 0.0, 5.0, 6.0)
+    assert summary.areas == {"tumor": 6.0}
+    assert summaries[b].areas == {"None": 2.0}
+    assert ImageId("c.svs", site="mock") not in summaries
+
+    combined = AnnotationSummaryIndex.concat([summaries, summaries])
+    assert combined[a].num_annotations == 4
+    assert combined[a].bounds == summary.bounds
+
+    # the areas are matched by image and row, whatever the order of images
+    reordered = df.iloc[[1, 0, 2]]
+    assert summaries.areas_of(reordered).tolist() == [2.0, 4.0, 2.0]
+    assert summaries.areas_of(pd.concat([df, df.iloc[[1]]])) is None
+
+    written = pd.DataFrame(
+        {
+            "image_id": [b.to_str()] * 2,
+            "geometry": [
+                "POLYGON ((0 0, 3 0, 3 3, 0 3, 0 0))",
+                "POLYGON ((5 5, 7 5, 7 7, 5 5))",
+            ],
+            "classification": ["stroma", None],
+            "annotator": [{"type": "model"}, {"type": "human"}],
+        }
+    )
+    replaced = summaries.replaced({b: written})
+    assert replaced[a] == summary
+    assert replaced[b].num_predicted == 1
+    assert replaced[b].areas == {"None": 2.0, "stroma": 9.0}
+    after = pd.concat([df.iloc[[0, 2]], written])
+    assert replaced.areas_of(after).tolist() == [4.0, 2.0, 9.0, 2.0]
@@ -0,0 +1,255 @@
+from __future__ import annotations
+
+import json
+
+import pandas as pd
+import pytest
+from filelock import FileLock
+
+from pavo.tabular import TabularRecords
+from pavo.tabular import TabularRecordsEngine
+from pavo.tabular import TabularRecordsIndex
+from pavo.tabular import TabularRecordsInputs
+from pavo.tabular import TabularRecordsStore
+
+
+def _inputs(value: float) -> TabularRecordsInputs:
+    ids = ["a", "b"]
+    return TabularRecordsInputs(
+        identifier="tg",
+        metadata=pd.DataFrame({"classification": ["x", "y"]}, index=ids),
+        annotations=pd.DataFrame(
+            {"image_id": ids, "annotator": [{"name": "n", "type": "human"}] * 2}
+        ),
+        image_predictions=pd.DataFrame({"image_id": [], "extra_metadata": []}),
+        metadata_predictions=pd.DataFrame(
+            {
+                "image_id": ids,
+                "row_json": [json.dumps({"value": 0.1}), json.dumps({"value": value})],
+            }
+        ),
+        tissue_area=pd.Series([1.0, 2.0], index=ids),
+    )
+
+
+def test_partition_digests_only_change_for_modified_images():
+    d0 = _inputs(0.5).partition_digests()
+    d1 = _inputs(0.7).partition_digests()
+    assert d0["a"] == d1["a"]
+    assert d0["b"] != d1["b"]
+
+
+def _scores_inputs(scores: dict[str, float]) -> TabularRecordsInputs:
+    ids = list(scores)
+    return TabularRecordsInputs(
+        identifier="tg",
+        metadata=pd.DataFrame({"classification": ["x"] * len(ids)}, index=ids),
+        annotations=pd.DataFrame(
+            {
+                "image_id": ids,
+                "annotator": [{"name": "n", "type": "human"}] * len(ids),
+                "classification": ["tumor"] * len(ids),
+                "geometry": ["POLYGON ((0 0, 1 0, 1 1, 0 0))"] * len(ids),
+            }
+        ),
+        image_predictions=pd.DataFrame({"image_id": [], "extra_metadata": []}),
+        metadata_predictions=pd.DataFrame(
+            {
+                "image_id": ids,
+                "model_extra_json": [json.dumps({"model": "m", "iteration": "v0"})]
+                * len(ids),
+                "row_json": [
+                    json.dumps({"classification": "f", "metric": "score", "value": v})
+                    for v in scores.values()
+                ],
+            }
+        ),
+        tissue_area=pd.Series([1.0] * len(ids), index=ids),
+    )
+
+
+def test_incremental_build_recomputes_only_changed_partitions(monkeypatch):
+    engine = TabularRecordsEngine()
+    computed = []
+    compute = engine.compute
+
+    def _compute(inputs):
+        computed.append(sorted(inputs.metadata.index))
+        return compute(inputs)
+
+    def build(scores, previous=None):
+        inputs = _scores_inputs(scores)
+        monkeypatch.setattr(
+            TabularRecordsInputs, "from_dataset", classmethod(lambda *_: inputs)
+        )
+        return engine.build(None, previous)
+
+    def canonical(df):
+        return df.astype(str).sort_values(list(df.columns)).reset_index(drop=True)
+
+    monkeypatch.setattr(engine, "compute", _compute)
+    r0 = build({"a": 0.1, "b": 0.2, "c": 0.3})
+    # b changed, c was removed and d was added
+    r1 = build({"a": 0.1, "b": 0.5, "d": 0.4}, previous=r0)
+    assert computed == [["a", "b", "c"], ["b", "d"]]
+    assert set(r0.df["image_id"]) == {"a", "b", "c"}
+    assert set(r1.df["image_id"]) == {"a", "b", "d"}
+
+    # unchanged inputs reuse all partitions
+    r2 = build({"a": 0.1, "b": 0.5, "d": 0.4}, previous=r1)
+    assert len(computed) == 2
+    pd.testing.assert_frame_equal(r2.df, r1.df)
+
+    full = build({"a": 0.1, "b": 0.5, "d": 0.4})
+    assert computed[-1] == ["a", "b", "d"]
+    pd.testing.assert_series_equal(r1.df.dtypes, full.df.dtypes)
+    pd.testing.assert_frame_equal(canonical(r1.df), canonical(full.df))
+    pd.testing.assert_series_equal(r1.digests, full.digests)
+
+
+def test_tabular_records_store_builds_once(tmp_path):
+    store = TabularRecordsStore(tmp_path, "memory://dataset")
+    calls = []
+
+    def build():
+        calls.append(1)
+        return TabularRecords(
+            df=pd.DataFrame({"image_id": ["a", "b"], "annotation_area": [1.0, None]}),
+            digests=pd.Series([1, 2], index=["a", "b"], dtype="uint64"),
+            key="key",
+        )
+
+    r0 = store.get_or_build("fp0", build)
+    r1 = store.get_or_build("fp0", build)
+    assert len(calls) == 1
+    pd.testing.assert_frame_equal(r0.df, r1.df)
+    assert r1.key == "key"
+    assert r1.digests["b"] == 2
+
+    # the held lock of a concurrent builder is kept, stale locks are pruned
+    other_lock = tmp_path.joinpath(store.root, "fp2.lock")
+    with FileLock(other_lock):
+        store.get_or_build("fp1", build)
+        assert other_lock.exists()
+    assert len(calls) == 2
+    assert store.load("fp0") is None
+    assert not tmp_path.joinpath(store.root, "fp0.lock").exists()
+    assert store.latest() is not None
+
+
+def test_tabular_records_engine_tissue_area_digest():
+    digest = TabularRecordsEngine.tissue_area_digest
+    failed = pd.Series([1.0, float("nan")], index=["a", "b"])
+    retried = pd.Series([1.0, 2.0], index=["a", "b"])
+    assert digest(failed) == digest(failed.copy())
+    assert digest(failed) != digest(retried)
+
+
+def test_tabular_records_index_query():
+    df = pd.DataFrame(
+        {
+            "classification": pd.Categorical(["b", "a", "c", "a", None]),
+            "annotation_area": [4.0, 1.0, None, 3.0, 2.0],
+        }
+    )
+    index = TabularRecordsIndex(df)
+    assert index.positions("classification", ["a", "x"]).tolist() == [1, 3]
+
+    total, page = index.query(
+        filters={"classification": ["a", "b"], "annotation_area": {"min": 2}},
+        sort=[("annotation_area", False)],
+        columns=["annotation_area"],
+    )
+    assert total == 2
+    assert page["annotation_area"].tolist() == [4.0, 3.0]
+
+    total, page = index.query(sort=[("annotation_area", True)], offset=1, limit=2)
+    assert total == 5
+    assert page["annotation_area"].tolist() == [2.0, 3.0]
+
+
+def test_tabular_records_index_aggregate():
+    df = pd.DataFrame(
+        {
+            "classification": pd.Categorical(["b", "a", "a", None]),
+            "annotation_area": [4.0, 1.0, 3.0, 2.0],
+        }
+    )
+    index = TabularRecordsIndex(df)
+    result = index.aggregate(
+        group_by=["classification"],
+        metrics=[("count", None), ("sum", "annotation_area")],
+    )
+    assert result["total"] == 4
+    groups = {g["key"]["classification"]: g for g in result["groups"]}
+    assert groups["a"]["count"] == 2
+    assert groups["a"]["sum"]["annotation_area"] == 4.0
+    assert groups[None]["count"] == 1
+
+    with pytest.raises(ValueError):
+        index.aggregate(metrics=[("median", "annotation_area")])
+
+
+def test_tabular_records_aggregate_annotation_value():
+    ids = ["a", "b"]
+    inputs = TabularRecordsInputs(
+        identifier="tg",
+        metadata=pd.DataFrame({"classification": ["x", "y"]}, index=ids),
+        annotations=pd.DataFrame(
+            {
+                "image_id": ids,
+                "annotator": [{"name": "n", "type": "human"}] * 2,
+                "classification": ["tumor", "tumor"],
+                "geometry": ["POLYGON ((0 0, 1 0, 1 1, 0 0))"] * 2,
+            }
+        ),
+        image_predictions=pd.DataFrame({"image_id": [], "extra_metadata": []}),
+        metadata_predictions=pd.DataFrame(
+            {
+                "image_id": ids,
+                "model_extra_json": [json.dumps({"model": "m", "iteration": "v0"})] * 2,
+                "row_json": [
+                    json.dumps({"classification": "f", "metric": "score", "value": v})
+                    for v in (0.2, 0.6)
+                ],
+            }
+        ),
+        tissue_area=pd.Series([1.0, 2.0], index=ids),
+    )
+    df = TabularRecordsEngine.concat([TabularRecordsEngine().compute(inputs)])
+    assert df["annotation_value"].dtype == "float64"
+
+    result = TabularRecordsIndex(df).aggregate(
+        group_by=["classification"],
+        metrics=[("mean", "annotation_value"), ("histogram", "annotation_value")],
+        bins=2,
+    )
+    groups = {g["key"]["classification"]: g for g in result["groups"]}
+    assert groups["F"]["mean"]["annotation_value"] == pytest.approx(0.4)
+    assert groups["F"]["histogram"]["annotation_value"] == [1, 1]
+    assert groups["tumor"]["mean"]["annotation_value"] is None
+
+
+def test_tabular_records_index_export():
+    import pyarrow as pa
+
+    df = pd.DataFrame(
+        {
+            "classification": pd.Categorical(["b", "a", "a", None]),
+            "annotation_area": [4.0, 1.0, 3.0, 2.0],
+            "organ": [None, "liver", None, "lung"],
+        }
+    )
+    index = TabularRecordsIndex(df)
+    chunks = index.export(
+        "arrow", filters={"classification": ["a"]}, columns=["organ"], batch_size=1
+    )
+    table = pa.ipc.open_stream(b"".join(chunks)).read_all()
+    assert table.column_names == ["organ"]
+    assert table["organ"].to_pylist() == ["liver", None]
+
+    csv = b"".join(index.export("csv", batch_size=3)).decode()
+    assert len(csv.splitlines()) == 5
+
+    with pytest.raises(ValueError):
+        index.export("xls")
@@ -0,0 +1,77 @@
+from __future__ import annotations
+
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+from pado.images import ImageId
+from PIL import Image as PILImage
+
+from pavo.tissue import TissueAreaService
+from pavo.tissue import tissue_fraction
+
+
+def test_tissue_fraction_ignores_bright_background():
+    rgb = np.full((10, 10, 3), 245, dtype=np.uint8)
+    rgb[:5, :, :] = (200, 120, 180)  # stained tissue
+    rgb[5, :, :] = (60, 60, 60)  # dark, unsaturated debris
+    assert tissue_fraction(rgb) == 0.5
+
+
+class _Image:
+    def __init__(self, color, calls):
+        self.color = color
+        self.calls = calls
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        pass
+
+    def get_thumbnail(self, size):
+        self.calls.append(self.color)
+        if self.color is None:
+            raise OSError("unreadable slide")
+        rgb = np.full((4, 4, 3), 245, dtype=np.uint8)
+        rgb[:2] = self.color
+        return PILImage.fromarray(rgb)
+
+
+class _Images:
+    def __init__(self, colors, mtimes):
+        self.colors = colors
+        self.calls = []
+        self.df = pd.DataFrame(
+            {"width": 10, "height": 10, "time_last_modified": mtimes},
+            index=list(colors),
+        )
+
+    def __getitem__(self, image_id):
+        return _Image(self.colors[image_id], self.calls)
+
+
+def test_tissue_area_service_refresh(tmp_path, monkeypatch):
+    monkeypatch.setattr(TissueAreaService, "load_precomputed", staticmethod(_none))
+    a, b, c = (ImageId(f"{x}.svs", site="mock") for x in "abc")
+    ds = SimpleNamespace(images=_Images({a: (200, 120, 180), b: None}, [0, 0]))
+
+    area = TissueAreaService(tmp_path, "memory://ds").load(ds)
+    assert area.to_dict() == {str(a): 50.0, str(b): 100.0}
+    assert len(ds.images.calls) == 2
+
+    # a new service reloads the stored areas from the parquet sidecar,
+    # and only recomputes the failed, new and changed slides
+    colors = {a: (200, 120, 180), b: (200, 120, 180), c: (200, 120, 180)}
+    ds = SimpleNamespace(images=_Images(colors, [0, 0, 0]))
+    area = TissueAreaService(tmp_path, "memory://ds").load(ds)
+    assert area.to_dict() == {str(a): 50.0, str(b): 50.0, str(c): 50.0}
+    assert len(ds.images.calls) == 2
+
+    ds.images = _Images(colors, [0, 1, 0])
+    TissueAreaService(tmp_path, "memory://ds").load(ds)
+    assert len(ds.images.calls) == 1
+
+
+def _none(ds):
+    return None
@@ -0,0 +1,225 @@
+"""pavo.tissue provides the tissue area of the slides in a dataset
+
+The tissue area normalizes annotation areas in the tabular records. It is
+read from a `precomputed.tissue.parquet` file in the dataset if available.
+Otherwise it is estimated from a low resolution tissue mask of each slide,
+computed in parallel and persisted in a parquet sidecar in the cache, so
+that only new or changed slides need to be opened. The slide dimensions
+from the image provider serve as a fallback.
+"""
+from __future__ import annotations
+
+import hashlib
+import logging
+import os
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+from typing import Sequence
+
+import numpy as np
+import pandas as pd
+from pado.images import ImageId
+from pado.io.files import urlpathlike_to_fs_and_path
+from pado.io.paths import search_dataset
+from pado.types import UrlpathLike
+
+if TYPE_CHECKING:
+    from pado import PadoDataset
+
+__all__ = [
+    "TissueAreaService",
+    "tissue_fraction",
+]
+
+_logger = logging.getLogger("pavo.data.caches")
+
+# bump this whenever the tissue area estimate changes
+TISSUE_AREA_VERSION = 1
+
+# changes of these image provider columns invalidate a stored tissue area
+_STAMP_COLUMNS = ["urlpath", "size_bytes", "time_last_modified", "width", "height"]
+
+
+def tissue_fraction(
+    rgb: np.ndarray,
+    *,
+    min_saturation: int = 20,
+    max_brightness: int = 235,
+) -> float:
+    """return the fraction of a low resolution rgb image covered by tissue
+
+    Stained tissue is colored, while the slide background is bright and
+    unsaturated.
+    """
+    rgb = np.asarray(rgb)[..., :3].astype(np.int16)
+    saturation = rgb.max(axis=-1) - rgb.min(axis=-1)
+    brightness = rgb.mean(axis=-1)
+    mask = (saturation >= min_saturation) & (brightness <= max_brightness)
+    return float(mask.mean()) if mask.size else 0.0
+
+
+class TissueAreaService:
+    """estimate and persist the tissue area of the slides in a dataset"""
+
+    def __init__(
+        self,
+        root: str | os.PathLike[str] | None,
+        urlpath: str,
+        *,
+        max_workers: int = 8,
+        use_masks: bool = True,
+        thumbnail_size: int = 512,
+    ) -> None:
+        if root is None:
+            self.path = None
+        else:
+            urlhash = hashlib.sha256(urlpath.encode()).hexdigest()[:16]
+            tissue_root = os.path.join(os.fspath(root), "tissue")
+            os.makedirs(tissue_root, exist_ok=True)
+            self.path = os.path.join(tissue_root, f"{urlhash}.parquet")
+        self.max_workers = max(1, int(max_workers))
+        self.use_masks = bool(use_masks)
+        self.thumbnail_size = int(thumbnail_size)
+
+    @classmethod
+    def from_cache_path(
+        cls,
+        cache_path: UrlpathLike | None,
+        urlpath: str,
+        **kwargs: int | bool,
+    ) -> TissueAreaService:
+        """return a service persisting to cache_path if it is on the local filesystem"""
+        root = None
+        if cache_path:
+            fs, path = urlpathlike_to_fs_and_path(cache_path)
+            protocols = (fs.protocol,) if isinstance(fs.protocol, str) else fs.protocol
+            if "file" in protocols:
+                root = path
+            else:
+                _logger.warning("tissue area cache requires a local CACHE_PATH")
+        return cls(root, urlpath, **kwargs)  # type: ignore[arg-type]
+
+    def load(self, ds: PadoDataset) -> pd.Series:
+        """return the tissue area in pixels² at level 0 indexed by image id str"""
+        precomputed = self.load_precomputed(ds)
+        if precomputed is not None:
+            return precomputed
+
+        idf = ds.images.df
+        index = pd.Index(idf.index.map(str))
+        area = _dimensions_area(idf)
+        area.index = index
+        if not self.use_masks:
+            return area
+
+        stamps = pd.Series(_stamps(idf), index=index)
+        stored = self._read()
+        valid = stored.reindex(index)
+        missing = index[valid["stamp"].ne(stamps).to_numpy()]
+        if len(missing):
+            _logger.info(
+                f"tissue area: computing {len(missing)} of {len(index)} tissue masks"
+            )
+            image_ids = [ImageId.from_str(iid) for iid in missing]
+            fractions = self._compute_fractions(ds, image_ids)
+            computed = pd.DataFrame(
+                {
+                    "stamp": stamps.loc[missing].to_numpy(),
+                    "fraction": fractions,
+                },
+                index=missing,
+            )
+            stored = pd.concat([stored.loc[stored.index.isin(index)], computed])
+            stored = stored.loc[~stored.index.duplicated(keep="last")]
+            valid = stored.reindex(index)
+            # failed computations are retried on the next load
+            self._write(stored.loc[stored["fraction"].notna()])
+
+        fraction = valid["fraction"]
+        # an empty mask or a failed computation falls back to the dimensions
+        return area.where(~(fraction > 0), area * fraction)
+
+    @staticmethod
+    def load_precomputed(ds: PadoDataset) -> pd.Series | None:
+        """load tissue area from the precomputed tissue geometries"""
+        import shapely
+
+        try:
+            (of,) = search_dataset(ds, "precomputed.tissue.parquet")
+        except ValueError:
+            return None  # no or ambiguous precomputed file
+        try:
+            with of as f:
+                _t = pd.read_parquet(f, columns=["tissue"])
+            tissue = shapely.area(shapely.from_wkb(_t["tissue"].to_numpy()))
+        except (OSError, KeyError, ValueError, shapely.errors.GEOSException) as err:
+            _logger.warning(f"ignoring unreadable precomputed tissue: {err!r}")
+            return None
+        area = pd.Series(tissue, index=_t.index.map(str))
+        return area.groupby(level=0).sum()
+
+    def _compute_fractions(
+        self, ds: PadoDataset, image_ids: Sequence[ImageId]
+    ) -> np.ndarray:
+        """compute the tissue fraction of slides in parallel, nan on failure"""
+        images = ds.images
+        size = (self.thumbnail_size, self.thumbnail_size)
+
+        def compute(image_id: ImageId) -> float:
+            try:
+                with images[image_id] as image:
+                    thumbnail = image.get_thumbnail(size).convert("RGB")
+                return tissue_fraction(np.asarray(thumbnail))
+            except (OSError, KeyError, ValueError, RuntimeError) as err:
+                _logger.warning(f"tissue mask failed for {image_id!r}: {err!r}")
+                return float("nan")
+
+        # slide access is mostly i/o bound, so threads are sufficient
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            return np.fromiter(pool.map(compute, image_ids), dtype=float)
+
+    # --- persistence ---
+
+    def _read(self) -> pd.DataFrame:
+        empty = pd.DataFrame({"stamp": pd.Series(dtype=object), "fraction": []})
+        if self.path is None:
+            return empty
+        try:
+            df = pd.read_parquet(self.path)
+        except FileNotFoundError:
+            return empty
+        except (OSError, ValueError) as err:
+            _logger.warning(f"ignoring unreadable tissue area cache: {err!r}")
+            return empty
+        return df.set_index("image_id")[["stamp", "fraction"]]
+
+    def _write(self, df: pd.DataFrame) -> None:
+        """write the tissue area sidecar atomically"""
+        if self.path is None:
+            return
+        root = os.path.dirname(self.path)
+        fd, tmp = tempfile.mkstemp(dir=root, suffix=".parquet.tmp")
+        os.close(fd)
+        try:
+            df.rename_axis("image_id").reset_index().to_parquet(tmp, index=False)
+            os.replace(tmp, self.path)
+        except (OSError, ValueError) as err:
+            os.unlink(tmp)
+            _logger.warning(f"could not persist tissue area: {err!r}")
+
+
+def _dimensions_area(idf: pd.DataFrame) -> pd.Series:
+    """slide area in pixels² at level 0 from the image provider columns"""
+    width = pd.to_numeric(idf["width"], errors="coerce")
+    height = pd.to_numeric(idf["height"], errors="coerce")
+    return (width * height).astype(float)
+
+
+def _stamps(idf: pd.DataFrame) -> np.ndarray:
+    """a per image stamp of the columns a stored tissue area depends on"""
+    columns = [c for c in _STAMP_COLUMNS if c in idf.columns]
+    stamps = pd.util.hash_pandas_object(
+        idf[columns].astype(str), index=False, categorize=False
+    ).to_numpy()
+    return np.array([f"v{TISSUE_AREA_VERSION}-{s:x}" for s in stamps], dtype=object)
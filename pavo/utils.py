@@ -2,16 +2,22 @@
 from __future__ import annotations
 
 import hashlib
+import io
 import os
 import platform
 from functools import lru_cache
 from functools import wraps
 from getpass import getuser
+from typing import TYPE_CHECKING
 from typing import Any
 from typing import Callable
+from typing import Iterable
+from typing import Iterator
 from typing import Type
 from typing import TypeVar
 
+import orjson
+from flask import has_app_context
 from flask import url_for
 from itsdangerous import base64_decode
 from itsdangerous import base64_encode
@@ -26,11 +32,16 @@ from werkzeug.routing import ValidationError
 
 from pavo._version import version as _pavo_version
 
+if TYPE_CHECKING:
+    from pavo.registry import ImageIdRegistry
+
 _T = TypeVar("_T")
 
 __all__ = [
     "ImageIdConverter",
     "url_for_versioned",
+    "ChunkSink",
+    "json_array_chunks",
     "ranged_type",
     "int_ge_0",
     "int_ge_1",
@@ -53,6 +64,11 @@ class ImageIdConverter(BaseConverter):
     weight = 100
 
     def to_python(self, value: str | bytes) -> ImageId:
+        registry = _loaded_registry()
+        if registry is not None and isinstance(value, str):
+            handle = registry.handle_from_url_id(value)
+            if handle is not None:
+                return registry.image_ids[handle]
         try:
             image_id_str = base64_decode(value).decode()
             return ImageId.from_str(image_id_str)
@@ -61,6 +77,11 @@ class ImageIdConverter(BaseConverter):
 
     def to_url(self, value: ImageId | tuple[str, ...] | str) -> str:
         if isinstance(value, ImageId):
+            registry = _loaded_registry()
+            if registry is not None:
+                url_id = registry.url_id_of(value)
+                if url_id is not None:
+                    return url_id
             image_id_str = value.to_str()
         elif isinstance(value, (tuple, list)):
             image_id_str = ImageId.make(value[1:], site=value[0]).to_str()
@@ -72,6 +93,16 @@ class ImageIdConverter(BaseConverter):
         return base64_encode(image_id_str.encode()).decode()
 
 
+def _loaded_registry() -> ImageIdRegistry | None:
+    """the image id registry of the datasets if they are already opened"""
+    from pavo.data import dataset
+
+    if not has_app_context():
+        return None
+    snapshot = dataset.get_loaded_snapshot()
+    return None if snapshot is None else snapshot.registry
+
+
 _version_hash = hashlib.sha256(_pavo_version.encode()).hexdigest()[:8]
 
 
@@ -83,6 +114,60 @@ def url_for_versioned(endpoint: str, **values: Any) -> str:
     return url_for(endpoint, **values)
 
 
+# --- streaming ---
+
+
+class ChunkSink(io.RawIOBase):
+    """a writable file collecting the bytes written since the last drain"""
+
+    def __init__(self) -> None:
+        super().__init__()
+        self._chunks: list[bytes] = []
+        self._position = 0
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, b: Any) -> int:
+        data = bytes(b)
+        self._chunks.append(data)
+        self._position += len(data)
+        return len(data)
+
+    def tell(self) -> int:
+        return self._position
+
+    def drain(self) -> bytes:
+        data = b"".join(self._chunks)
+        self._chunks.clear()
+        return data
+
+
+def json_array_chunks(
+    items: Iterable[Any],
+    *,
+    head: bytes = b"[",
+    tail: bytes = b"]",
+    batch_size: int = 1000,
+) -> Iterator[bytes]:
+    """yield a json array of items in chunks of batch_size items
+
+    head and tail allow embedding the array in an enclosing object.
+    """
+    yield head
+    sep = b""
+    batch = []
+    for item in items:
+        batch.append(orjson.dumps(item))
+        if len(batch) >= batch_size:
+            yield sep + b",".join(batch)
+            sep = b","
+            batch.clear()
+    if batch:
+        yield sep + b",".join(batch)
+    yield tail
+
+
 # --- request types ---
 
 